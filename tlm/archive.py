@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  archive.py
+#  
+#  Copyright 2014 Balint Seeber <balint256@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+# Binary archive of deframed minor frames
+# File: <header> <block>... [<index> <trailer>] (little-endian)
+# Each block holds up to 'block_records' fixed-size records, stored a field at a time (and each byte position of the payload together, which compresses far better than whole records) and zlib-compressed
+# The index and trailer are written on close: without them (e.g. still being recorded, or it crashed) the blocks are scanned instead
+
+import os, struct, zlib, time, datetime
+import numpy
+
+from constants import *
+import input, utils
+
+ARCHIVE_MAGIC	= "TLMARCH1"
+ARCHIVE_VERSION	= 1
+
+ARCHIVE_FLAG_SYNC	= 0x01	# Deframer (re)acquired sync at this frame
+ARCHIVE_FLAG_DROP	= 0x02	# Data was lost before this frame
+
+RECORD_DTYPE = numpy.dtype([
+	('time',	'<f8'),	# Receive time (seconds since the epoch)
+	('flags',	'u1'),
+	('source',	'u1'),	# Source ID given to the writer (e.g. which station it came from)
+	('data',	'u1', (MINOR_FRAME_LEN,)),
+])
+
+BLOCK_INDEX_DTYPE = numpy.dtype([
+	('offset',	'<u8'),	# Of the block header in the file
+	('record',	'<u8'),	# Number of the block's first record
+	('count',	'<u4'),
+	('start',	'<f8'),	# Time of first and last records
+	('end',		'<f8'),
+])
+
+_HEADER		= struct.Struct('<8sHHI')	# Magic, version, payload length, records per block
+_BLOCK		= struct.Struct('<4sIIIdd')	# Marker, compressed length, record count, CRC of compressed data, first time, last time
+_BLOCK_MARKER	= "BLCK"
+_TRAILER	= struct.Struct('<8sQQ')	# Magic, index offset, block count
+_INDEX_MAGIC	= "TLMAIDX1"
+
+def is_archive(file_path):
+	try:
+		f = open(file_path, 'rb')
+	except IOError:
+		return False
+	try:
+		return f.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+	finally:
+		f.close()
+
+def _pack_block(records):
+	return records['time'].tostring() + records['flags'].tostring() + records['source'].tostring() + records['data'].T.tostring()
+
+def _unpack_block(body, count):
+	records = numpy.zeros(count, dtype=RECORD_DTYPE)
+	offset = 0
+	for name, itemsize in [('time', 8), ('flags', 1), ('source', 1)]:
+		records[name] = numpy.frombuffer(body, dtype=RECORD_DTYPE[name], count=count, offset=offset)
+		offset += count * itemsize
+	records['data'] = numpy.frombuffer(body, dtype=numpy.uint8, count=count*MINOR_FRAME_LEN, offset=offset).reshape(MINOR_FRAME_LEN, count).T
+	return records
+
+def _scan_blocks(f, file_size):	# Block index and where the last complete block ends
+	f.seek(_HEADER.size)
+	offset = _HEADER.size
+	record = 0
+	blocks = []
+	while (offset + _BLOCK.size) <= file_size:
+		(marker, length, count, crc, start, end) = _BLOCK.unpack(f.read(_BLOCK.size))
+		if marker != _BLOCK_MARKER or (offset + _BLOCK.size + length) > file_size:
+			break	# Index (or a partly written block)
+		data = f.read(length)
+		if (zlib.crc32(data) & 0xffffffff) != crc:
+			break
+		blocks += [(offset, record, count, start, end)]
+		offset += _BLOCK.size + length
+		record += count
+	return (numpy.array(blocks, dtype=BLOCK_INDEX_DTYPE), offset)
+
+def _read_index(f, file_size):	# From the trailer (None if there isn't a valid one)
+	if file_size < (_HEADER.size + _TRAILER.size):
+		return None
+	f.seek(file_size - _TRAILER.size)
+	(magic, index_offset, block_cnt) = _TRAILER.unpack(f.read(_TRAILER.size))
+	if magic != _INDEX_MAGIC or (index_offset + (block_cnt * BLOCK_INDEX_DTYPE.itemsize) + _TRAILER.size) != file_size:
+		return None
+	f.seek(index_offset)
+	blocks = numpy.fromfile(f, dtype=BLOCK_INDEX_DTYPE, count=block_cnt)
+	if len(blocks) != block_cnt:
+		return None
+	return (blocks, index_offset)
+
+def _open_archive(f):	# Checks the header, returns (records per block, block index, end of blocks)
+	header = f.read(_HEADER.size)
+	if len(header) != _HEADER.size:
+		raise Exception("Archive is too short")
+	(magic, version, payload_length, block_records) = _HEADER.unpack(header)
+	if magic != ARCHIVE_MAGIC:
+		raise Exception("Not an archive")
+	if version != ARCHIVE_VERSION:
+		raise Exception("Unsupported archive version: %d" % (version))
+	if payload_length != MINOR_FRAME_LEN:
+		raise Exception("Archive has %d byte frames" % (payload_length))
+	
+	file_size = os.fstat(f.fileno()).st_size
+	res = _read_index(f, file_size)
+	if res is None:
+		res = _scan_blocks(f, file_size)
+	(blocks, end) = res
+	return (block_records, blocks, end)
+
+class ArchiveWriter():	# Records completed minor frames (register it for a FrameTracker's EVENT_NEW_FRAME)
+	def __init__(self, file_path, engine=None, source=0, block_records=1024, block_interval=60.0, level=6):
+		self.file_path = file_path
+		self.engine = engine	# For the receive time of each frame
+		self.source = source
+		self.block_interval = block_interval	# Seconds before a block is written even if it isn't full (limits what's lost if we crash)
+		self.level = level
+		self.records = None
+		self.record_cnt = 0	# In the current block
+		self.block_start_time = None
+		self.blocks = []
+		self.frame_cnt = 0
+		self.raw_bytes = 0
+		self.written_bytes = 0
+		self.f = None
+		
+		if os.path.exists(file_path) and os.path.getsize(file_path) > 0:	# Carry on where it left off
+			self.f = open(file_path, 'r+b')
+			(self.block_records, blocks, end) = _open_archive(self.f)
+			self.blocks = map(tuple, blocks.tolist())
+			for block in self.blocks:
+				self.frame_cnt += block[2]
+			self.f.seek(end)
+			self.f.truncate()	# Old index (written again on close)
+		else:
+			self.block_records = block_records
+			self.f = open(file_path, 'wb')
+			self.f.write(_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, MINOR_FRAME_LEN, self.block_records))
+		
+		self.records = numpy.zeros(self.block_records, dtype=RECORD_DTYPE)
+	def __call__(self, event, source, frame, minor_frame_idx=None, sync=False, drop=False, *args, **kwds):
+		t = None
+		if minor_frame_idx is not None:
+			t = source.get_minor_frame_time(minor_frame_idx)	# When the frame's input buffer was received (recorded times when replaying)
+		if t is None and self.engine is not None:
+			t = self.engine.get_local_time_now()
+		self.write(frame, t, sync, drop)
+	def write(self, frame, t=None, sync=False, drop=False):	# 't' is a local datetime (None: now)
+		if self.f is None:
+			return
+		if t is None:
+			t = datetime.datetime.now()
+		t = utils.to_epoch(t)
+		
+		flags = 0
+		if sync:
+			flags |= ARCHIVE_FLAG_SYNC
+		if drop:
+			flags |= ARCHIVE_FLAG_DROP
+		
+		record = self.records[self.record_cnt]
+		record['time'] = t
+		record['flags'] = flags
+		record['source'] = self.source
+		record['data'] = frame
+		if self.record_cnt == 0:
+			self.block_start_time = time.time()
+		self.record_cnt += 1
+		self.frame_cnt += 1
+		
+		if self.record_cnt == self.block_records:
+			self.flush()
+		else:
+			self.check_flush()
+	def check_flush(self):	# Write out the current block once it's been open for 'block_interval' (call regularly, as frames may stop arriving)
+		if self.record_cnt > 0 and (time.time() - self.block_start_time) >= self.block_interval:
+			self.flush()
+	def flush(self):	# Write out the current block
+		if self.record_cnt == 0:
+			return
+		records = self.records[:self.record_cnt]
+		data = zlib.compress(_pack_block(records), self.level)
+		offset = self.f.tell()
+		self.f.write(_BLOCK.pack(_BLOCK_MARKER, len(data), self.record_cnt, zlib.crc32(data) & 0xffffffff, records[0]['time'], records[-1]['time']))
+		self.f.write(data)
+		self.f.flush()
+		record = 0
+		if len(self.blocks) > 0:
+			record = self.blocks[-1][1] + self.blocks[-1][2]
+		self.blocks += [(offset, record, self.record_cnt, records[0]['time'], records[-1]['time'])]
+		self.raw_bytes += self.record_cnt * RECORD_DTYPE.itemsize
+		self.written_bytes += _BLOCK.size + len(data)
+		self.record_cnt = 0
+	def close(self):
+		if self.f is None:
+			return
+		self.flush()
+		index_offset = self.f.tell()
+		numpy.array(self.blocks, dtype=BLOCK_INDEX_DTYPE).tofile(self.f)
+		self.f.write(_TRAILER.pack(_INDEX_MAGIC, index_offset, len(self.blocks)))
+		self.f.close()
+		self.f = None
+	def get_frame_count(self): return self.frame_cnt
+	def get_compression_ratio(self):	# Of blocks written since opening
+		if self.written_bytes == 0:
+			return None
+		return float(self.raw_bytes) / self.written_bytes
+	def get_status_string(self):
+		status = "Archive: %d frames" % (self.frame_cnt)
+		ratio = self.get_compression_ratio()
+		if ratio is not None:
+			status += " (%.1fx)" % (ratio)
+		return status
+
+class ArchiveInput(input.ReplayInput):	# Replays an archive
+	def __init__(self, frames_per_read=32, *args, **kwds):
+		input.ReplayInput.__init__(self, *args, **kwds)
+		self.frames_per_read = frames_per_read
+		self.f = None
+		self.blocks = numpy.zeros(0, dtype=BLOCK_INDEX_DTYPE)
+		self.reset()
+	def reset(self):
+		self.file_path = None
+		self.block_idx = 0	# Next to read
+		self.records = None	# Current block
+		self.record_idx = 0	# In the current block
+		self.first = True
+	def start(self, file_path, *args, **kwds):
+		input.Input.start(self, *args, **kwds)
+		self.reset()
+		self.f = open(file_path, 'rb')
+		self.file_path = file_path
+		(block_records, self.blocks, end) = _open_archive(self.f)
+	def stop(self):
+		if self.f:
+			self.f.close()
+			self.f = None
+		input.Input.stop(self)
+	def get_frame_count(self):
+		if len(self.blocks) == 0:
+			return 0
+		return int(self.blocks[-1]['record'] + self.blocks[-1]['count'])
+	def _read_block(self, block_idx):
+		block = self.blocks[block_idx]
+		self.f.seek(int(block['offset']))
+		(marker, length, count, crc, start, end) = _BLOCK.unpack(self.f.read(_BLOCK.size))
+		return _unpack_block(zlib.decompress(self.f.read(length)), count)
+	def seek_frame(self, frame_idx):
+		block_idx = int(numpy.searchsorted(self.blocks['record'], frame_idx, side='right')) - 1
+		block_idx = max(0, block_idx)
+		self.records = None
+		self.block_idx = block_idx
+		self.record_idx = 0
+		if block_idx < len(self.blocks):
+			self.records = self._read_block(block_idx)
+			self.block_idx += 1
+			self.record_idx = max(0, min(frame_idx - int(self.blocks[block_idx]['record']), len(self.records)))
+		self.first = True	# So the deframer resyncs
+		self.buffers = []
+		self.pacer.reset()
+	def seek_time(self, t):	# Local datetime: first frame received at or after it
+		t = utils.to_epoch(t)
+		block_idx = int(numpy.searchsorted(self.blocks['end'], t))
+		if block_idx == len(self.blocks):
+			self.seek_frame(self.get_frame_count())
+			return
+		records = self._read_block(block_idx)
+		self.seek_frame(int(self.blocks[block_idx]['record']) + int(numpy.searchsorted(records['time'], t)))
+	def _read(self):
+		while self.records is None or self.record_idx == len(self.records):
+			if self.block_idx == len(self.blocks):
+				return None
+			self.records = self._read_block(self.block_idx)
+			self.block_idx += 1
+			self.record_idx = 0
+		
+		records = self.records[self.record_idx:self.record_idx+self.frames_per_read]
+		self.record_idx += len(records)
+		
+		data = records['data'].tostring()	# Plain Python values from here (much quicker than indexing records one at a time)
+		record_flags = records['flags'].tolist()
+		times = records['time'].tolist()
+		for i in range(len(records)):
+			flags = input.Buffer.FLAG_NONE
+			if self.first or (record_flags[i] & ARCHIVE_FLAG_SYNC):
+				flags |= input.Buffer.FLAG_FIRST
+				self.first = False
+			if record_flags[i] & ARCHIVE_FLAG_DROP:
+				flags |= input.Buffer.FLAG_DROP
+			self.enqueue_data(input.Buffer(data[i*MINOR_FRAME_LEN:(i+1)*MINOR_FRAME_LEN], flags=flags, time=datetime.datetime.fromtimestamp(times[i])))
+		return times
+	def get_status_string(self):
+		if not self.f:
+			return "No file open"
+		frame_idx = 0
+		if self.block_idx > 0:
+			frame_idx = int(self.blocks[self.block_idx - 1]['record']) + self.record_idx
+		return "Replaying archive: '%s' (frame %d/%d)%s" % (self.file_path, frame_idx, self.get_frame_count(), self.pacer.get_status_string())
+
+def main():
+	return 0
+
+if __name__ == '__main__':
+	main()
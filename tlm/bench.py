@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench.py
+#  
+#  Copyright 2014 Balint Seeber <balint256@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+import sys, os, time, random, datetime, gc, resource, socket, json, tempfile, shutil
+
+from optparse import OptionParser, Values
+
+import net, tlm, input, archive
+from constants import *
+
+SYNC_WORD = [0x12, 0xfc, 0x81, 0x9f, 0xbe]
+
+def generate_symbol_capture(frame_cnt, error_rate=0.0, seed=0):
+	# Hard-decision symbols as they arrive from BorIP (bit 0: symbol, bit 1: correlator flag)
+	rng = random.Random(seed)
+	syms = []
+	for i in range(frame_cnt):
+		frame = [rng.randint(0, 255) for j in range(MINOR_FRAME_LEN - len(SYNC_WORD))]
+		frame[MINOR_FRAME_IDX_OFFSET] = i % NUM_MINOR_FRAMES
+		frame += SYNC_WORD
+		bits = [(b >> (7-j)) & 0x1 for b in frame for j in range(8)]
+		for j in range(len(bits)):
+			d1 = rng.randint(0, 1)
+			d2 = d1 ^ bits[j] ^ 0x1
+			if error_rate > 0 and rng.random() < error_rate:
+				d2 ^= 0x1
+			if j == (len(bits) - 1):	# Correlator fires on the last bit of the access code
+				if error_rate == 0 or rng.random() >= error_rate * 100:
+					d1 |= 0x2
+			elif error_rate > 0 and rng.random() < error_rate / 10:
+				d1 |= 0x2	# False correlation
+			syms += [d1, d2]
+	return "".join(map(chr, syms))
+
+def generate_frames(frame_cnt, seed=0, change_rate=1.0, mode=MODE_ENG):
+	# 'change_rate' is the chance of a byte differing from the last time it was sent (housekeeping is mostly static)
+	rng = random.Random(seed)
+	subcoms = []
+	if change_rate < 1.0:	# Subcom bytes move between columns, so they need to be kept static separately
+		for subcom_key in sorted(MODE_MAP[mode].keys()):
+			(length, cols) = MODE_MAP[mode][subcom_key]
+			subcoms += [([rng.randint(0, 255) for j in range(length)], cols)]
+	frames = []
+	for i in range(frame_cnt):
+		minor_frame_idx = i % NUM_MINOR_FRAMES
+		if change_rate < 1.0 and i > 0:
+			frame = frames[i - 1][:-len(SYNC_WORD)]
+			for j in range(len(frame)):
+				if rng.random() < change_rate:
+					frame[j] = rng.randint(0, 255)
+		else:
+			frame = [rng.randint(0, 255) for j in range(MINOR_FRAME_LEN - len(SYNC_WORD))]
+		for (subcom, cols) in subcoms:
+			for j in range(len(cols)):
+				subcom_idx = ((minor_frame_idx * len(cols)) + j) % len(subcom)	# Same order as the SubcomTracker
+				if rng.random() < change_rate:
+					subcom[subcom_idx] = rng.randint(0, 255)
+				frame[cols[j]] = subcom[subcom_idx]
+		frame[MINOR_FRAME_IDX_OFFSET] = minor_frame_idx
+		frames += [frame + SYNC_WORD]
+	return frames
+
+def load_symbol_capture(file_path):
+	f = open(file_path, 'rb')
+	try:
+		return f.read()
+	finally:
+		f.close()
+
+def generate_pk_text(frame_cnt, error_rate=0.0, seed=0):	# Frames as the PK server sends them (header line then 8 lines of 16 hex values)
+	rng = random.Random(seed)
+	lines = []
+	for i in range(frame_cnt):
+		header = "Frame %d" % (i)
+		if error_rate > 0 and rng.random() < error_rate * 10:
+			header += " (bad)"
+		lines += [header]
+		for j in range(8):
+			values = ["%02x" % (rng.randint(0, 255)) for k in range(16)]
+			if error_rate > 0:
+				for k in range(len(values)):
+					r = rng.random()
+					if r < error_rate:
+						values[k] = "zz"	# Garbled
+					elif r < error_rate * 2:
+						values[k] = values[k][1]	# Single digit (still valid)
+				if rng.random() < error_rate:
+					values = values[:-1]	# Short line
+			lines += [" ".join(values) + "\r"]
+	return "\n".join(lines) + "\n"
+
+def split_buffers(data, buffer_size, drop_rate=0.0, seed=0):
+	rng = random.Random(seed)
+	buffers = []
+	for i in range(0, len(data), buffer_size):
+		flags = net.Buffer.FLAG_NONE
+		if drop_rate > 0 and rng.random() < drop_rate:
+			flags |= net.Buffer.FLAG_DROP
+		buffers += [net.Buffer(data[i:i+buffer_size], flags)]
+	return buffers
+
+class FrameCollector():
+	def __init__(self, length):
+		self.length = length
+		self.frames = []
+		self.resync = False
+	def __call__(self, byte, frame, sync=False, idx=None, time=None):
+		if idx is None:
+			idx = len(frame) - 1
+		if idx == 0:
+			self.resync = sync
+		if idx == (self.length - 1):
+			self.frames += [(tuple(frame), self.resync)]
+
+def bench_symbols(options, args):
+	if len(args) > 0:
+		print "Loading symbol capture:", args[0]
+		data = load_symbol_capture(args[0])
+	else:
+		print "Generating %d frames of symbols (error rate: %f)" % (options.frames, options.error_rate)
+		data = generate_symbol_capture(options.frames, options.error_rate, options.seed)
+	
+	buffers = split_buffers(data, options.buffer_size, options.drop_rate, options.seed)
+	print "%d symbols in %d buffers" % (len(data), len(buffers))
+	
+	deframers = [('SymbolDeframer', tlm.SymbolDeframer), ('VectorSymbolDeframer', tlm.VectorSymbolDeframer)]
+	
+	results = []
+	for name, deframer_class in deframers:
+		collector = FrameCollector(MINOR_FRAME_LEN)
+		deframer = deframer_class(MINOR_FRAME_LEN)
+		deframer.process(buffers, collector)
+		
+		durations = []
+		for i in range(options.repeat):
+			deframer = deframer_class(MINOR_FRAME_LEN)
+			start = time.time()
+			deframer.process(buffers)
+			durations += [time.time() - start]
+		
+		duration = min(durations)
+		print "%-20s: %.3f s (%.0f symbols/s), complete frames: %d, sync resets: %d" % (name, duration, len(data) / duration, deframer.get_complete_frame_count(), deframer.get_sync_reset_count())
+		results += [(name, duration, collector.frames, deframer.get_complete_frame_count(), deframer.get_sync_reset_count())]
+	
+	reference = results[0]
+	for result in results[1:]:
+		identical = (result[2:] == reference[2:])
+		print "%s vs %s: %s, speed-up: %.1fx" % (result[0], reference[0], ("identical" if identical else "DIFFERENT"), reference[1] / result[1])
+		if not identical:
+			return False
+	
+	return True
+
+def bench_pk(options, args):
+	if len(args) > 0:
+		print "Loading PK text:", args[0]
+		data = load_symbol_capture(args[0])
+	else:
+		print "Generating %d frames of PK text (error rate: %f)" % (options.frames, options.error_rate)
+		data = generate_pk_text(options.frames, options.error_rate, options.seed)
+	
+	chunks = [data[i:i+options.buffer_size] for i in range(0, len(data), options.buffer_size)]
+	print "%d bytes in %d chunks" % (len(data), len(chunks))
+	
+	parsers = [('LinePKParser', input.LinePKParser), ('PKParser', input.PKParser)]
+	
+	results = []
+	for name, parser_class in parsers:
+		durations = []
+		for i in range(options.repeat):
+			parser = parser_class()
+			frames = []
+			start = time.time()
+			for chunk in chunks:
+				if parser.parse(chunk):
+					frames += parser.get_frames()
+			durations += [time.time() - start]
+		
+		duration = min(durations)
+		print "%-12s: %.3f s (%.1f MB/s, %.0f frames/s), frames: %d, bad lines: %d" % (name, duration, len(data) / duration / 1e6, len(frames) / duration, parser.frame_cnt, parser.bad_line_cnt)
+		frames = [(f.get_buffer(), f.get_flags(), f.get_original()) for f in frames]
+		results += [(name, duration, frames, parser.frame_cnt, parser.bad_line_cnt)]
+	
+	reference = results[0]
+	for result in results[1:]:
+		identical = (result[2:] == reference[2:])
+		print "%s vs %s: %s, speed-up: %.1fx" % (result[0], reference[0], ("identical" if identical else "DIFFERENT"), reference[1] / result[1])
+		if not identical:
+			return False
+	
+	return True
+
+def _read_input(data_input):	# Every buffer until EOF
+	buffers = []
+	while True:
+		data = data_input.get_data()
+		if data is None:
+			break
+		buffers += data
+	return buffers
+
+def bench_archive(options, args):	# Record generated frames as PK text and as an archive, then compare the two for size and replay
+	print "Generating %d minor frames (change rate: %f)" % (options.frames, options.change_rate)
+	frames = generate_frames(options.frames, options.seed, options.change_rate, options.mode)
+	
+	path = tempfile.mkdtemp()
+	try:
+		pk_path = os.path.join(path, "frames.log")
+		archive_path = os.path.join(path, "frames.arc")
+		
+		lines = []
+		for i in range(len(frames)):
+			lines += ["Frame %d" % (i)]
+			for j in range(0, MINOR_FRAME_LEN, 16):
+				lines += [" ".join(["%02x" % (b) for b in frames[i][j:j+16]])]
+		f = open(pk_path, 'w')
+		f.write("\n".join(lines) + "\n")
+		f.close()
+		
+		start = time.time()
+		writer = archive.ArchiveWriter(archive_path)
+		for frame in frames:
+			writer.write(frame)
+		writer.close()
+		duration = time.time() - start
+		print "Archive written: %.3f s (%.0f frames/s), compression: %.1fx" % (duration, len(frames) / duration, writer.get_compression_ratio())
+		
+		pk_size = os.path.getsize(pk_path)
+		archive_size = os.path.getsize(archive_path)
+		print "PK text: %d bytes, archive: %d bytes (%.1fx smaller, %.1f bytes/frame)" % (pk_size, archive_size, float(pk_size) / archive_size, float(archive_size) / len(frames))
+		
+		results = []
+		for name, input_class in [('FileInput', input.FileInput), ('ArchiveInput', archive.ArchiveInput)]:
+			file_path = pk_path
+			if input_class == archive.ArchiveInput:
+				file_path = archive_path
+			durations = []
+			for i in range(options.repeat):
+				data_input = input_class()
+				data_input.start(file_path)
+				start = time.time()
+				buffers = _read_input(data_input)
+				durations += [time.time() - start]
+				data_input.stop()
+			duration = min(durations)
+			print "%-12s: %.3f s (%.0f frames/s)" % (name, duration, len(buffers) / duration)
+			results += [(name, duration, [b.get_buffer() for b in buffers])]
+	finally:
+		shutil.rmtree(path)
+	
+	identical = (results[1][2] == results[0][2])
+	print "%s vs %s: %s, speed-up: %.1fx" % (results[1][0], results[0][0], ("identical" if identical else "DIFFERENT"), results[0][1] / results[1][1])
+	return identical
+
+def create_engine(options):	# Headless engine with elements loaded and tracked, but no I/O started
+	engine_options = Values({
+		'load_path':		os.path.dirname(os.path.abspath(__file__)),
+		'mode':				options.mode,
+		'headless':			True,
+		'input':			None,
+		'network_address':	None,
+		'vector_deframer':	False,
+		'receive_buffer':	0,
+		'archive':			None,
+		'on_demand':		options.on_demand,
+		'history_length':	options.history_length,
+		'history_duration':	options.history_duration,
+	})
+	engine = tlm.Engine(engine_options)
+	engine.load()
+	return engine
+
+def get_max_rss():	# KB on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_replay(options, args):
+	print "Generating %d minor frames (change rate: %f)" % (options.frames, options.change_rate)
+	frames = generate_frames(options.frames, options.seed, options.change_rate, options.mode)
+	buffers = []
+	for frame in frames:
+		flags = net.Buffer.FLAG_NONE
+		if len(buffers) == 0:
+			flags |= net.Buffer.FLAG_FIRST
+		buffers += [net.Buffer("".join(map(chr, frame)), flags)]
+	
+	engine = create_engine(options)
+	deframer = tlm.ByteDeframer(MINOR_FRAME_LEN)
+	
+	if options.watch:	# Acquire like a UI layout or server client would
+		for element_id in options.watch.split(','):
+			if engine.element_state_manager.acquire(element_id, safe=False) is None:
+				print "Unknown element:", element_id
+				return False
+	if options.on_demand:
+		print "Decoding %d of %d elements on demand" % (len(engine.element_state_manager.consumer_counts), len(engine.element_manager.get_element_ids()))
+	
+	gc.collect()
+	object_cnt = len(gc.get_objects())
+	max_rss = get_max_rss()
+	
+	start = time.time()
+	for i in range(0, len(buffers), options.buffer_size):
+		engine.local_time_now = datetime.datetime.now()
+		if options.per_byte:
+			deframer.process(buffers[i:i+options.buffer_size], accept_fn=engine.accept_byte)
+		else:
+			deframer.process(buffers[i:i+options.buffer_size], accept_frame_fn=engine.accept_frame)
+	duration = time.time() - start
+	
+	gc.collect()
+	
+	print "%s: %.3f s (%.0f frames/s), complete frames: %d" % (("Per-byte" if options.per_byte else "Per-frame"), duration, len(frames) / duration, deframer.get_complete_frame_count())
+	print "Frame storage: %d bytes, max RSS growth: %d KB, objects retained: %d" % (engine.frame_tracker.get_memory_usage(), get_max_rss() - max_rss, len(gc.get_objects()) - object_cnt)
+	if options.history_length > 0 or options.history_duration > 0:
+		print "Element history: %d bytes" % (engine.element_state_manager.get_history_memory_usage())
+	
+	hit_cnt = 0
+	miss_cnt = 0
+	for element_state in engine.element_state_manager.element_state_map.values():
+		(hits, misses) = element_state.get_cache_stats()
+		hit_cnt += hits
+		miss_cnt += misses
+	if (hit_cnt + miss_cnt) > 0:
+		print "Element updates: %d, unchanged raw input (parse skipped): %d (%.1f%%)" % (hit_cnt + miss_cnt, hit_cnt, 100.0 * hit_cnt / (hit_cnt + miss_cnt))
+	
+	return True
+
+def _wait_for(condition, timeout=30.0, sleep=0.001):
+	start = time.time()
+	while not condition():
+		if (time.time() - start) > timeout:
+			return False
+		time.sleep(sleep)
+	return True
+
+def _read_response(connection, timeout=30.0):	# One JSON line
+	connection.settimeout(timeout)
+	data = ""
+	while not data.endswith('\n'):
+		chunk = connection.recv(1)
+		if len(chunk) == 0:
+			raise Exception("Connection closed")
+		data += chunk
+	return json.loads(data)
+
+def _send_requests(engine, connections, requests):	# Times until every client has its response, then how long the engine thread takes to apply the tracking changes
+	start = time.time()
+	for i in range(len(connections)):
+		connections[i][0].sendall(json.dumps(requests[i]) + '\n')
+	for connection, client_element_ids in connections:
+		_read_response(connection)
+	duration = time.time() - start
+	
+	start = time.time()
+	engine.run_commands()	# As the engine thread would at the next frame boundary
+	return (duration, time.time() - start)
+
+def _print_request_stats(server):
+	for name in ['request', 'lock wait', 'tracking']:
+		cnt, average, maximum = server.get_request_stats(name)
+		print "    %-9s: %d, average: %.3f ms, max: %.3f ms" % (name, cnt, average * 1e3, maximum * 1e3)
+
+def bench_registrations(options, args):	# Server register/unregister/disconnect with many clients
+	engine = create_engine(options)
+	server = engine.server
+	server.log = lambda msg: None
+	server.start(address='127.0.0.1', port=0)
+	
+	element_ids = sorted(engine.element_manager.get_element_ids())
+	element_cnt = min(options.client_elements, len(element_ids))
+	rng = random.Random(options.seed)
+	
+	print "%d clients registering %d of %d elements each" % (options.clients, element_cnt, len(element_ids))
+	
+	connections = []
+	try:
+		for i in range(options.clients):
+			connection = socket.create_connection(server.server.server_address)
+			connections += [(connection, rng.sample(element_ids, element_cnt))]
+		if not _wait_for(lambda: server.get_client_count() == options.clients):
+			print "Not all clients connected"
+			return False
+		
+		requests = []
+		for i in range(len(connections)):
+			requests += [{'action':'register', 'data':connections[i][1], 'seq':i}]
+		duration, engine_duration = _send_requests(engine, connections, requests)
+		print "Register:   %.3f s (%.0f elements/s), engine: %.3f s, triggers: %d, elements: %d" % (duration, options.clients * element_cnt / duration, engine_duration, len(server.registration_map), len(server.element_refs))
+		
+		requests = []
+		for i in range(len(connections)):
+			requests += [{'action':'unregister', 'data':connections[i][1][:element_cnt/2], 'seq':i}]
+		duration, engine_duration = _send_requests(engine, connections, requests)
+		print "Unregister: %.3f s (%.0f elements/s), engine: %.3f s, triggers: %d, elements: %d" % (duration, options.clients * (element_cnt/2) / duration, engine_duration, len(server.registration_map), len(server.element_refs))
+		
+		start = time.time()
+		for connection, client_element_ids in connections:
+			connection.close()
+		connections = []
+		if not _wait_for(lambda: server.get_client_count() == 0):
+			print "Not all clients disconnected"
+			return False
+		duration = time.time() - start
+		start = time.time()
+		engine.run_commands()
+		print "Disconnect: %.3f s, engine: %.3f s, triggers: %d, elements: %d" % (duration, time.time() - start, len(server.registration_map), len(server.element_refs))
+		
+		print "Server requests:"
+		_print_request_stats(server)
+		
+		if len(server.registration_map) > 0 or len(server.element_refs) > 0 or len(engine.element_state_manager.consumer_counts) > 0:
+			print "Registrations left behind after disconnect"
+			return False
+	finally:
+		for connection, client_element_ids in connections:
+			connection.close()
+		server.stop()
+	
+	return True
+
+_BENCHMARKS = {
+	'symbols':			bench_symbols,
+	'pk':				bench_pk,
+	'archive':			bench_archive,
+	'replay':			bench_replay,
+	'registrations':	bench_registrations,
+}
+
+def main():
+	parser = OptionParser(usage="%%prog: [options] <%s> [args]" % ("|".join(sorted(_BENCHMARKS.keys()))))
+	
+	parser.add_option("-n", "--frames", type="int", default=2000, help="number of minor frames to generate [default=%default]")
+	parser.add_option("-e", "--error-rate", type="float", default=0.0, help="generated symbol error rate [default=%default]")
+	parser.add_option("-d", "--drop-rate", type="float", default=0.0, help="fraction of buffers flagged as dropped [default=%default]")
+	parser.add_option("-b", "--buffer-size", type="int", default=1020, help="symbols (or bytes of PK text) per buffer [default=%default]")
+	parser.add_option("-r", "--repeat", type="int", default=3, help="timing repetitions (best is reported) [default=%default]")
+	parser.add_option("-S", "--seed", type="int", default=0, help="random seed [default=%default]")
+	parser.add_option("-m", "--mode", type="string", default=MODE_ENG, help="telemetry mode for replay [default=%default]")
+	parser.add_option("-c", "--change-rate", type="float", default=1.0, help="chance of a replayed byte changing between minor frames [default=%default]")
+	parser.add_option("-D", "--on-demand", action="store_true", default=False, help="only decode watched elements during replay [default=%default]")
+	parser.add_option("-w", "--watch", type="string", default=None, help="comma-separated element IDs to watch during replay [default=%default]")
+	parser.add_option("-B", "--per-byte", action="store_true", default=False, help="replay through the per-byte path [default=%default]")
+	parser.add_option("-k", "--history-length", type="int", default=0, help="samples of history kept for each element [default=%default]")
+	parser.add_option("-K", "--history-duration", type="float", default=0.0, help="seconds of history kept for each element [default=%default]")
+	parser.add_option("-C", "--clients", type="int", default=200, help="server clients for registrations [default=%default]")
+	parser.add_option("-E", "--client-elements", type="int", default=100, help="elements registered by each server client [default=%default]")
+	
+	(options, args) = parser.parse_args()
+	
+	if len(args) < 1 or args[0] not in _BENCHMARKS.keys():
+		parser.print_usage()
+		return 1
+	
+	if not _BENCHMARKS[args[0]](options, args[1:]):
+		return 1
+	
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
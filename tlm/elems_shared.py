@@ -30,6 +30,8 @@ class FixedWordParser(ByteParser):
 		self.fw_idx = fw_idx
 		if bits is not None and not isinstance(bits, list): bits = [bits]
 		self.bits = bits
+	def get_cache_key(self, val, *args, **kwds):
+		return (kwds['minor_frame_idx'] % 4, tuple(val))
 	def parse(self, val, *args, **kwds):
 		fw_idx = kwds['minor_frame_idx'] % 4
 		if fw_idx != self.fw_idx:
@@ -30,6 +30,8 @@ from elems_shared import *
 import fss_angle, spin_rate
 
 class PulseCountParser(Parser):
+	def get_cache_key(self, l, *args, **kwds):
+		return tuple(l)
 	def parse(self, l, *args, **kwds):
 		cnt = 0
 		val = 0
@@ -48,6 +50,8 @@ class ExternalFunctionParser(Parser):
 	def __init__(self, fn, *args, **kwds):
 		Parser.__init__(self, *args, **kwds)
 		self.fn = fn
+	def get_cache_key(self, val, *args, **kwds):	# Function only depends on its arguments
+		return tuple(val)
 	def parse(self, val, *args, **kwds):
 		try:
 			return (True, self.fn(*val))
@@ -64,11 +68,7 @@ class FSSAParser(Parser):
 		try:
 			engine = kwds['state'].engine
 			as2_tracker = engine.subcom_trackers[ANALOG_SUBCOM_2]
-			byte7 = None
-			if len(as2_tracker.subcom_frame) > 7:
-				byte7 = as2_tracker.subcom_frame[7]
-			elif len(as2_tracker.last_subcom_frame) > 7:
-				byte7 = as2_tracker.last_subcom_frame[7]
+			byte7 = as2_tracker.get_byte(7)	# Latest received (from the current subcom frame, or an earlier one)
 			if byte7 is None:
 				return (False, None)
 			val += [byte7]
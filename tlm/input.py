@@ -22,7 +22,11 @@
 #  
 #  
 
-import datetime, os
+import datetime, time, os, binascii, string, mmap, struct, zlib, re, collections
+import numpy
+
+from constants import *
+import utils
 
 class Buffer():
 	FLAG_NONE	= 0x00
@@ -30,15 +34,16 @@ class Buffer():
 	FLAG_LAST	= 0x02
 	FLAG_FIRST	= 0x04
 	FLAG_BAD	= 0x08
-	def __init__(self, buffer, flags=FLAG_NONE, time=None, original=None):
+	def __init__(self, buffer, flags=FLAG_NONE, time=None, original=None, local_time=None):	# 'local_time' saves looking up the time again for each of a batch
 		self.buffer = buffer
 		self.original = original
 		self.flags = flags
-		local_time_now = datetime.datetime.now()
+		if local_time is None:
+			local_time = datetime.datetime.now()
 		if time is None:
-			time = local_time_now
+			time = local_time
 		self.time = time
-		self.local_time = local_time_now
+		self.local_time = local_time
 	def get_buffer(self): return self.buffer
 	def get_time(self): return self.time
 	def get_flags(self): return self.flags
@@ -69,7 +74,221 @@ class Input():
 	def get_status_string(self):
 		return ""
 
+class Pacer():	# Holds replayed frames back until they're due by their receive times (scaled by 'speed')
+	def __init__(self, speed=0.0, frame_interval=0.0, max_gap=10.0):
+		self.speed = speed	# 1: real time, 10: ten times faster, 0: as fast as possible (not paced)
+		self.frame_interval = frame_interval	# Recorded seconds between frames without a receive time (0: they aren't paced)
+		self.max_gap = max_gap	# Longer recorded gaps (or time going backwards) restart the timeline instead of being waited out
+		self.reset()
+	def reset(self):	# e.g. after seeking
+		self.pending = collections.deque()	# (buffer, when it's due (None: now), recorded seconds since the last one)
+		self.start_time = None	# Wall clock time the timeline (re)started at
+		self.start_recorded = None	# Recorded time of the frame it started with
+		self.last_recorded = None	# Of the last frame added
+		self.last_due = None
+		self.first_time = None	# Of the first delivery
+		self.last_time = None	# Of the last delivery
+		self.frame_cnt = 0
+		self.recorded_elapsed = 0.0	# Recorded seconds delivered (skipped gaps excluded)
+		self.drift = 0.0	# How late the last frame was delivered
+		self.max_drift = 0.0
+		self.gap_cnt = 0
+	def is_enabled(self): return self.speed > 0
+	def has_pending(self): return len(self.pending) > 0
+	def add(self, buffers, times):	# 'times' are seconds since the epoch (None or NaN if unknown)
+		now = time.time()
+		for i in range(len(buffers)):
+			t = times[i]
+			if t is not None and t != t:
+				t = None
+			if t is None and self.frame_interval > 0:
+				t = 0.0
+				if self.last_recorded is not None:
+					t = self.last_recorded + self.frame_interval
+			
+			if t is None:
+				self.pending.append((buffers[i], None, 0.0))
+				continue
+			
+			elapsed = 0.0
+			if self.last_recorded is None or t < self.last_recorded or (t - self.last_recorded) > self.max_gap:
+				if self.last_recorded is not None:
+					self.gap_cnt += 1
+				self.start_time = now
+				if self.last_due is not None and self.last_due > now:
+					self.start_time = self.last_due
+				self.start_recorded = t
+			else:
+				elapsed = t - self.last_recorded
+			self.last_recorded = t
+			
+			self.last_due = self.start_time + ((t - self.start_recorded) / self.speed)
+			self.pending.append((buffers[i], self.last_due, elapsed))
+	def get_due(self):
+		now = time.time()
+		buffers = []
+		while len(self.pending) > 0:
+			(buffer, due, elapsed) = self.pending[0]
+			if due is not None:
+				if due > now:
+					break
+				self.drift = now - due
+				self.max_drift = max(self.max_drift, self.drift)
+			self.pending.popleft()
+			
+			if self.first_time is None:
+				self.first_time = now
+			else:
+				self.recorded_elapsed += elapsed
+			self.last_time = now
+			self.frame_cnt += 1
+			buffers += [buffer]
+		return buffers
+	def get_status_string(self):
+		if not self.is_enabled():
+			return ""
+		status = ", pace: x%g" % (self.speed)
+		if self.start_recorded is None:
+			return status + " (frames have no receive time)"
+		if self.first_time is not None and self.last_time > self.first_time:
+			duration = self.last_time - self.first_time
+			status += " (achieved x%.1f, %.1f frames/s)" % (self.recorded_elapsed / duration, (self.frame_cnt - 1) / duration)
+		status += ", drift: %+.1f ms (max %+.1f)" % (self.drift * 1e3, self.max_drift * 1e3)
+		if self.gap_cnt > 0:
+			status += ", gaps skipped: %d" % (self.gap_cnt)
+		return status
+
+class ReplayInput(Input):	# Reads recorded frames, optionally paced by their receive times
+	def __init__(self, *args, **kwds):
+		Input.__init__(self, *args, **kwds)
+		self.pacer = Pacer()
+	def set_pacing(self, speed, frame_interval=0.0):
+		self.pacer = Pacer(speed, frame_interval)
+	def _read(self):	# Enqueue the next frames: returns their receive times (None if unknown), or None at the end
+		return None
+	def get_data(self):
+		if not self.pacer.is_enabled():
+			if self._read() is None:
+				return None
+			return Input.get_data(self)	# Hand over (and clear) what has been enqueued
+		
+		if not self.pacer.has_pending():	# Don't read ahead while frames are being held back
+			times = self._read()
+			if times is None:
+				return None
+			self.pacer.add(Input.get_data(self), times)
+		
+		return self.pacer.get_due()	# Nothing yet is an empty list (the engine will sleep)
+
 class PKParser():
+	HEADER = "Frame"
+	BAD = "(bad)"
+	LINE_VALUES = 16
+	FRAME_LINES = 8
+	_HEX_DIGITS = string.hexdigits
+	_SEPARATORS = " " * (LINE_VALUES - 1)
+	_LINE_LENGTH = (LINE_VALUES * 3) - 1	# e.g. "0a 1b ... ff"
+	def __init__(self):
+		self.reset()
+	def reset(self):
+		self.buffers = []
+		self.frame_offsets = []	# (start, end) byte offsets (since reset) of each frame in 'buffers'
+		self.bytes_parsed = 0	# Up to the end of the last complete line
+		self.frame_offset = None
+		self.line = bytearray()	# Incomplete last line
+		self.original = []
+		self.hex_lines = []
+		self.frame_line_idx = None
+		self.in_frame = False
+		self.frame_number = None
+		self.frame_time = None
+		self.found_header = False
+		self.bad_line_cnt = 0
+		self.frame_cnt = 0
+		self.last_log = ""
+		self.frame_good = True
+	def _get_hex(self, line):	# Line of frame values -> 32 hex digits (None if it's bad)
+		if len(line) == PKParser._LINE_LENGTH and line[2::3] == PKParser._SEPARATORS and line.translate(None, PKParser._HEX_DIGITS) == PKParser._SEPARATORS:
+			return line.translate(None, " ")
+		
+		# Anything other than two digits per value (e.g. a single digit) goes the long way
+		parts = line.split(" ")
+		if len(parts) != PKParser.LINE_VALUES:
+			return None
+		try:
+			parts = map(lambda x: int(x, 16), parts)
+		except:
+			return None
+		for value in parts:
+			if value < 0 or value > 0xff:
+				return None
+		return "".join(map(lambda x: "%02x" % (x), parts))
+	def parse(self, data):
+		self.line.extend(str(data))
+		
+		end = self.line.rfind('\n')
+		if end == -1:
+			return len(self.buffers) > 0
+		lines = str(self.line[:end]).split('\n')
+		del self.line[:end+1]
+		
+		offset = self.bytes_parsed
+		self.bytes_parsed += end + 1
+		
+		for line in lines:
+			line_offset = offset
+			offset += len(line) + 1
+			line = line.strip()
+			
+			if not self.found_header:
+				if len(line) > len(PKParser.HEADER) and line.startswith(PKParser.HEADER):
+					self.found_header = True
+					self.last_log = line
+					# FIXME:
+					#self.frame_number
+					#self.frame_time
+					self.frame_good = (line.find(PKParser.BAD) == -1)
+					self.frame_line_idx = 0
+					self.hex_lines = []
+					self.original = [line]
+					self.frame_offset = line_offset
+				continue
+			
+			hex_line = self._get_hex(line)
+			if hex_line is None:
+				self.found_header = False
+				self.bad_line_cnt += 1
+				continue
+			
+			self.hex_lines += [hex_line]
+			self.original += [line]
+			
+			self.frame_line_idx += 1
+			
+			if self.frame_line_idx == PKParser.FRAME_LINES:
+				values = binascii.unhexlify("".join(self.hex_lines))
+				flags = Buffer.FLAG_NONE
+				if self.frame_cnt == 0:
+					flags |= Buffer.FLAG_FIRST
+				if not self.frame_good:
+					flags |= Buffer.FLAG_BAD
+				buffer = Buffer(values, flags=flags, time=self.frame_time, original="\n".join(self.original))
+				self.buffers += [buffer]
+				self.frame_offsets += [(self.frame_offset, offset)]
+				self.frame_cnt += 1
+				
+				self.found_header = False
+		
+		return len(self.buffers) > 0
+	def get_frame_offsets(self):	# Call before get_frames
+		return self.frame_offsets
+	def get_frames(self):
+		buffers = self.buffers
+		self.buffers = []
+		self.frame_offsets = []
+		return buffers
+
+class LinePKParser():	# Original line-at-a-time parser (kept as a reference for 'bench.py pk')
 	HEADER = "Frame"
 	BAD = "(bad)"
 	def __init__(self):
@@ -103,7 +322,7 @@ class PKParser():
 		for line in lines:
 			found_header = False
 			if not self.found_header:
-				if len(line) > len(PKParser.HEADER) and line.find(PKParser.HEADER) == 0:
+				if len(line) > len(LinePKParser.HEADER) and line.find(LinePKParser.HEADER) == 0:
 					self.found_header = found_header = True
 				else:
 					continue
@@ -113,7 +332,7 @@ class PKParser():
 				# FIXME:
 				#self.frame_number
 				#self.frame_time
-				self.frame_good = (line.find(PKParser.BAD) == -1)
+				self.frame_good = (line.find(LinePKParser.BAD) == -1)
 				self.frame_line_idx = 0
 				self.values = []
 				self.original = [line]
@@ -159,9 +378,9 @@ class PKParser():
 		self.buffers = []
 		return buffers
 
-class FileInput(Input):
+class FileInput(ReplayInput):
 	def __init__(self, buffer_size=4096, *args, **kwds):
-		Input.__init__(self, *args, **kwds)
+		ReplayInput.__init__(self, *args, **kwds)
 		self.buffer_size = buffer_size
 		self.f = None
 		self.file_size = 0
@@ -182,7 +401,7 @@ class FileInput(Input):
 			self.f.close()
 			self.f = None
 		Input.stop(self)
-	def get_data(self):
+	def _read(self):
 		while True:
 			data = self.f.read(self.buffer_size)
 			if len(data) == 0:
@@ -193,11 +412,242 @@ class FileInput(Input):
 			frames = self.parser.get_frames()
 			for f in frames:
 				self.enqueue_data(f)
-			return self.buffers
+			return [None] * len(frames)	# PK headers don't have a receive time
+	def get_status_string(self):
+		if not self.f:
+			return "No file open"
+		return "Reading from: '%s' (%d/%d)%s" % (self.file_path, self.bytes_read, self.file_size, self.pacer.get_status_string())
+
+INDEX_DTYPE = numpy.dtype([
+	('offset',			'<u8'),	# Of the header line in the log
+	('length',			'<u4'),	# Header line up to the end of the frame's last line
+	('header_length',	'<u2'),	# Header text is read from the log
+	('flags',			'u1'),	# Buffer.FLAG_BAD
+	('minor_frame_idx',	'u1'),
+	('time',			'<f8'),	# Receive time from the header (seconds since the epoch, NaN if it has none)
+])
+
+_INDEX_MAGIC	= "PKINDEX1"
+_INDEX_HEADER	= struct.Struct('<8sQQI')	# Magic, frame count, bytes of log indexed (resume from here), CRC of the start of the log
+_INDEX_CHECK_LENGTH	= 4096
+_HEADER_TIME	= re.compile(r"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})(\.\d+)?")
+
+def parse_header_time(header):	# Seconds since the epoch (local time) of the first timestamp in a header line (NaN if there isn't one)
+	match = _HEADER_TIME.search(header)
+	if not match:
+		return float('nan')
+	try:
+		t = time.mktime(time.strptime(match.group(1) + " " + match.group(2), "%Y-%m-%d %H:%M:%S"))
+	except ValueError:
+		return float('nan')
+	if match.group(3):
+		t += float(match.group(3))
+	return t
+
+class FrameIndex():	# Where each frame is in a PK log, cached in a sidecar file and extended as the log grows
+	def __init__(self, file_path, index_path=None, chunk_size=1024*1024, save_interval=64*1024*1024):
+		self.file_path = file_path
+		if index_path is None:
+			index_path = file_path + ".idx"
+		self.index_path = index_path
+		self.chunk_size = chunk_size
+		self.save_interval = save_interval
+		self._set_frames(numpy.zeros(0, dtype=INDEX_DTYPE))
+		self.saved_cnt = 0
+		self.indexed_bytes = 0
+		self.check = None
+	def __len__(self):
+		return len(self.frames)
+	def _set_frames(self, frames, count=None):	# 'frames' has room to grow: 'count' of them are used
+		if count is None:
+			count = len(frames)
+		self.capacity_frames = frames
+		self.frames = frames[:count]	# View of those used
+	def _get_check(self, data):
+		return zlib.crc32(data[:_INDEX_CHECK_LENGTH]) & 0xffffffff
+	def load(self, data):	# 'data' is the (mapped) log: returns False if there's no usable index for it
+		self._set_frames(numpy.zeros(0, dtype=INDEX_DTYPE))
+		self.saved_cnt = 0
+		self.indexed_bytes = 0
+		self.check = None
+		
+		if not os.path.exists(self.index_path):
+			return False
+		
+		f = open(self.index_path, 'rb')
+		try:
+			header = f.read(_INDEX_HEADER.size)
+			if len(header) != _INDEX_HEADER.size:
+				return False
+			(magic, frame_cnt, indexed_bytes, check) = _INDEX_HEADER.unpack(header)
+			if magic != _INDEX_MAGIC:
+				return False
+			if indexed_bytes > len(data) or check != self._get_check(data[:min(indexed_bytes, _INDEX_CHECK_LENGTH)]):
+				return False	# Not the log this index was built for
+			frames = numpy.fromfile(f, dtype=INDEX_DTYPE, count=frame_cnt)
+			if len(frames) != frame_cnt:
+				return False
+		finally:
+			f.close()
+		
+		self._set_frames(frames)
+		self.saved_cnt = frame_cnt
+		self.indexed_bytes = indexed_bytes
+		self.check = check
+		
+		return True
+	def save(self):
+		try:
+			if self.saved_cnt == 0:
+				f = open(self.index_path, 'wb')
+			else:
+				f = open(self.index_path, 'r+b')
+			try:
+				# New frames first, so an interrupted save leaves a header that only counts frames that were written
+				f.seek(_INDEX_HEADER.size + (self.saved_cnt * INDEX_DTYPE.itemsize))
+				self.frames[self.saved_cnt:].tofile(f)
+				f.seek(0)
+				f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, len(self.frames), self.indexed_bytes, self.check))
+			finally:
+				f.close()
+		except IOError:
+			return False	# e.g. read-only directory (the index is still used, just rebuilt next time)
+		self.saved_cnt = len(self.frames)
+		return True
+	def update(self, data):	# Index frames after what has been indexed so far: returns the number of new frames
+		# Resume from the end of the last complete frame (the parser is always in a clean state there)
+		parser = PKParser()
+		start = self.indexed_bytes
+		frame_cnt = 0
+		frames = []
+		last_save = start
+		offset = start
+		while offset < len(data):
+			parser.parse(data[offset:offset+self.chunk_size])
+			offset = min(offset + self.chunk_size, len(data))
+			
+			for (frame_offset, frame_end), buffer in zip(parser.get_frame_offsets(), parser.get_frames()):
+				header = buffer.get_original()[:buffer.get_original().find('\n')]
+				frames += [(start + frame_offset, frame_end - frame_offset, min(len(header), 0xffff), buffer.get_flags() & Buffer.FLAG_BAD, ord(buffer.get_buffer()[MINOR_FRAME_IDX_OFFSET]), parse_header_time(header))]
+				self.indexed_bytes = start + frame_end
+			
+			if (offset - last_save) >= self.save_interval and len(frames) > 0:
+				self._append(frames, data)
+				frame_cnt += len(frames)
+				frames = []
+				self.save()
+				last_save = offset
+		
+		if len(frames) > 0 or self.check is None:
+			self._append(frames, data)
+			frame_cnt += len(frames)
+			self.save()
+		
+		return frame_cnt
+	def _append(self, frames, data):
+		if len(frames) > 0:
+			count = len(self.frames)
+			if count + len(frames) > len(self.capacity_frames):	# Double the capacity, so a growing log isn't copied on every update
+				capacity_frames = numpy.zeros(max(count + len(frames), len(self.capacity_frames) * 2), dtype=INDEX_DTYPE)
+				capacity_frames[:count] = self.frames
+				self._set_frames(capacity_frames, count)
+			self.capacity_frames[count:count+len(frames)] = frames
+			self._set_frames(self.capacity_frames, count + len(frames))
+		self.check = self._get_check(data[:min(self.indexed_bytes, _INDEX_CHECK_LENGTH)])	# Only covers what's been indexed (the rest can still change)
+	def find_time(self, t):	# First frame received at or after 't' (seconds since the epoch)
+		times = self.frames['time']
+		timed = numpy.flatnonzero(times == times)	# Not NaN
+		if len(timed) == 0:
+			raise Exception("No frame times in the index of: %s" % (self.file_path))
+		idx = numpy.searchsorted(times[timed], t)
+		if idx == len(timed):
+			return len(self.frames)
+		return int(timed[idx])
+
+class IndexedFileInput(ReplayInput):	# Replays a memory-mapped PK log through a frame index, so it can start anywhere
+	def __init__(self, frames_per_read=32, follow=False, *args, **kwds):	# 'follow': keep waiting for frames appended to the log once replay catches up, instead of ending
+		ReplayInput.__init__(self, *args, **kwds)
+		self.frames_per_read = frames_per_read
+		self.follow = follow
+		self.f = None
+		self.mm = None
+		self.index = None
+		self.parser = PKParser()
+		self.reset()
+	def reset(self):
+		self.frame_idx = 0
+		self.file_path = None
+	def start(self, file_path, *args, **kwds):
+		Input.start(self, *args, **kwds)
+		self.reset()
+		self.f = open(file_path, 'rb')
+		self.file_path = file_path
+		self.index = FrameIndex(file_path)
+		self._map()
+		self.index.load(self._get_data())	# Otherwise it's built from scratch
+		self.index.update(self._get_data())
+		self.parser.reset()
+	def stop(self):
+		if self.mm:
+			self.mm.close()
+			self.mm = None
+		if self.f:
+			self.f.close()
+			self.f = None
+		Input.stop(self)
+	def _map(self):	# (Re)map the whole log (it might have grown)
+		if self.mm:
+			self.mm.close()
+			self.mm = None
+		if os.fstat(self.f.fileno()).st_size > 0:	# Can't map an empty file
+			self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+	def _get_data(self):
+		if self.mm is None:
+			return ""
+		return self.mm
+	def update_index(self):	# Pick up frames appended to the log since it was opened
+		size = os.fstat(self.f.fileno()).st_size
+		if self.mm is not None and size == len(self.mm):
+			return 0
+		self._map()
+		return self.index.update(self._get_data())
+	def get_frame_count(self):
+		return len(self.index)
+	def get_frame_info(self, frame_idx):	# (Header text, minor frame index, receive time or None)
+		frame = self.index.frames[frame_idx]
+		header = self.mm[int(frame['offset']):int(frame['offset'] + frame['header_length'])]
+		t = None
+		if frame['time'] == frame['time']:
+			t = datetime.datetime.fromtimestamp(frame['time'])
+		return (header, int(frame['minor_frame_idx']), t)
+	def seek_frame(self, frame_idx):
+		self.frame_idx = max(0, min(frame_idx, len(self.index)))
+		self.parser.reset()	# Next frame is flagged as the first, so the deframer resyncs
+		self.buffers = []
+		self.pacer.reset()
+	def seek_time(self, t):	# Local datetime
+		self.seek_frame(self.index.find_time(utils.to_epoch(t)))
+	def _read(self):
+		if self.frame_idx >= len(self.index):
+			self.update_index()
+			if self.frame_idx >= len(self.index):
+				if self.follow:	# The log may still grow
+					return []
+				return None
+		
+		frames = self.index.frames[self.frame_idx:self.frame_idx+self.frames_per_read]
+		start = int(frames[0]['offset'])
+		end = int(frames[-1]['offset'] + frames[-1]['length'])
+		self.parser.parse(self.mm[start:end])	# Starts at a header and ends after a complete frame, so the same frames come out
+		self.frame_idx += len(frames)
+		
+		for f in self.parser.get_frames():
+			self.enqueue_data(f)
+		return frames['time'].tolist()
 	def get_status_string(self):
 		if not self.f:
 			return "No file open"
-		return "Reading from: '%s' (%d/%d)" % (self.file_path, self.bytes_read, self.file_size)
+		return "Replaying: '%s' (frame %d/%d)%s" % (self.file_path, self.frame_idx, len(self.index), self.pacer.get_status_string())
 
 def main():
 	return 0
@@ -26,13 +26,15 @@
 
 from __future__ import with_statement
 
-import socket, threading, datetime, struct, random, time
+import socket, threading, datetime, struct, random, time, select, errno, os, collections
 
 from input import *
 
 _UDP_IP = "127.0.0.1"
 _PORT = 22222
 _BUFFER_SIZE = 1024
+_RING_SIZE = 1024	# UDP receive buffers (more are allocated if the engine falls behind)
+_MAX_BATCH = 256	# Datagrams received per wakeup before handing them over
 
 # BorIP flags (see http://wiki.spench.net/wiki/BorIP#Streaming_UDP_Protocol)
 BF_HARDWARE_OVERRUN	= 0x01
@@ -44,6 +46,24 @@ BF_STREAM_END		= 0x20
 BF_BUFFER_UNDERRUN	= 0x40
 BF_HARDWARE_TIMEOUT	= 0x80
 
+_BORIP_HEADER = struct.Struct("BBH")	# Flags, notification, sequence number
+
+def get_udp_drops(sock):	# Datagrams the kernel dropped for this socket (from /proc/net/udp, None if unavailable)
+	try:
+		inode = str(os.fstat(sock.fileno()).st_ino)
+		f = open("/proc/net/udp", 'r')
+	except (IOError, OSError, socket.error):
+		return None
+	try:
+		f.readline()	# Column headings
+		for line in f:
+			parts = line.split()
+			if len(parts) > 12 and parts[9] == inode:
+				return int(parts[12])
+	finally:
+		f.close()
+	return None
+
 class RateCalculator():
 	def __init__(self, averaging_period=5.0, minimum_averaging_factor=0.5):
 		self.averaging_period = averaging_period
@@ -173,63 +193,112 @@ class TCPNetworkThread(threading.Thread, RateCalculator):
 		self.disconnect()
 
 class UDPNetworkThread(threading.Thread, RateCalculator):
-	def __init__(self, network, borip, *args, **kwargs):
+	def __init__(self, network, borip, timeout=0.1, drop_check_interval=1.0, *args, **kwargs):
 		threading.Thread.__init__(self, name="Network", *args, **kwargs)
 		RateCalculator.__init__(self, *args, **kwargs)
 		self.network = network
 		self.borip = borip
+		self.timeout = timeout
+		self.drop_check_interval = drop_check_interval	# Seconds between reading the kernel's drop count
+		self.last_drop_check = None
+		self.kernel_drops = None	# Since the socket was opened
+		self.initial_kernel_drops = None
 		self.reset()
 	def reset(self):
 		self.last_seq = None
-		self.drop_count = 0
+		self.drop_count = 0	# Sequence gaps
+		self.missing_cnt = 0	# Datagrams missing in those gaps
 		RateCalculator.reset(self)
 	def log(self, msg):
 		self.network.log(msg)
 	def get_drop_count(self): return self.drop_count
+	def get_missing_count(self): return self.missing_cnt
+	def get_kernel_drop_count(self): return self.kernel_drops
+	def _check_kernel_drops(self, sock):
+		now = time.time()
+		if self.last_drop_check is not None and (now - self.last_drop_check) < self.drop_check_interval:
+			return
+		self.last_drop_check = now
+		drops = get_udp_drops(sock)
+		if drops is None:
+			return
+		if self.initial_kernel_drops is None:
+			self.initial_kernel_drops = drops
+		self.kernel_drops = drops - self.initial_kernel_drops
+	def _receive(self, sock):	# Drain what's waiting: returns [(ring buffer, length)]
+		received = []
+		while len(received) < _MAX_BATCH:
+			ring_buffer = self.network.get_ring_buffer()
+			try:
+				length = sock.recv_into(ring_buffer, self.network.buffer_size)
+			except socket.error, (e, msg):
+				self.network.free_ring_buffer(ring_buffer)
+				if e == errno.EAGAIN or e == errno.EWOULDBLOCK:
+					break
+				raise
+			received += [(ring_buffer, length)]
+		return received
 	def run(self):
 		#print "In NetworkThread"
 		while True:
 			try:
-				if self.network.sock is None:
+				sock = self.network.sock
+				if sock is None:
 					break
 				
-				data, addr = self.network.sock.recvfrom(self.network.buffer_size)
+				self._check_kernel_drops(sock)
 				
-				flags = Buffer.FLAG_NONE
+				(readable, writable, errored) = select.select([sock], [], [], self.timeout)
+				if len(readable) == 0:
+					self.calculate_statistics()
+					continue
 				
-				if self.borip:
-					borip_header_length = 4
-					if len(data) < borip_header_length:
-						# FIXME: Raise error
-						continue
-					flags, notification, seq = struct.unpack("BBH", data[:borip_header_length])
-					
-					if flags & BF_STREAM_START:
-						self.log("Stream start")
-						self.reset()
-					
-					#if random.random() < 0.01: seq = -1	# Simulate packet loss
+				received = self._receive(sock)
+				if len(received) == 0:
+					continue
+				
+				local_time_now = datetime.datetime.now()	# Once for the batch
+				buffers = []
+				ring_buffers = []
+				for ring_buffer, length in received:
+					data = memoryview(ring_buffer)[:length]	# Handed on without copying (the ring buffer is reused once the engine is done with it)
 					
-					if self.last_seq is not None:
-						if seq != ((self.last_seq + 1) % (1 << 16)):
-							flags |= Buffer.FLAG_DROP
-							self.drop_count += 1
-					self.last_seq = seq
+					flags = Buffer.FLAG_NONE
 					
-					if flags & BF_STREAM_END:
-						flags |= Buffer.FLAG_LAST
+					if self.borip:
+						if length < _BORIP_HEADER.size:
+							# FIXME: Raise error
+							self.network.free_ring_buffer(ring_buffer)
+							continue
+						flags, notification, seq = _BORIP_HEADER.unpack_from(ring_buffer)
+						
+						if flags & BF_STREAM_START:
+							self.log("Stream start")
+							self.reset()
+						
+						#if random.random() < 0.01: seq = -1	# Simulate packet loss
+						
+						if self.last_seq is not None:
+							expected_seq = (self.last_seq + 1) % (1 << 16)
+							if seq != expected_seq:
+								flags |= Buffer.FLAG_DROP
+								self.drop_count += 1
+								self.missing_cnt += (seq - expected_seq) % (1 << 16)
+						self.last_seq = seq
+						
+						if flags & BF_STREAM_END:
+							flags |= Buffer.FLAG_LAST
+						
+						data = data[_BORIP_HEADER.size:]
 					
-					data = data[borip_header_length:]
+					buffers += [Buffer(data, flags, time=local_time_now, local_time=local_time_now)]
+					ring_buffers += [ring_buffer]
 				
-				net_buffer = Buffer(data, flags)
+				self.stats_history += buffers
 				
-				self.stats_history += [net_buffer]
+				self.calculate_statistics(local_time_now)
 				
-				self.calculate_statistics(net_buffer.get_local_time())
-				
-				self.network.enqueue_data(net_buffer)
-			except socket.timeout:
-				self.calculate_statistics()
+				self.network.enqueue_batch(buffers, ring_buffers)
 			except Exception, e:
 				#print "Encountered exception in NetworkThread:", e
 				self.network.exception = e
@@ -307,11 +376,41 @@ class TCPNetwork(NetworkInput):
 		return status
 
 class UDPNetwork(NetworkInput):
-	def __init__(self, buffer_size=_BUFFER_SIZE, timeout=0.1, *args, **kwds):
+	def __init__(self, buffer_size=_BUFFER_SIZE, timeout=0.1, receive_buffer_size=0, ring_size=_RING_SIZE, *args, **kwds):
 		NetworkInput.__init__(self, *args, **kwds)
 		self.sock = None
 		self.buffer_size = buffer_size
 		self.timeout = timeout
+		self.receive_buffer_size = receive_buffer_size	# SO_RCVBUF (0: system default)
+		self.ring_size = ring_size
+		self.free_ring_buffers = collections.deque()	# Ready to receive into
+		self.pending_ring_buffers = []	# Holding buffers waiting for get_data
+		self.used_ring_buffers = []	# Holding buffers the engine has (until it next calls get_data)
+		self.ring_overflow_cnt = 0	# Extra ring buffers that had to be allocated
+	def get_ring_buffer(self):	# Network thread
+		try:
+			return self.free_ring_buffers.popleft()
+		except IndexError:
+			self.ring_overflow_cnt += 1
+			return bytearray(self.buffer_size)
+	def free_ring_buffer(self, ring_buffer):
+		self.free_ring_buffers.appendleft(ring_buffer)
+	def enqueue_batch(self, buffers, ring_buffers):
+		with self.lock:
+			self.buffers += buffers
+			self.pending_ring_buffers += ring_buffers
+			self.last_enqueue_time = datetime.datetime.now()
+	def get_data(self):
+		with self.lock:
+			self.free_ring_buffers.extend(self.used_ring_buffers)	# The engine is finished with the last lot
+			while len(self.free_ring_buffers) > self.ring_size:	# Let go of extras allocated during a backlog
+				self.free_ring_buffers.pop()
+			self.used_ring_buffers = self.pending_ring_buffers
+			self.pending_ring_buffers = []
+			buffers = self.buffers
+			self.buffers = []
+			self.last_get_time = datetime.datetime.now()
+			return buffers
 	def start(self, address=_UDP_IP, port=_PORT, *args, **kwds):
 		NetworkInput.start(self, *args, **kwds)
 		if address is None:
@@ -320,12 +419,16 @@ class UDPNetwork(NetworkInput):
 			raise Exception("Socket already exists")
 		try:
 			self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			if self.receive_buffer_size > 0:
+				self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
 			self.sock.bind((address, port))
-			if self.timeout > 0:
-				self.sock.settimeout(self.timeout)
+			self.sock.setblocking(0)	# The thread waits in select, then drains everything that's waiting
 		except Exception, e:
 			raise e
-		self.thread = UDPNetworkThread(self, borip=True)
+		self.free_ring_buffers = collections.deque([bytearray(self.buffer_size) for i in range(self.ring_size)])
+		self.pending_ring_buffers = []
+		self.used_ring_buffers = []
+		self.thread = UDPNetworkThread(self, borip=True, timeout=self.timeout)
 		self.thread.setDaemon(True)
 		self.thread.start()
 	def stop(self):
@@ -337,7 +440,11 @@ class UDPNetwork(NetworkInput):
 	def get_status_string(self):
 		if self.thread is None:
 			return ""
-		status = "Rate: %04d, drops: %04d" % (int(self.thread.get_ave_rate()), self.thread.get_drop_count())
+		status = "Rate: %04d, drops: %04d (%d missing)" % (int(self.thread.get_ave_rate()), self.thread.get_drop_count(), self.thread.get_missing_count())
+		if self.thread.get_kernel_drop_count() is not None:
+			status += ", kernel drops: %d" % (self.thread.get_kernel_drop_count())
+		if self.ring_overflow_cnt > 0:
+			status += ", ring overflows: %d" % (self.ring_overflow_cnt)
 		if len(self.last_thread_message) > 0:
 			status += ", " + self.last_thread_message
 		return status
@@ -24,13 +24,19 @@
 
 import math
 
-import utils, state
+import numpy
+
+import utils, state, res
 
 from constants import *
 
 class Parser():
 	def __init__(self, *args, **kwds): pass
 	def __call__(self, *args, **kwds): self.parse(*args, **kwds)
+	def get_shift(self):	# Only for parsers that do nothing more than shift each collected value in (lets values be combined ahead of time)
+		return None
+	def get_cache_key(self, l, *args, **kwds):	# Hashable key of everything 'parse' depends on, so parsing can be skipped when it hasn't changed (None to always parse)
+		return None
 	def parse(self, l, *args, **kwds):
 		raise Exception("Implement Parser")
 
@@ -38,6 +44,14 @@ class ShiftParser(Parser):
 	def __init__(self, shift, *args, **kwds):
 		Parser.__init__(self, *args, **kwds)
 		self.shift = shift
+	def get_shift(self):
+		if self.__class__.parse.im_func is not ShiftParser.parse.im_func:	# Sub-class does its own parsing
+			return None
+		return self.shift
+	def get_cache_key(self, l, *args, **kwds):
+		if self.get_shift() is None:	# Sub-class must supply its own key
+			return None
+		return tuple(l)
 	def parse(self, l, *args, **kwds):
 		val = 0L
 		for x in l:
@@ -148,9 +162,31 @@ class CurveFormatter(CustomFormatter, RangeInfo):
 		CustomFormatter.__init__(self, fmt, *args, **kwds)
 		RangeInfo.__init__(self, curve[0], curve[1], *args, **kwds)
 		self.curve = curve
+		self.lut = res.get_curve_lut(curve)
+	def convert(self, val):	# Returns (valid, engineering value), or arrays of both when given an array of raw values
+		if isinstance(val, numpy.ndarray):
+			if self.lut is not None and val.dtype.kind in 'iu':	# Raw byte values
+				idx = numpy.clip(val, 0, self.lut.size - 1).astype(numpy.intp)
+				valid = self.lut.valid_array.take(idx) & (val >= 0) & (val < self.lut.size)
+				return (valid, self.lut.value_array.take(idx))
+			valid = numpy.zeros(val.shape, dtype=numpy.bool_)	# Otherwise each value is converted on its own
+			values = numpy.zeros(val.shape, dtype=numpy.float64)
+			for i, v in enumerate(val.flat):
+				res, interp_val = self.convert(v.item())
+				valid.flat[i] = res
+				if res:
+					values.flat[i] = interp_val
+				else:
+					values.flat[i] = numpy.nan	# As for out-of-range raw values
+			return (valid, values)
+		if self.lut is not None and isinstance(val, (int, long)) and val >= 0 and val < self.lut.size:
+			if self.lut.valid[val]:
+				return (True, self.lut.values[val])
+			return (False, val)
+		return utils.interpolate(val, self.curve)	# Not a raw byte value
 	def format(self, val, *args, **kwds):
 		#if val is None: return "-"	# FIXME: When/where did this happen?
-		res, interp_val = utils.interpolate(val, self.curve)
+		res, interp_val = self.convert(val)
 		if not res:
 			return "<out-of-range: %s>" % (interp_val)
 		return CustomFormatter.format(self, interp_val)
@@ -159,6 +195,10 @@ class CurveFormatterValidator(CurveFormatter, RangeValidator):
 	def __init__(self, curve, *args, **kwds):
 		CurveFormatter.__init__(self, curve, *args, **kwds)
 		RangeValidator.__init__(self, curve[0], curve[1], *args, **kwds)
+	def validate(self, val, *args, **kwds):
+		if self.lut is not None and isinstance(val, (int, long)) and val >= 0 and val < self.lut.size:
+			return self.lut.valid[val]
+		return RangeValidator.validate(self, val, *args, **kwds)
 
 ########################################
 
@@ -170,6 +210,10 @@ class CustomOffset():
 		return issubclass(c.__class__, tuple(self.compatible_trackers))
 	def get_trigger_indices(self, *args, **kwds):
 		raise Exception("Implement CustomOffset get_trigger_offsets")
+	def get_collect_key(self, trigger, *args, **kwds):	# Offsets returning the same key for a trigger collect the same data (None to always collect separately)
+		return None
+	def get_extract_plan(self, trigger, *args, **kwds):	# ([byte indices in minor frame], [bit offsets] or None for whole bytes) if collect can be done for a whole frame at once
+		return None
 	def collect(self, *args, **kwds):
 		raise Exception("Implement CustomOffset collect")
 
@@ -266,6 +310,22 @@ class ByteOffsetPrototype(CustomOffset):
 			raise Exception("Cannot build trigger map with byte offset type: '%s'" % (type(self.byte_offsets)))
 	def get_trigger_indices(self, *args, **kwds):
 		return self.trigger_map.keys()
+	def get_collect_key(self, trigger, *args, **kwds):
+		res, map_res = trigger.check_map(self.trigger_map)
+		if not res:
+			return None
+		byte_offset, offset, byte_offset_pre_lut = map_res[0]
+		if byte_offset_pre_lut is not None:
+			return None
+		return (MINOR_FRAME_KEY, 'bytes', tuple(byte_offset))
+	def get_extract_plan(self, trigger, *args, **kwds):
+		res, map_res = trigger.check_map(self.trigger_map)
+		if not res:
+			return None
+		byte_offset, offset, byte_offset_pre_lut = map_res[0]
+		if byte_offset_pre_lut is not None:
+			return None
+		return (list(byte_offset), None)
 	def collect(self, byte, frame, minor_frame_idx, idx, trigger, *args, **kwds):	# FIXME: Data might be zero filled, use valid list
 		#if isinstance(self.byte_offsets, list):	# Extract index if it applies to all minor frames
 		#	trigger = state.Trigger(MINOR_FRAME_KEY, (trigger.indices[1],))
@@ -311,7 +371,7 @@ class ByteOffsetPrototype(CustomOffset):
 		# list, list of lists, or dict with single item (i.e. all in same frame)
 		l = []
 		for i in byte_offset:	# FIXME: If -ve, get from previous frames
-			l += [frame[i]]
+			l += [int(frame[i])]	# Frame might be a view of the FrameTracker's buffer
 		return l
 
 class ByteOffset(ByteOffsetPrototype, ByteParser):
@@ -323,6 +383,25 @@ class BitOffset(ByteOffsetPrototype, BitParser):
 	def __init__(self, offsets, lut=None, *args, **kwds):
 		ByteOffsetPrototype.__init__(self, offsets, byte_offsets=utils.bits_to_bytes(offsets), lut=lut, *args, **kwds)
 		BitParser.__init__(self, *args, **kwds)
+	def get_collect_key(self, trigger, *args, **kwds):
+		res, map_res = trigger.check_map(self.trigger_map)
+		if not res:
+			return None
+		byte_offset, offset, byte_offset_pre_lut = map_res[0]
+		if byte_offset_pre_lut is not None:
+			return None
+		return (MINOR_FRAME_KEY, 'bits', tuple(offset))
+	def get_extract_plan(self, trigger, *args, **kwds):
+		res, map_res = trigger.check_map(self.trigger_map)
+		if not res:
+			return None
+		byte_offset, offset, byte_offset_pre_lut = map_res[0]
+		if byte_offset_pre_lut is not None:
+			return None
+		for i, j in zip(byte_offset, offset):
+			if (j / 8) != i:
+				return None	# Let collect raise
+		return (list(byte_offset), list(offset))
 	def collect(self, byte, frame, minor_frame_idx, idx, trigger, *args, **kwds):	# FIXME: Data might be zero filled, use valid list
 		res = ByteOffsetPrototype.collect(self, byte, frame, minor_frame_idx, idx, trigger, *args, **kwds)
 		if not isinstance(res, list):
@@ -364,6 +443,10 @@ class ModeFilteredByteOffset(CustomOffset, ByteParser):
 		return mode
 	def get_trigger_indices(self, *args, **kwds):
 		return self.offsets[self._get_mode(*args, **kwds)].get_trigger_indices(*args, **kwds)
+	def get_collect_key(self, *args, **kwds):
+		return self.offsets[self._get_mode(*args, **kwds)].get_collect_key(*args, **kwds)
+	def get_extract_plan(self, *args, **kwds):
+		return self.offsets[self._get_mode(*args, **kwds)].get_extract_plan(*args, **kwds)
 	def collect(self, *args, **kwds):
 		return self.offsets[self._get_mode(*args, **kwds)].collect(*args, **kwds)
 
@@ -394,6 +477,11 @@ class SubcomByteOffsetPrototype(CustomOffset):
 		return c.can_handle_subcom(self.subcom_key)
 	def get_trigger_indices(self, *args, **kwds):
 		return self.trigger_map.keys()
+	def get_collect_key(self, trigger, *args, **kwds):
+		if trigger not in self.trigger_map:
+			return None
+		byte_offset, offset = self.trigger_map[trigger]
+		return (self.subcom_key, 'bytes', tuple(byte_offset))
 	def collect(self, byte, frame, idx, trigger, *args, **kwds):	# FIXME: Data might be zero filled, use valid list
 		if trigger not in self.trigger_map.keys():	# FIXME: Use trigger.check_map (will still work for now)
 			raise Exception("Trigger %s not in trigger map: %s" % (trigger, self.trigger_map))
@@ -401,7 +489,7 @@ class SubcomByteOffsetPrototype(CustomOffset):
 		byte_offset, offset = self.trigger_map[trigger]
 		l = []
 		for i in byte_offset:
-			l += [frame[i]]
+			l += [int(frame[i])]	# Frame is a view of the SubcomTracker's ring
 		return l
 
 class SubcomByteOffset(SubcomByteOffsetPrototype, ByteParser):
@@ -413,6 +501,11 @@ class SubcomBitOffset(SubcomByteOffsetPrototype, BitParser):
 	def __init__(self, subcom_key, offsets, *args, **kwds):
 		SubcomByteOffsetPrototype.__init__(self, subcom_key, offsets, utils.bits_to_bytes(offsets))
 		BitParser.__init__(self, *args, **kwds)
+	def get_collect_key(self, trigger, *args, **kwds):
+		if trigger not in self.trigger_map:
+			return None
+		byte_offset, offset = self.trigger_map[trigger]
+		return (self.subcom_key, 'bits', tuple(offset))
 	def collect(self, byte, frame, idx, trigger, *args, **kwds):	# FIXME: Data might be zero filled, use valid list
 		res = SubcomByteOffsetPrototype.collect(self, byte, frame, idx, trigger, *args, **kwds)
 		if not isinstance(res, list):
@@ -475,6 +568,7 @@ class Element():
 		# Flags
 		self._flags = flags
 	def id(self): return self._id
+	def category(self): return self._category
 	def positions(self): return self._positions
 	def parser(self): return self._parser
 	def validator(self): return self._validator
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  protocol.py
+#  
+#  Copyright 2014 Balint Seeber <balint256@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+# Binary wire protocol for server clients (negotiated with the 'protocol' action, requests stay as JSON lines)
+# Each record: <uint32 body length> <uint8 record type> <body> (little-endian)
+
+import struct, datetime
+import numpy
+
+import utils
+
+PROTOCOL_JSON	= 'json'
+PROTOCOL_BINARY	= 'binary'
+PROTOCOLS		= [PROTOCOL_JSON, PROTOCOL_BINARY]
+
+RECORD_JSON		= 0	# Body is a JSON message (e.g. action responses)
+RECORD_UPDATE	= 1	# Body is a packed element update
+RECORD_FRAME	= 2	# Body is a raw minor frame or subcom frame (from the 'stream' action)
+
+FRAME_FLAG_SYNC	= 0x01	# Deframer (re)acquired sync at this frame
+FRAME_FLAG_DROP	= 0x02	# Data was lost before this frame
+FRAME_FLAG_GAPS	= 0x04	# Subcom frame has bytes that weren't received (they are zero)
+
+VALUE_NONE		= 0
+VALUE_INT		= 1
+VALUE_FLOAT		= 2
+VALUE_STR		= 3
+VALUE_TRUE		= 4
+VALUE_FALSE		= 5
+
+_HEADER			= struct.Struct('<IB')
+_UPDATE			= struct.Struct('<HdIdb')	# Element index, time, update count, update time, valid (-1: unknown)
+_FRAME			= struct.Struct('<hBd')	# Minor frame index (-1: unknown), flags, time
+_INT			= struct.Struct('<q')
+_FLOAT			= struct.Struct('<d')
+_LENGTH			= struct.Struct('<H')
+
+_INT_MIN		= -(1 << 63)
+_INT_MAX		= (1 << 63) - 1
+
+def to_epoch(t):	# Local datetime -> seconds (NaN for None)
+	if t is None:
+		return float('nan')
+	return utils.to_epoch(t)
+
+def from_epoch(t):
+	if t != t:	# NaN
+		return None
+	return datetime.datetime.fromtimestamp(t)
+
+def pack_record(record_type, body):
+	return _HEADER.pack(len(body), record_type) + body
+
+def unpack_records(data):	# Returns list of (record type, body) and what's left of 'data' (an incomplete record)
+	records = []
+	offset = 0
+	while (len(data) - offset) >= _HEADER.size:
+		length, record_type = _HEADER.unpack_from(data, offset)
+		end = offset + _HEADER.size + length
+		if end > len(data):
+			break
+		records += [(record_type, data[offset + _HEADER.size:end])]
+		offset = end
+	return (records, data[offset:])
+
+def pack_str(s):
+	if isinstance(s, unicode):
+		s = s.encode('utf-8')
+	elif not isinstance(s, str):
+		s = str(s)
+	s = s[:0xffff]
+	return _LENGTH.pack(len(s)) + s
+
+def unpack_str(data, offset):
+	length, = _LENGTH.unpack_from(data, offset)
+	offset += _LENGTH.size
+	return (data[offset:offset + length], offset + length)
+
+def pack_value(v):
+	if v is None:
+		return chr(VALUE_NONE)
+	if isinstance(v, bool):
+		if v:
+			return chr(VALUE_TRUE)
+		return chr(VALUE_FALSE)
+	if isinstance(v, (int, long)) and v >= _INT_MIN and v <= _INT_MAX:
+		return chr(VALUE_INT) + _INT.pack(v)
+	if isinstance(v, float):
+		return chr(VALUE_FLOAT) + _FLOAT.pack(v)
+	if isinstance(v, basestring):
+		return chr(VALUE_STR) + pack_str(v)
+	try:
+		return chr(VALUE_FLOAT) + _FLOAT.pack(float(v))	# e.g. numpy scalars
+	except:
+		pass
+	return chr(VALUE_STR) + pack_str(v)	# Anything else (e.g. exceptions from parsers) as text
+
+def unpack_value(data, offset):
+	value_type = ord(data[offset])
+	offset += 1
+	if value_type == VALUE_NONE:
+		return (None, offset)
+	if value_type == VALUE_TRUE:
+		return (True, offset)
+	if value_type == VALUE_FALSE:
+		return (False, offset)
+	if value_type == VALUE_INT:
+		return (_INT.unpack_from(data, offset)[0], offset + _INT.size)
+	if value_type == VALUE_FLOAT:
+		return (_FLOAT.unpack_from(data, offset)[0], offset + _FLOAT.size)
+	if value_type == VALUE_STR:
+		return unpack_str(data, offset)
+	raise Exception("Unknown value type: %d" % (value_type))
+
+def pack_update(element_idx, state):	# 'state' has the same keys as a JSON update
+	valid = -1
+	if state['valid'] is not None:
+		valid = int(state['valid'])
+	body = _UPDATE.pack(element_idx, to_epoch(state['time']), state['update_count'], to_epoch(state['update_time']), valid)
+	body += pack_value(state['value']) + pack_str(state['value_formatted']) + pack_str(state['trigger'])
+	if 'previous_value' in state:
+		body += chr(1) + pack_value(state['previous_value']) + pack_str(state['previous_value_formatted']) + _FLOAT.pack(to_epoch(state['previous_value_time']))
+	else:
+		body += chr(0)
+	return pack_record(RECORD_UPDATE, body)
+
+def unpack_update(body):	# Returns (element index, state): 'trigger' is its string form and there's no 'id' (look it up with the index from registration)
+	element_idx, t, update_count, update_time, valid = _UPDATE.unpack_from(body, 0)
+	state = {}
+	state['time']			= from_epoch(t)
+	state['update_count']	= update_count
+	state['update_time']	= from_epoch(update_time)
+	state['valid']			= None
+	if valid >= 0:
+		state['valid']		= (valid == 1)
+	offset = _UPDATE.size
+	state['value'], offset				= unpack_value(body, offset)
+	state['value_formatted'], offset	= unpack_str(body, offset)
+	state['trigger'], offset			= unpack_str(body, offset)
+	has_previous = ord(body[offset])
+	offset += 1
+	if has_previous:
+		state['previous_value'], offset				= unpack_value(body, offset)
+		state['previous_value_formatted'], offset	= unpack_str(body, offset)
+		state['previous_value_time']				= from_epoch(_FLOAT.unpack_from(body, offset)[0])
+	return (element_idx, state)
+
+def pack_frame(stream, minor_frame_idx, flags, t, data):	# 'stream' is the tracker key (e.g. 'MIF', 'DS'), 'data' the frame's bytes (or anything NumPy can turn into them)
+	if minor_frame_idx is None:
+		minor_frame_idx = -1
+	if not isinstance(data, str):
+		data = numpy.asarray(data, dtype=numpy.uint8).tostring()
+	return pack_record(RECORD_FRAME, _FRAME.pack(minor_frame_idx, flags, to_epoch(t)) + pack_str(stream) + data)
+
+def unpack_frame(body):	# Returns (stream, minor frame index, flags, time, data)
+	minor_frame_idx, flags, t = _FRAME.unpack_from(body, 0)
+	if minor_frame_idx < 0:
+		minor_frame_idx = None
+	stream, offset = unpack_str(body, _FRAME.size)
+	return (stream, minor_frame_idx, flags, from_epoch(t), body[offset:])
+
+def main():
+	return 0
+
+if __name__ == '__main__':
+	main()
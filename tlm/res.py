@@ -24,9 +24,33 @@
 
 import os, sys
 
+import numpy
+
+import utils
+
 # Curve values: [valid input points, output points]
 CURVES = {}
 
+# Lookup tables of each raw byte value, keyed by curve content (shared by all elements using the same curve)
+CURVE_LUTS = {}
+
+class CurveLUT():
+	def __init__(self, curve, size=256):
+		self.size = size
+		self.values = []	# Engineering value for each raw value (None if out of range)
+		self.valid = []
+		self.value_array = numpy.zeros(size, dtype=numpy.float64)	# NaN if out of range
+		for i in range(size):
+			res, val = utils.interpolate(i, curve)
+			self.valid += [res]
+			if res:
+				self.values += [val]
+				self.value_array[i] = val
+			else:
+				self.values += [None]
+				self.value_array[i] = numpy.nan
+		self.valid_array = numpy.array(self.valid, dtype=numpy.bool_)
+
 def get_curve(k, safe=True, safe_ranges=[0,255]):
 	if k not in CURVES.keys():
 		if safe:
@@ -35,6 +59,15 @@ def get_curve(k, safe=True, safe_ranges=[0,255]):
 		else: raise Exception("Curve %d is not registered")
 	return CURVES[k]
 
+def get_curve_lut(curve):	# Returns None if the curve can't be tabulated (formatting will then interpolate and raise as usual)
+	key = (tuple(curve[0]), tuple(curve[1]))
+	if key not in CURVE_LUTS:
+		try:
+			CURVE_LUTS[key] = CurveLUT(curve)
+		except Exception, e:
+			CURVE_LUTS[key] = None
+	return CURVE_LUTS[key]
+
 def load_curves(load_path=".", verbose=False):
 	global CURVES
 	abs_load_path = os.path.abspath(load_path)
@@ -61,6 +94,7 @@ def load_curves(load_path=".", verbose=False):
 					print "'%s' already in curve map (ignoring)" % (k)
 					continue
 				CURVES[k] = curves[k]
+				get_curve_lut(CURVES[k])
 	
 	if verbose: print "Loaded %d curves" % (len(CURVES))
 
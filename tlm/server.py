@@ -24,27 +24,134 @@
 
 from __future__ import with_statement
 
-import sys, threading, traceback, socket, SocketServer, time, traceback, jsonpickle, datetime
+import sys, threading, traceback, socket, SocketServer, time, traceback, jsonpickle, datetime, select, errno, collections
 
-import utils, primitives
+import utils, primitives, protocol
+
+from constants import *
 
 _LISTEN_ADDR = "0.0.0.0"
 _LISTEN_PORT = 21012
 
+OVERFLOW_DROP_OLDEST	= 'drop-oldest'
+OVERFLOW_COALESCE		= 'coalesce'	# Replace a queued update for the same element with the latest one
+OVERFLOW_DISCONNECT		= 'disconnect'
+OVERFLOW_POLICIES		= [OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE, OVERFLOW_DISCONNECT]
+
+MAX_FLUSH_INTERVAL	= 10.0	# Seconds (longer batch intervals requested by clients are clamped)
+MAX_BATCH_RECORDS	= 1000	# A batch is flushed early once it holds this many updates...
+MAX_BATCH_BYTES		= 256*1024	# ...or this many bytes (so each queued batch is bounded, and queue length and overflow policy still apply)
+
 class DatetimeHandler(jsonpickle.handlers.BaseHandler):
 	def flatten(self, obj, data):
 		return obj.isoformat()
 jsonpickle.handlers.registry.register(datetime.datetime, DatetimeHandler)
 
+class Subscription():	# Per-client options for an element, applied before an update is encoded (updates held back by 'max_rate' are sent once the interval is up, see 'take_held')
+	def __init__(self, options):
+		self.options = options
+		self.min_interval = None	# Seconds (from 'max_rate' in Hz)
+		if 'max_rate' in options and options['max_rate'] is not None:
+			max_rate = float(options['max_rate'])
+			if max_rate <= 0:
+				raise Exception("Invalid max_rate: %s" % (options['max_rate']))
+			self.min_interval = 1.0 / max_rate
+		self.every = None	# Send every Nth update
+		if 'every' in options and options['every'] is not None:
+			self.every = int(options['every'])
+			if self.every < 1:
+				raise Exception("Invalid every: %s" % (options['every']))
+		self.deadband = None	# Numeric change needed (implies 'on_change')
+		if 'deadband' in options and options['deadband'] is not None:
+			self.deadband = float(options['deadband'])
+			if self.deadband < 0:
+				raise Exception("Invalid deadband: %s" % (options['deadband']))
+		self.on_change = (self.deadband is not None)
+		if 'on_change' in options and options['on_change']:
+			self.on_change = True
+		self.update_cnt = 0
+		self.sent_cnt = 0
+		self.last_sent_time = None
+		self.last_sent_value = None
+		self.last_sent_valid = None
+		self.held = None	# Element state whose latest update was held back by 'max_rate'
+	def accept(self, element_state, now):	# Returns True if this update should be sent
+		self.update_cnt += 1
+		
+		if self.every is not None and ((self.update_cnt - 1) % self.every) != 0:
+			return False
+		
+		value = element_state.last_value
+		if self.on_change and self.sent_cnt > 0 and element_state.last_valid == self.last_sent_valid:
+			if self.deadband is not None:
+				try:
+					if abs(value - self.last_sent_value) <= self.deadband:
+						self.held = None	# Back to what was sent
+						return False
+				except TypeError:	# Not numeric
+					if value == self.last_sent_value:
+						self.held = None
+						return False
+			elif value == self.last_sent_value:
+				self.held = None
+				return False
+		
+		if self.min_interval is not None and self.last_sent_time is not None and (now - self.last_sent_time) < self.min_interval:
+			self.held = element_state	# Sent when the interval is up, unless a later update gets there first
+			return False
+		
+		self._sent(element_state, now)
+		return True
+	def take_held(self, now):	# Returns the element state to send if a held back update is now due
+		if self.held is None or (now - self.last_sent_time) < self.min_interval:
+			return None
+		element_state = self.held
+		self._sent(element_state, now)
+		return element_state
+	def _sent(self, element_state, now):
+		self.held = None
+		self.sent_cnt += 1
+		self.last_sent_time = now
+		self.last_sent_value = element_state.last_value
+		self.last_sent_valid = element_state.last_valid
+
+class FrameStream():	# Listens for a tracker's completed frames (minor or subcom) on behalf of clients streaming them
+	def __init__(self, server, key, tracker):
+		self.server = server
+		self.key = key
+		self.tracker = tracker
+		self.client_addresses = set()
+		self.frame_cnt = 0
+	def __call__(self, event, source, frame, minor_frame_idx=None, sync=False, drop=False, valid=True, *args, **kwds):
+		if len(self.client_addresses) == 0:	# Waiting to be removed by the engine thread
+			return
+		self.server._post_frame(self, frame, minor_frame_idx, sync, drop, valid)
+
 class ThreadedTCPRequestHandler(SocketServer.StreamRequestHandler): # BaseRequestHandler
 	# No __init__
 	def setup(self):
 		SocketServer.StreamRequestHandler.setup(self)
 		#print "==> Connection from:", self.client_address#, "in thread", threading.currentThread().getName()
 		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+		self.registration_map = {}	# Trigger -> element states registered on it (each once)
+		self.element_states = collections.OrderedDict()	# Element state -> its trigger indices (everything registered, in order)
+		self.send_queue = collections.deque()	# [key, message] entries waiting for the writer thread
+		self.queued_updates = {}	# Key -> latest entry for it in the queue (for coalescing)
+		self.send_buffer = ""	# Being sent by the writer thread
+		self.queue_lock = threading.Lock()
+		self.closed = False
+		self.max_queue_depth = 0
+		self.drop_cnt = 0
+		self.batch_interval = None	# Seconds between batched updates (None: each update is sent on its own, 0: once per engine iteration)
+		self.batch = []	# Encoded updates waiting for the next batch
+		self.batch_bytes = 0
+		self.batch_time = None
+		self.protocol = protocol.PROTOCOL_JSON	# For messages to the client (requests are always JSON)
+		self.subscriptions = {}	# Element ID -> Subscription (for elements registered with options)
+		self.held_subscriptions = {}	# Element ID -> Subscription holding back an update (see Subscription.take_held)
+		self.streams = set()	# Keys of frame streams
 		with self.server.client_lock:
-			self.server.clients.append(self)
-		self.registration_map = {}
+			self.server.clients[self.client_address] = self
 	def handle(self):
 		buffer = ""
 		while True:
@@ -76,30 +183,132 @@ class ThreadedTCPRequestHandler(SocketServer.StreamRequestHandler): # BaseReques
 			    buffer = ""
 	def finish(self):
 		#print "==> Disconnection from:", self.client_address
+		with self.queue_lock:
+			self.closed = True
+			self.send_queue.clear()
+			self.queued_updates = {}
+		self.batch = []
+		self.batch_bytes = 0
+		
 		self.server.server.untrack(self)
 		
 		with self.server.client_lock:
-			self.server.clients.remove(self)
+			del self.server.clients[self.client_address]
 		try:
 			SocketServer.StreamRequestHandler.finish(self)
 		except socket.error, (e, msg):
 			#if (e != 32): # Broken pipe
 			#	print "==>", self.client_address, "-", msg
 			pass
-	def post(self, msg, new_line=True):
+	def post(self, msg, new_line=True, key=None, binary=False):	# Never blocks: the message is queued for the writer thread ('key' identifies the element an update is for, 'binary' if already packed)
 		try:
-			if not isinstance(msg, str):
-				msg = jsonpickle.encode(msg, unpicklable=False)
-			if new_line:
-				msg += '\n'
-			self.wfile.write(msg)
+			if not binary:
+				if not isinstance(msg, str):
+					msg = jsonpickle.encode(msg, unpicklable=False)
+				if self.protocol == protocol.PROTOCOL_BINARY:
+					msg = protocol.pack_record(protocol.RECORD_JSON, msg)
+				elif new_line:
+					msg += '\n'
 		except Exception, e:
 			#print "Could not post to %s: %s\n%s" % (str(self.client_address), e, str(msg))
+			return
+		
+		with self.queue_lock:
+			if self.closed:
+				return
+			
+			if len(self.send_queue) >= self.server.queue_length:
+				self.drop_cnt += 1
+				policy = self.server.overflow_policy
+				if policy == OVERFLOW_DISCONNECT:
+					self._close()
+					return
+				if policy == OVERFLOW_COALESCE and key is not None and key in self.queued_updates:
+					self.queued_updates[key][1] = msg
+					return
+				self._forget(self.send_queue.popleft())
+			
+			entry = [key, msg]
+			self.send_queue.append(entry)
+			if key is not None:
+				self.queued_updates[key] = entry
+			
+			self.max_queue_depth = max(self.max_queue_depth, len(self.send_queue))
+		
+		self.server.write_event.set()
+	def _forget(self, entry):	# Assumes queue lock is taken
+		key = entry[0]
+		if key is not None and key in self.queued_updates and self.queued_updates[key] is entry:
+			del self.queued_updates[key]
+	def _close(self):	# Handler thread will see the connection close and clean up
+		self.closed = True
+		try:
+			self.request.shutdown(socket.SHUT_RDWR)
+		except socket.error:
 			pass
+	def has_pending(self):
+		return not self.closed and (len(self.send_buffer) > 0 or len(self.send_queue) > 0)
+	def send_pending(self, max_length=65536):	# Called by the writer thread once the socket is writable
+		with self.queue_lock:
+			while len(self.send_queue) > 0 and len(self.send_buffer) < max_length:
+				entry = self.send_queue.popleft()
+				self._forget(entry)
+				self.send_buffer += entry[1]
+		
+		if len(self.send_buffer) == 0:
+			return
+		
+		try:
+			sent = self.request.send(self.send_buffer, socket.MSG_DONTWAIT)
+		except socket.error, (e, msg):
+			if e in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]:
+				return
+			#print "Could not send to %s: %s" % (str(self.client_address), msg)
+			with self.queue_lock:
+				self._close()
+			return
+		
+		self.send_buffer = self.send_buffer[sent:]
+	def get_queue_stats(self):	# (current depth, max depth, dropped)
+		return (len(self.send_queue), self.max_queue_depth, self.drop_cnt)
+	def set_batch_interval(self, interval):
+		self.flush_batch()
+		if interval is not None:
+			interval = max(0.0, min(interval, MAX_FLUSH_INTERVAL))
+		self.batch_interval = interval
+	def add_to_batch(self, encoded_update):
+		self.batch += [encoded_update]
+		self.batch_bytes += len(encoded_update)
+		if len(self.batch) >= MAX_BATCH_RECORDS or self.batch_bytes >= MAX_BATCH_BYTES:
+			self.flush_batch()
+	def flush_batch(self, now=None):	# Posts pending updates as one message
+		if now is None:
+			now = time.time()
+		if len(self.batch) > 0:
+			if self.protocol == protocol.PROTOCOL_BINARY:
+				self.post("".join(self.batch), binary=True)	# Records are sent together
+			else:
+				self.post('{"action": "batch", "result": [%s], "error": null}' % (", ".join(self.batch)))	# Updates are already encoded
+			self.batch = []
+			self.batch_bytes = 0
+		self.batch_time = now
 
 class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 	pass
 
+class WaitTimedLock():	# Takes a lock, recording how long the caller had to wait whenever another thread held it
+	def __init__(self, lock, record_fn):
+		self.lock = lock
+		self.record_fn = record_fn	# Called with the seconds waited
+	def __enter__(self):
+		if self.lock.acquire(False):	# Uncontended (nothing to record)
+			return
+		start = time.time()
+		self.lock.acquire()
+		self.record_fn(time.time() - start)
+	def __exit__(self, *args):
+		self.lock.release()
+
 class Server():
 	def __init__(self, engine, element_manager, element_state_manager, log):
 		self.engine = engine
@@ -110,13 +319,34 @@ class Server():
 		self.server = None
 		self.server_thread = None
 		self.update_lock = threading.Lock()
+		self.engine_update_lock = WaitTimedLock(self.update_lock, self._add_lock_wait)	# Same lock, as taken by the engine thread
 		self.pending_updates = []
-		self.registration_map = {}
-	def start(self, address=_LISTEN_ADDR, port=_LISTEN_PORT, buffer_size=1024, sleep=1.0):
+		self.registration_map = {}	# Trigger -> set of client addresses
+		self.element_refs = {}	# Element state -> number of clients registered for it
+		self.frame_streams = {}	# Tracker key -> FrameStream
+		self.element_indices = {}	# Element ID -> index used in binary updates (assigned at registration, kept for the life of the server)
+		self.filter_cnt = 0	# Element updates not sent due to subscription options
+		self.encode_cnt = 0	# Element updates encoded
+		self.write_cnt = 0	# Element updates written to clients
+		self.rate_time = None
+		self.rate_counts = (0, 0)
+		self.rates = (0.0, 0.0)	# (encodes/s, writes/s)
+		self.writer_thread = None
+		self.write_event = threading.Event()
+		self.writing = False
+		self.control_thread = None
+		self.request_event = threading.Event()
+		self.controlling = False
+		self.snapshot_responses = collections.deque()	# (client, response, arrival time) filled in by the engine thread
+		self.stats_lock = threading.Lock()
+		self.stats = {'request':(0, 0.0, 0.0), 'lock wait':(0, 0.0, 0.0), 'tracking':(0, 0.0, 0.0)}	# Name -> (count, total, max)
+	def start(self, address=_LISTEN_ADDR, port=_LISTEN_PORT, buffer_size=1024, sleep=1.0, queue_length=1000, overflow_policy=OVERFLOW_DROP_OLDEST):
 		if self.server:
 			raise Exception("Server already started")
 		if self.server_thread:
 			raise Exception("Server thread already exists")
+		if overflow_policy not in OVERFLOW_POLICIES:
+			raise Exception("Unknown overflow policy: %s" % (overflow_policy))
 		
 		listen_address = (address, port)
 		
@@ -128,9 +358,12 @@ class Server():
 				
 				self.server.server = self
 				self.server.client_lock = threading.Lock()
-				self.server.clients = []
+				self.server.clients = collections.OrderedDict()	# Address -> handler
 				self.server.update_event = threading.Event()
 				self.server.buffer_size = buffer_size
+				self.server.queue_length = queue_length
+				self.server.overflow_policy = overflow_policy
+				self.server.write_event = self.write_event
 				self.server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 				
 				self.server_thread = threading.Thread(target=self.server.serve_forever)
@@ -148,6 +381,49 @@ class Server():
 			break
 		
 		print "Server listening on:",  self.server.server_address
+		
+		self.writing = True
+		self.writer_thread = threading.Thread(target=self._write_loop)
+		self.writer_thread.setDaemon(True)
+		self.writer_thread.start()
+		
+		self.controlling = True
+		self.control_thread = threading.Thread(target=self._control_loop)
+		self.control_thread.setDaemon(True)
+		self.control_thread.start()
+	def _write_loop(self, timeout=0.1):	# Sends queued messages to all clients, so the engine thread never blocks on a socket
+		while self.writing:
+			self.write_event.wait(timeout)
+			self.write_event.clear()
+			
+			while self.writing:
+				server = self.server
+				if server is None:
+					break
+				with server.client_lock:
+					clients = [c for c in server.clients.values() if c.has_pending()]
+				if len(clients) == 0:
+					break
+				
+				try:
+					(readable, writable, exceptional) = select.select([], [c.request for c in clients], [], timeout)
+				except (select.error, socket.error), e:	# A socket was closed in the meantime
+					continue
+				
+				for client in clients:
+					if client.request in writable:
+						client.send_pending()
+	def get_queue_stats(self):	# (total queued, max depth of any client, total dropped)
+		if self.server is None:
+			return (0, 0, 0)
+		total_depth, max_depth, drop_cnt = 0, 0, 0
+		with self.server.client_lock:
+			for client in self.server.clients.values():
+				depth, client_max_depth, client_drop_cnt = client.get_queue_stats()
+				total_depth += depth
+				max_depth = max(max_depth, client_max_depth)
+				drop_cnt += client_drop_cnt
+		return (total_depth, max_depth, drop_cnt)
 	def untrack(self, client_connection):
 		if self.server is None:
 			return
@@ -156,171 +432,481 @@ class Server():
 				# Remove all pending updates for this client
 				self.pending_updates = filter(lambda x: x[0] != client_connection.client_address, self.pending_updates)
 				
-				# Remove this client for the server's trigger registration map
-				triggers_to_remove = []
-				triggers_removed = []
-				for trigger_index in self.registration_map.keys():
-					if client_connection.client_address in self.registration_map[trigger_index]:
-						self.registration_map[trigger_index].remove(client_connection.client_address)
-						triggers_removed += [trigger_index]
-						if len(self.registration_map[trigger_index]) == 0:
-							triggers_to_remove += [trigger_index]
+				changes = []
 				
-				for trigger_index in triggers_to_remove:
-					del self.registration_map[trigger_index]
+				for key in client_connection.streams:
+					self.frame_streams[key].client_addresses.discard(client_connection.client_address)
+				client_connection.streams = set()
+				self._remove_unused_frame_streams(changes)
 				
-				element_states = self._get_client_element_states(client_connection)
+				had_elements = (len(client_connection.element_states) > 0)
 				
-				#self.log("%s: Untrack: %s" % (client_connection.client_address, ", ".join([x.get_element().id() for x in element_states])))
-				#self.log("%s: Empty server trigger indices: %s (total: %s)" % (client_connection.client_address, len(triggers_to_remove), len(self.registration_map.keys())))
+				untracked_elements = []
+				old_triggers = []
+				for element_state in client_connection.element_states.keys():
+					if self._remove_client_element(client_connection, element_state, old_triggers, changes):
+						untracked_elements += [element_state]
+				if len(old_triggers) > 0:
+					changes += [(self._untrack_triggers, (old_triggers,))]
 				
-				untracked_elements = self._untrack(element_states, client_connection)
+				if len(changes) > 0:
+					self.engine.post_command(self._apply_changes, changes, time.time())
 				
-				if len(triggers_removed) > 0:
-					self.log("%s: Untracked: %s" % (client_connection.client_address, ", ".join([x.get_element().id() for x in untracked_elements])))
-	def _get_client_element_states(self, client_connection):	# Assumes locks are taken
-		element_states = []
-		
-		# Compile a unique list of all the elements that this connection had registered
-		for trigger_index in client_connection.registration_map.keys():
-			_element_states = client_connection.registration_map[trigger_index]
-			for element_state in _element_states:
-				if element_state not in element_states:
-					element_states += [element_state]
-		
-		return element_states
-	def _untrack(self, element_states, client_connection):	# Assumes locks are taken
-		# Remove from that list those elements that are still registered by other clients
-		if self.server is not None:	# If server is shutdown while clients are still connected
-			for client in self.server.clients:
-				if client == client_connection:
-					continue
+				if not had_elements:
+					return
 				
-				other_element_states = self._get_client_element_states(client)
-				for element_state in other_element_states:
-					if element_state in element_states:
-						element_states.remove(element_state)
+				self.log("%s: Untracked: %s" % (client_connection.client_address, ", ".join([x.get_element().id() for x in untracked_elements])))
+	def _add_client_element(self, client, element_state, trigger_indices, new_triggers, changes):	# Assumes locks are taken ('trigger_indices' are looked up beforehand). Returns False if already registered. Appends triggers to start tracking, and changes for the engine thread.
+		if element_state in client.element_states:
+			return False
 		
-		#self.log("%s: Untrack: %s" % (client_connection.client_address, ", ".join([x.get_element().id() for x in element_states])))
+		changes += [(self.element_state_manager.acquire, (element_state.get_element(),))]	# Each client counts as one consumer of an element
 		
-		# Untrack the remaining elements (that were only registered by this client)
-		for element_state in element_states:
-			self.engine.untrack(element_state.get_element().positions().get_trigger_indices(mode=self.engine.options.mode), self)
+		client.element_states[element_state] = trigger_indices
 		
-		return element_states
-	def run(self):
-		with self.update_lock:
-			for update in self.pending_updates:
-				client_address, msg = update
+		if element_state not in self.element_refs:
+			self.element_refs[element_state] = 0
+		self.element_refs[element_state] += 1
+		
+		for trigger_index in trigger_indices:
+			if trigger_index not in client.registration_map:
+				client.registration_map[trigger_index] = []
 				
-				client = self.get_client(client_address)	 # Lock released below
-				if not client:
-					raise Exception("Client went missing: %s" % (str(client_address)))
+				if trigger_index not in self.registration_map:	# First client for this trigger
+					self.registration_map[trigger_index] = set()
+					new_triggers += [trigger_index]
+				self.registration_map[trigger_index].add(client.client_address)
+			client.registration_map[trigger_index] += [element_state]	# Few per trigger (and never repeated, see 'element_states')
+		
+		return True
+	def _remove_client_element(self, client, element_state, old_triggers, changes):	# Assumes locks are taken. Returns True if no other client has it registered. Appends triggers to stop tracking, and changes for the engine thread.
+		trigger_indices = client.element_states.pop(element_state)
+		
+		for trigger_index in trigger_indices:
+			client_element_states = client.registration_map[trigger_index]
+			if element_state not in client_element_states:
+				continue
+			client_element_states.remove(element_state)
+			if len(client_element_states) > 0:
+				continue
+			
+			# Client no longer has anything on this trigger
+			del client.registration_map[trigger_index]
+			
+			client_addresses = self.registration_map[trigger_index]
+			client_addresses.discard(client.client_address)
+			if len(client_addresses) == 0:	# Nor does anyone else
+				del self.registration_map[trigger_index]
+				old_triggers += [trigger_index]
+		
+		changes += [(self.element_state_manager.release, (element_state.get_element(),))]
+		
+		self.element_refs[element_state] -= 1
+		if self.element_refs[element_state] > 0:
+			return False
+		del self.element_refs[element_state]
+		return True
+	def _group_triggers(self, triggers):	# Engine tracks one tracker's triggers per call (and recompiles once for them all)
+		groups = collections.OrderedDict()
+		for trigger in triggers:
+			if trigger.name not in groups:
+				groups[trigger.name] = []
+			groups[trigger.name] += [trigger]
+		return groups.values()
+	def _track_triggers(self, triggers):
+		for trigger_indices in self._group_triggers(triggers):
+			self.engine.track(trigger_indices, self)
+	def _untrack_triggers(self, triggers):
+		for trigger_indices in self._group_triggers(triggers):
+			self.engine.untrack(trigger_indices, self)
+	def get_subscriber_count(self, element_state):
+		if element_state not in self.element_refs:
+			return 0
+		return self.element_refs[element_state]
+	def get_rates(self):	# (encodes/s, writes/s) for element updates
+		return self.rates
+	def get_client_count(self):
+		if self.server is None:
+			return 0
+		return len(self.server.clients)
+	def _update_rates(self, interval=1.0):
+		now = time.time()
+		if self.rate_time is None:
+			self.rate_time = now
+			return
+		elapsed = now - self.rate_time
+		if elapsed < interval:
+			return
+		last_encode_cnt, last_write_cnt = self.rate_counts
+		self.rates = ((self.encode_cnt - last_encode_cnt) / elapsed, (self.write_cnt - last_write_cnt) / elapsed)
+		self.rate_counts = (self.encode_cnt, self.write_cnt)
+		self.rate_time = now
+	def run(self):	# Engine thread (requests are handled by the control thread)
+		self._update_rates()
+		
+		with self.engine_update_lock:
+			self._send_held_updates()
+			self._flush_batches()
+	def _control_loop(self, timeout=0.1):	# Handles requests as soon as they arrive, leaving tracking changes for the engine thread to apply between frames
+		while self.controlling:
+			self.request_event.wait(timeout)
+			self.request_event.clear()
+			
+			try:
+				self._handle_requests()
 				
-				successful_elements, failed_elements = [], []
+				self._post_snapshots()
+			except Exception, e:
+				print "While Server was handling requests:", e
+	def _handle_requests(self):
+		with self.update_lock:
+			requests = self.pending_updates
+			self.pending_updates = []
+		
+		for client_address, msg, arrival_time in requests:
+			changes = []	# (function, args) for the engine thread to apply in one go (see Engine.post_command)
+			snapshot = None	# [(element state, query)] for the engine thread to read ('get' and 'history')
+			
+			client = self.get_client(client_address, keep_lock=False)	# Registrations are only changed by this thread, so can be read before taking the locks (closing is checked again below)
+			if not client or client.closed:	# Disconnected in the meantime
+				continue
+			
+			successful_elements, failed_elements = [], []
+			new_protocol = None
+			
+			response = {'action':None, 'result':(successful_elements,failed_elements), 'error':None, 'seq':None}
+			
+			# Specs are resolved, and triggers looked up, before taking the update lock (only needed to change registrations)
+			action = None
+			registrations = []	# [(element state, subscription or None, element options, trigger indices, element info)]
+			unregistrations = []	# [element state]
+			
+			try:
+				action				= msg['action'].lower()
+				data				= msg['data']
 				
-				response = {'action':None, 'result':(successful_elements,failed_elements), 'error':None, 'seq':None}
+				response['action']	= action
+				response['seq']		= msg['seq']
 				
-				try:
-					action				= msg['action'].lower()
-					data				= msg['data']
+				if action == "register":
+					for element_id, element_options in self._resolve_element_specs(data, failed_elements):	# Options, e.g. {'id':..., 'max_rate':4} (see Subscription)
+						element_state = self.element_state_manager.get_element_state(element_id, safe=False)
+						if element_state is None:
+							failed_elements += [element_id]
+							continue
+						
+						subscription = None
+						if element_options is not None:
+							try:
+								subscription = Subscription(element_options)
+							except Exception, e:
+								failed_elements += [element_id]
+								response['error'] = "%s: %s" % (element_id, e)
+								continue
+						
+						element = element_state.get_element()
+						trigger_indices = element.positions().get_trigger_indices(mode=self.engine.options.mode)
+						
+						element_info = {'id':element.id()}
+						
+						element_info['unit'] = element.unit()
+						
+						if subscription is not None:
+							element_info['options'] = element_options
+						
+						range_info = utils.find_subclass(primitives.RangeInfo, [element.validator(), element.formatter()])
+						if range_info:
+							element_info['range_raw'] = (min(range_info.rng), max(range_info.rng))
+							element_info['range_out'] = (min(range_info.points), max(range_info.points))
+						
+						registrations += [(element_state, subscription, element_options, trigger_indices, element_info)]
+				elif action == "get":	# Current state of elements (all of them if none are given), without registering or tracking anything
+					if data is None or len(data) == 0:
+						data = sorted(self.element_manager.get_element_ids())
 					
-					response['action']	= action
-					response['seq']		= msg['seq']
+					snapshot = []	# Read by the engine thread between frames, so all states are from the same point
+					for element_id, element_options in self._resolve_element_specs(data, failed_elements):
+						element_state = self.element_state_manager.get_element_state(element_id, safe=False)
+						if element_state is None:
+							failed_elements += [element_id]
+							continue
+						
+						snapshot += [(element_state, None)]
+				elif action == "history":	# Recorded samples of elements, e.g. to backfill a plot (nothing is registered)
+					query_defaults = {}	# 'count' (last N samples), 'start'/'end' (seconds since the epoch)
+					if 'options' in msg and msg['options'] is not None:
+						query_defaults = msg['options']
 					
+					snapshot = []
+					for element_id, element_options in self._resolve_element_specs(data, failed_elements):
+						query = dict(query_defaults)
+						if element_options is not None:	# Per-element query, e.g. {'id':..., 'count':100}
+							query.update(element_options)
+						
+						element_state = self.element_state_manager.get_element_state(element_id, safe=False)
+						if element_state is None or element_state.history is None:
+							failed_elements += [element_id]
+							continue
+						
+						snapshot += [(element_state, query)]
+				elif action == "unregister":
+					self.log("%s: Unregistering: %s" % (client_address, ", ".join(map(str, data))))
+					
+					for element_id, element_options in self._resolve_element_specs(data, failed_elements, client):
+						element_state = self.element_state_manager.get_element_state(element_id, safe=False)
+						if element_state is None:
+							failed_elements += [element_id]
+							continue
+						unregistrations += [element_state]
+				elif action not in ["stream", "unstream", "protocol"]:
+					response['error'] = "Action unrecognised: '%s'" % (msg['action'])
+					self.log("%s: Invalid action: %s" % (client_address, msg['action']))
+			except Exception, e:
+				print "While Server was handling message:", e
+				response['error'] = str(e)
+				action = None	# Nothing is changed
+			
+			untracked_elements = []
+			
+			with self.update_lock:	# Held as briefly as possible, as element updates from the engine thread wait on it
+				client = self.get_client(client_address)	 # Lock released below
+				if not client:
+					continue
+				if client.closed:
+					self.server.client_lock.release()
+					continue
+				
+				try:
 					if action == "register":
-						for element_id in data:
-							element_state = self.element_state_manager.get_element_state(element_id, safe=False)
-							if element_state is None:
-								failed_elements += [element_id]
-								continue
-							
-							trigger_indices = element_state.get_element().positions().get_trigger_indices(mode=self.engine.options.mode)
-							self.engine.track(trigger_indices, self)
-							
-							for trigger_index in trigger_indices:
-								if trigger_index not in self.registration_map.keys():
-									self.registration_map[trigger_index] = []
-								self.registration_map[trigger_index] += [client_address]
-								
-								if trigger_index not in client.registration_map.keys():
-									client.registration_map[trigger_index] = []
-								client.registration_map[trigger_index] += [element_state]
-							
-							element_info = {'id':element_id}
+						if 'options' in msg and msg['options'] is not None:	# Per-client options (batching is opt-in)
+							options = msg['options']
+							if 'batch' in options and options['batch']:
+								interval = 0.0
+								if 'flush_interval' in options:
+									interval = float(options['flush_interval'])
+								client.set_batch_interval(interval)
+							elif 'batch' in options:
+								client.set_batch_interval(None)
+						
+						new_triggers = []
+						for element_state, subscription, element_options, trigger_indices, element_info in registrations:
+							element_id = element_info['id']
+							if subscription is not None:
+								client.subscriptions[element_id] = subscription
+							elif element_id in client.subscriptions:
+								del client.subscriptions[element_id]
 							
-							element_info['unit'] = element_state.get_element().unit()
+							self._add_client_element(client, element_state, trigger_indices, new_triggers, changes)
 							
-							range_info = utils.find_subclass(primitives.RangeInfo, [element_state.get_element().validator(), element_state.get_element().formatter()])
-							if range_info:
-								element_info['range_raw'] = (min(range_info.rng), max(range_info.rng))
-								element_info['range_out'] = (min(range_info.points), max(range_info.points))
+							if client.protocol == protocol.PROTOCOL_BINARY:
+								element_info['index'] = self._get_element_index(element_id)
 							
 							successful_elements += [element_info]
-							
-							self.log("%s: Registered: %s" % (client_address, ", ".join([x['id'] for x in successful_elements])))
-					elif action == "unregister":
-						self.log("%s: Unregistering: %s" % (client_address, ", ".join(map(str, data))))
 						
-						registered_element_states = self._get_client_element_states(client)
-						element_states = []
+						if len(new_triggers) > 0:
+							changes += [(self._track_triggers, (new_triggers,))]
+					elif action == "stream":	# Raw frames from trackers (e.g. 'MIF', 'DS'), as binary records
+						if data is None or len(data) == 0:
+							data = sorted(self.engine.trackers.keys())
 						
-						# Filter out bad elements, or those that aren't registered for this client
-						for element_id in data:
-							element_state = self.element_state_manager.get_element_state(element_id, safe=False)
-							if element_state is None or element_state not in registered_element_states:
-								failed_elements += [element_id]
+						for key in data:
+							if client.protocol != protocol.PROTOCOL_BINARY:
+								failed_elements += [key]
+								response['error'] = "Frame streams need the binary protocol"
+								continue
+							if key not in self.engine.trackers:
+								failed_elements += [key]
 								continue
 							
-							if element_id in successful_elements:
+							if key not in self.frame_streams:
+								frame_stream = FrameStream(self, key, self.engine.trackers[key])
+								changes += [(frame_stream.tracker.register, (EVENT_NEW_FRAME, frame_stream))]
+								self.frame_streams[key] = frame_stream
+							self.frame_streams[key].client_addresses.add(client_address)
+							client.streams.add(key)
+							
+							successful_elements += [key]
+					elif action == "unstream":
+						if data is None or len(data) == 0:
+							data = sorted(client.streams)
+						
+						for key in data:
+							if key not in client.streams:
+								failed_elements += [key]
 								continue
 							
-							successful_elements += [element_id]
-							element_states += [element_state]
+							self.frame_streams[key].client_addresses.discard(client_address)
+							client.streams.remove(key)
+							
+							successful_elements += [key]
 						
-						# Remove the elements from the client's map. If the trigger's list is then empty, remove it too, and then remove the client from the server's map.
-						triggers_to_remove = []
-						for element_state in element_states:
-							for trigger_index in client.registration_map.keys():
-								client_registration_list = client.registration_map[trigger_index]
-								if element_state in client_registration_list:
-									client_registration_list.remove(element_state)
-								if len(client_registration_list) == 0:
-									del client.registration_map[trigger_index]
-									triggers_to_remove += [trigger_index]
+						self._remove_unused_frame_streams(changes)
+					elif action == "protocol":	# Switches messages to the client after this response
+						if data not in protocol.PROTOCOLS:
+							failed_elements += [data]
+							response['error'] = "Protocol unrecognised: '%s'" % (data)
+						else:
+							successful_elements += [data]
+							new_protocol = data
+					elif action == "unregister":
+						old_triggers = []
 						
-						# If the client no longer tracks a trigger index, remove the client from the server's map. If the server's list for that trigger index is empty, remove it too.
-						for trigger_index in triggers_to_remove:
-							if trigger_index not in self.registration_map.keys():
-								raise Exception("Client %s trigger index %s not in server map %s" % (client_address, trigger_index, self.registration_map.keys()))
+						# Filter out those that aren't registered for this client
+						for element_state in unregistrations:
+							element_id = element_state.get_element().id()
+							if element_state not in client.element_states:
+								if element_id not in successful_elements:	# Not a repeat of one just removed
+									failed_elements += [element_id]
+								continue
 							
-							client_address_list = self.registration_map[trigger_index]
-							if client_address not in client_address_list:
-								raise Exception("Client %s not in server's trigger index %s list %s" % (client_address, trigger_index, client_address_list))
+							successful_elements += [element_id]
 							
-							client_address_list.remove(client_address)
+							if element_id in client.subscriptions:
+								del client.subscriptions[element_id]
 							
-							if len(client_address_list) == 0:
-								del self.registration_map[trigger_index]
-						
-						untracked_elements = self._untrack(element_states, client)
+							# Removes the client from the server's map for triggers it no longer needs (and untracks those nobody needs)
+							if self._remove_client_element(client, element_state, old_triggers, changes):
+								untracked_elements += [element_state]
 						
-						self.log("%s: Unregistered: %s" % (client_address, ", ".join([x.get_element().id() for x in untracked_elements])))
-					else:
-						response['error'] = "Action unrecognised: '%s'" % (msg['action'])
-						self.log("%s: Invalid action: %s" % (client_address, msg['action']))
+						if len(old_triggers) > 0:
+							changes += [(self._untrack_triggers, (old_triggers,))]
 				except Exception, e:
 					print "While Server was handling message:", e
 					response['error'] = str(e)
-					raise
 				
-				client.post(response)
+				if new_protocol is not None:	# Under the lock, so no update is encoded for the wrong protocol
+					client.flush_batch()	# Batched updates were encoded for the old protocol
+					client.post(response)
+					client.protocol = new_protocol
+				elif snapshot is not None:	# Engine thread fills in the response
+					self.engine.post_command(self._take_snapshot, client, response, snapshot, arrival_time)
+				else:
+					client.post(response)
+				
+				if len(changes) > 0:	# Under the lock, so the engine applies them in the order they were made (e.g. before those of a disconnect), and after the response, so it reaches the client before any updates these cause
+					self.engine.post_command(self._apply_changes, changes, arrival_time)
 				
 				self.server.client_lock.release()
 			
-			self.pending_updates = []
+			if snapshot is None and new_protocol is None:
+				self._add_stat('request', time.time() - arrival_time)
+			
+			if action == "register":
+				self.log("%s: Registered: %s" % (client_address, ", ".join([x['id'] for x in successful_elements])))
+			elif action == "unregister":
+				self.log("%s: Unregistered: %s" % (client_address, ", ".join([x.get_element().id() for x in untracked_elements])))
+			elif new_protocol is not None:
+				self.log("%s: Protocol: %s" % (client_address, new_protocol))
+	def _apply_changes(self, changes, arrival_time):	# Engine thread, between frames
+		for fn, args in changes:
+			try:
+				fn(*args)
+			except Exception, e:	# The rest still need applying (e.g. untracking triggers after a failed release)
+				self.log("While applying change %s: %s" % (fn, e))
+		self._add_stat('tracking', time.time() - arrival_time)
+	def _take_snapshot(self, client, response, snapshot, arrival_time):	# Engine thread, between frames
+		successful_elements, failed_elements = response['result']
+		for element_state, query in snapshot:
+			element_id = element_state.get_element().id()
+			try:
+				if query is None:
+					state, error = self._get_update_state(element_state)
+					if error is not None:
+						raise Exception(error)
+					successful_elements += [state]
+				else:
+					successful_elements += [self._get_history(element_state, query)]
+			except Exception, e:
+				failed_elements += [element_id]
+				response['error'] = "%s: %s" % (element_id, e)
+		self.snapshot_responses.append((client, response, arrival_time))	# Encoded and sent by the control thread
+		self.request_event.set()
+	def _post_snapshots(self):
+		while len(self.snapshot_responses) > 0:
+			client, response, arrival_time = self.snapshot_responses.popleft()
+			client.post(response)
+			self._add_stat('request', time.time() - arrival_time)
+	def _add_lock_wait(self, duration):
+		self._add_stat('lock wait', duration)
+	def _add_stat(self, name, duration):	# Times (seconds) of 'request' (arrival to response), 'lock wait' (engine thread waiting for the update lock held by another thread), 'tracking' (arrival to changes applied by the engine)
+		with self.stats_lock:
+			cnt, total, maximum = self.stats[name]
+			self.stats[name] = (cnt + 1, total + duration, max(maximum, duration))
+	def get_request_stats(self, name):	# (count, average, max) in seconds
+		with self.stats_lock:
+			cnt, total, maximum = self.stats[name]
+		if cnt == 0:
+			return (0, 0.0, 0.0)
+		return (cnt, total / cnt, maximum)
+	def _send_held_updates(self):	# Assumes update lock is taken
+		if self.server is None:
+			return
+		now = time.time()
+		encoded = {}
+		with self.server.client_lock:
+			for client in self.server.clients.values():
+				if len(client.held_subscriptions) == 0:
+					continue
+				for element_id, subscription in client.held_subscriptions.items():
+					if element_id not in client.subscriptions or client.subscriptions[element_id] is not subscription:	# Unregistered (or registered again) since
+						del client.held_subscriptions[element_id]
+						continue
+					element_state = subscription.take_held(now)
+					if subscription.held is None:
+						del client.held_subscriptions[element_id]
+					if element_state is not None:
+						self._send_update(client, element_state, encoded)
+	def _send_update(self, client, element_state, encoded):	# Assumes update lock is taken. 'encoded' caches messages for the other clients it goes to.
+		element_id = element_state.get_element().id()
+		key = (client.protocol, element_id)
+		if key not in encoded:
+			encoded[key] = self._encode_update(element_state, client.protocol)
+		
+		if client.batch_interval is None:
+			client.post(encoded[key], key=element_id, binary=(client.protocol == protocol.PROTOCOL_BINARY))
+		else:
+			client.add_to_batch(encoded[key])	# Sent by 'run' once the interval has passed (or it's full)
+		self.write_cnt += 1
+	def _flush_batches(self):	# Assumes update lock is taken
+		if self.server is None:
+			return
+		now = time.time()
+		with self.server.client_lock:
+			for client in self.server.clients.values():
+				if client.batch_interval is None or len(client.batch) == 0:
+					continue
+				if (now - client.batch_time) >= client.batch_interval:
+					client.flush_batch(now)
+	def _remove_unused_frame_streams(self, changes):	# Assumes update lock is taken. Listener is removed by the engine thread, which is the one dispatching frames.
+		for key in self.frame_streams.keys():
+			frame_stream = self.frame_streams[key]
+			if len(frame_stream.client_addresses) > 0:
+				continue
+			changes += [(frame_stream.tracker.unregister, (EVENT_NEW_FRAME, frame_stream))]
+			del self.frame_streams[key]
+	def _post_frame(self, frame_stream, frame, minor_frame_idx, sync, drop, valid):	# Packed once, however many clients it goes to
+		flags = 0
+		if sync:
+			flags |= protocol.FRAME_FLAG_SYNC
+		if drop:
+			flags |= protocol.FRAME_FLAG_DROP
+		if not valid:
+			flags |= protocol.FRAME_FLAG_GAPS
+		
+		with self.engine_update_lock:
+			if self.server is None:
+				return
+			
+			msg = protocol.pack_frame(frame_stream.key, minor_frame_idx, flags, self.engine.get_local_time_now(), frame)
+			
+			with self.server.client_lock:
+				for client_address in frame_stream.client_addresses:
+					if client_address in self.server.clients:
+						self.server.clients[client_address].post(msg, binary=True)
+			
+			frame_stream.frame_cnt += 1
 	def __call__(self, *args, **kwds):
-		with self.update_lock:
+		with self.engine_update_lock:
 			trigger = kwds['trigger']
 			
 			res, map_res = trigger.check_map(self.registration_map)
@@ -334,6 +920,9 @@ class Server():
 			
 			triggered_client_addresses = map_res
 			
+			encoded = {}	# (protocol, element ID) -> message: each update is encoded once, however many clients it goes to
+			now = time.time()
+			
 			for client_address in triggered_client_addresses:
 				client = self.get_client(client_address)
 				if not client:
@@ -348,50 +937,157 @@ class Server():
 					if element_state.last_value is None:
 						continue
 					
-					element = element_state.get_element()
-					
-					state = {}
-					response = {'result':state, 'error':None}
-					
-					try:
-						state['id']				= element_state.get_element().id()
-						state['time']			= self.engine.get_local_time_now()
-						state['update_count']	= element_state.update_count
-						state['value']			= element_state.last_value
-						state['value_formatted']= element.formatter().format(element_state.last_value)
-						state['valid']			= element_state.last_valid
-						state['update_time']	= element_state.last_update_time
-						state['trigger']		= element_state.last_trigger
-						if element_state.previous_value is not None:
-							state['previous_value']				= element_state.previous_value
-							state['previous_value_formatted']	= element.formatter().format(element_state.previous_value)
-							state['previous_value_time']		= element_state.previous_value_time
-					except Exception, e:
-						response['error'] = str(e)
+					element_id = element_state.get_element().id()
+					if element_id in client.subscriptions:
+						subscription = client.subscriptions[element_id]
+						if not subscription.accept(element_state, now):
+							self.filter_cnt += 1
+							if subscription.held is not None:
+								client.held_subscriptions[element_id] = subscription
+							continue
 					
-					client.post(response)
+					self._send_update(client, element_state, encoded)
 				
 				self.server.client_lock.release()
+	def _resolve_element_specs(self, data, failed_elements, client=None):	# Returns [(element ID, options dict or None)] with patterns expanded (see ElementManager.find_elements). With a client, patterns only match what it has registered.
+		element_specs = []
+		for element_spec in data:
+			element_id = element_spec
+			element_options = None
+			if isinstance(element_spec, dict):
+				element_id = element_spec['id']
+				element_options = element_spec
+			
+			if not self.element_manager.is_pattern(element_id):
+				element_specs += [(element_id, element_options)]
+				continue
+			
+			try:
+				element_ids = self.element_manager.find_elements(element_id)
+			except Exception, e:	# e.g. bad regular expression
+				self.log("Invalid element pattern '%s': %s" % (element_id, e))
+				element_ids = []
+			
+			if client is not None:
+				registered_element_ids = []
+				for matched_element_id in element_ids:
+					if self.element_state_manager.get_element_state(matched_element_id, safe=False) in client.element_states:
+						registered_element_ids += [matched_element_id]
+				element_ids = registered_element_ids
+			
+			if len(element_ids) == 0:
+				failed_elements += [element_id]
+				continue
+			
+			for matched_element_id in element_ids:
+				element_specs += [(matched_element_id, element_options)]
+		
+		return element_specs
+	def _get_history(self, element_state, query):
+		count, start_time, end_time = None, None, None
+		if 'count' in query and query['count'] is not None:
+			count = int(query['count'])
+		if 'start' in query and query['start'] is not None:
+			start_time = float(query['start'])
+		if 'end' in query and query['end'] is not None:
+			end_time = float(query['end'])
+		
+		now = None
+		local_time_now = self.engine.get_local_time_now()
+		if local_time_now is not None:	# Ages are relative to the engine's clock (which the samples were timed with)
+			now = utils.to_epoch(local_time_now)
+		
+		samples = element_state.history.get_samples(count, start_time, end_time, now)
+		
+		values = []
+		for value in samples['value'].tolist():
+			if value != value:	# NaN (not numeric)
+				value = None
+			values += [value]
+		
+		valids = []
+		for valid in samples['valid'].tolist():
+			if valid < 0:
+				valid = None
+			else:
+				valid = (valid == 1)
+			valids += [valid]
+		
+		history = {'id':element_state.get_element().id()}
+		history['time']		= samples['time'].tolist()	# Seconds since the epoch
+		history['value']	= values
+		history['valid']	= valids
+		history['memory']	= element_state.get_history_memory_usage()
+		return history
+	def _get_element_index(self, element_id):
+		if element_id not in self.element_indices:
+			self.element_indices[element_id] = len(self.element_indices)
+		return self.element_indices[element_id]
+	def _get_update_state(self, element_state):	# Returns (state, error)
+		state = {}
+		
+		try:
+			state['id']				= element_state.get_element().id()
+			state['time']			= self.engine.get_local_time_now()
+			state['update_count']	= element_state.update_count
+			state['value']			= element_state.last_value
+			state['value_formatted']= element_state.get_formatted_value()
+			state['valid']			= element_state.last_valid
+			state['update_time']	= element_state.last_update_time
+			state['trigger']		= element_state.last_trigger
+			if element_state.previous_value is not None:
+				state['previous_value']				= element_state.previous_value
+				state['previous_value_formatted']	= element_state.get_formatted_previous_value()
+				state['previous_value_time']		= element_state.previous_value_time
+		except Exception, e:
+			return (state, str(e))
+		
+		return (state, None)
+	def _encode_update(self, element_state, wire_protocol=protocol.PROTOCOL_JSON):
+		state, error = self._get_update_state(element_state)
+		response = {'result':state, 'error':error}
+		
+		self.encode_cnt += 1
+		
+		if wire_protocol == protocol.PROTOCOL_BINARY:
+			if response['error'] is None:
+				try:
+					return protocol.pack_update(self._get_element_index(state['id']), state)
+				except Exception, e:
+					response['error'] = str(e)
+			return protocol.pack_record(protocol.RECORD_JSON, jsonpickle.encode(response, unpicklable=False))	# Errors are still sent as JSON
+		
+		return jsonpickle.encode(response, unpicklable=False)
 	def get_client(self, address, keep_lock=True):
 		self.server.client_lock.acquire()
 		client = None
-		for c in self.server.clients:
-			if c.client_address == address:
-				client = c
-				break
+		if address in self.server.clients:
+			client = self.server.clients[address]
 		if client is None or not keep_lock:
 			self.server.client_lock.release()
 		return client
-	def update(self, update):
+	def update(self, update):	# From client handler threads
+		client_address, msg = update
 		with self.update_lock:
-			self.pending_updates += [update]
+			self.pending_updates += [(client_address, msg, time.time())]
+		self.request_event.set()
 	def stop(self):
 		print "Shutting down server..."
+		self.controlling = False
+		self.request_event.set()
+		if self.control_thread:
+			self.control_thread.join()
+			self.control_thread = None
+		self.writing = False
+		self.write_event.set()
+		if self.writer_thread:
+			self.writer_thread.join()
+			self.writer_thread = None
 		if self.server:
 			self.server.shutdown()
 			
 			with self.server.client_lock:
-				for client in self.server.clients:
+				for client in self.server.clients.values():
 					print "Disconnecting client:", client.client_address
 					client.request.shutdown(socket.SHUT_RDWR)
 					client.request.close()
@@ -22,7 +22,11 @@
 #  
 #  
 
+import time
+import numpy
+
 from constants import *
+import utils
 
 # Engine states
 STATE_NONE = 0
@@ -35,6 +39,74 @@ STATE_TXT = {
 	STATE_RECEIVING:		'Receiving'
 }
 
+HISTORY_DTYPE = numpy.dtype([('time', numpy.float64), ('value', numpy.float64), ('valid', numpy.int8)])	# Valid: -1 unknown (value is NaN if not numeric)
+
+_epoch_cache = [None, None]	# Updates in the same engine iteration share a time, so only convert it once
+
+def to_epoch(t):	# Local datetime -> seconds
+	if t is not _epoch_cache[0]:
+		_epoch_cache[1] = utils.to_epoch(t)
+		_epoch_cache[0] = t
+	return _epoch_cache[1]
+
+class History():	# Ring buffer of an element's samples, bounded by count and/or age (seconds)
+	def __init__(self, length=None, duration=None, initial_length=64):
+		if length is None and duration is None:
+			raise Exception("History needs a length and/or duration")
+		self.length = length
+		self.duration = duration
+		if length is None:	# Grows until samples start expiring
+			self.samples = numpy.zeros(initial_length, dtype=HISTORY_DTYPE)
+		else:
+			self.samples = numpy.zeros(length, dtype=HISTORY_DTYPE)
+		self.start = 0	# Oldest sample
+		self.count = 0
+	def append(self, t, value, valid):
+		t = to_epoch(t)
+		try:
+			value = float(value)
+		except (TypeError, ValueError):
+			value = numpy.nan
+		if valid is None:
+			valid = -1
+		
+		capacity = len(self.samples)
+		
+		if self.duration is not None:
+			oldest = t - self.duration
+			while self.count > 0 and self.samples[self.start]['time'] < oldest:
+				self.start = (self.start + 1) % capacity
+				self.count -= 1
+		
+		if self.count == capacity:
+			if self.length is None:
+				self.samples = numpy.concatenate((self.samples[(self.start + numpy.arange(self.count)) % capacity], numpy.zeros(capacity, dtype=HISTORY_DTYPE)))
+				self.start = 0
+				capacity = len(self.samples)
+			else:	# Overwrite the oldest
+				self.start = (self.start + 1) % capacity
+				self.count -= 1
+		
+		self.samples[(self.start + self.count) % capacity] = (t, value, valid)
+		self.count += 1
+	def get_samples(self, count=None, start_time=None, end_time=None, now=None):	# Copy, oldest first ('now' in seconds, defaults to the current time)
+		samples = self.samples[(self.start + numpy.arange(self.count)) % len(self.samples)]
+		if self.duration is not None:	# Expired samples are only dropped on append, so may still be held
+			if now is None:
+				now = time.time()
+			samples = samples[samples['time'] >= now - self.duration]
+		if start_time is not None:
+			samples = samples[samples['time'] >= start_time]
+		if end_time is not None:
+			samples = samples[samples['time'] <= end_time]
+		if count is not None:
+			samples = samples[max(0, len(samples) - count):]
+		return samples
+	def get_memory_usage(self):	# Bytes
+		return self.samples.nbytes
+	def __len__(self):
+		return self.count
+
 class ElementState():
 	def __init__(self, element, manager, engine):
 		self.element = element
@@ -48,7 +120,45 @@ class ElementState():
 		self.last_valid = None
 		self.last_trigger = None
 		self.update_count = 0
+		
+		self.changed = False	# Whether the last update changed the value (or its validity)
+		self.last_cache_key = None	# Key of the raw input that produced the current value
+		self.cache_hit_cnt = 0
+		self.cache_miss_cnt = 0
+		
+		self.formatted_value = None
+		self.formatted_value_stale = True
+		self.formatted_previous_value = None
+		self.formatted_previous_value_stale = True
+		
+		self.history = None	# Samples of every update (see 'enable_history')
 	def get_element(self): return self.element
+	def enable_history(self, length=None, duration=None):	# Previous samples are discarded
+		self.history = History(length, duration)
+	def disable_history(self):
+		self.history = None
+	def get_history_memory_usage(self):
+		if self.history is None:
+			return 0
+		return self.history.get_memory_usage()
+	def get_cache_stats(self):	# (hits, misses): hits are updates where the parser and validator were skipped as the raw input hadn't changed
+		return (self.cache_hit_cnt, self.cache_miss_cnt)
+	def get_formatted_value(self):	# Formatting is only redone when the value changes (None is formatted too, as clients have always been sent it)
+		if self.formatted_value_stale:
+			self.formatted_value = self.element.formatter().format(self.last_value)
+			self.formatted_value_stale = False
+		return self.formatted_value
+	def get_formatted_previous_value(self):
+		if self.previous_value is None:
+			return None
+		if self.formatted_previous_value_stale:
+			self.formatted_previous_value = self.element.formatter().format(self.previous_value)
+			self.formatted_previous_value_stale = False
+		return self.formatted_previous_value
+	def get_collect_key(self, trigger):	# States with the same key collect identical raw data for this trigger (None if not shareable)
+		return self.element.positions().get_collect_key(trigger=trigger, mode=self.engine.options.mode)
+	def get_extract_plan(self, trigger):
+		return self.element.positions().get_extract_plan(trigger=trigger, mode=self.engine.options.mode)
 	def _update(self, time, trigger, res, valid):
 		self.last_update_time = time
 		self.update_count += 1
@@ -56,30 +166,186 @@ class ElementState():
 		if res is not None and res != self.last_value:
 			self.previous_value = self.last_value
 			self.previous_value_time = time
+			self.formatted_previous_value_stale = True
+		
+		value_changed = (res != self.last_value)
+		if value_changed:
+			self.formatted_value_stale = True
+		self.changed = value_changed or (valid != self.last_valid)
 		
 		self.last_trigger = trigger
 		self.last_value = res
 		self.last_valid = valid
+		
+		if self.history is not None:
+			self.history.append(time, res, valid)
+	def _update_unchanged(self, trigger):	# Raw input is the same as last time, so value and validity are too
+		self.last_update_time = self.manager.engine.get_local_time_now()
+		self.update_count += 1
+		self.changed = False
+		self.last_trigger = trigger
+		self.cache_hit_cnt += 1
+		
+		if self.history is not None:
+			self.history.append(self.last_update_time, self.last_value, self.last_valid)
 	def __call__(self, trigger, *args, **kwds):
 		#try:
 			#if self.element.id() == ?: raise Exception("%s" % (self.element.id()))	# TEST
 			
-			local_time_now = self.manager.engine.get_local_time_now()
-			
 			raw_data = self.element.positions().collect(trigger=trigger, state=self, mode=self.engine.options.mode, *args, **kwds)
 			
-			(res, val) = self.element.parser().parse(raw_data, element=self.element, state=self, *args, **kwds)
-			if res == False:
-				return False	# [This will cause the callback chain to abort] Not any more
-			
-			#if self.element.id() == ?: raise Exception("%s" % (self.element.id()))	# TEST
-			
-			valid = self.element.validator().validate(val, state=self)
-			
-			self._update(local_time_now, trigger, val, valid)
+			return self.accept(raw_data, trigger, *args, **kwds)
 		#except Exception, e:
 		#	self.last_value = str(e)
 		#	raise e
+	def accept(self, raw_data, trigger, *args, **kwds):	# Already collected (e.g. by an ElementStateGroup)
+		parser = self.element.parser()
+		
+		cache_key = parser.get_cache_key(raw_data, element=self.element, state=self, *args, **kwds)
+		if cache_key is not None and cache_key == self.last_cache_key:
+			return self._update_unchanged(trigger)
+		
+		(res, val) = parser.parse(raw_data, element=self.element, state=self, *args, **kwds)
+		if res == False:
+			return False	# [This will cause the callback chain to abort] Not any more
+		
+		#if self.element.id() == ?: raise Exception("%s" % (self.element.id()))	# TEST
+		
+		return self._accept_parsed(val, trigger, cache_key)
+	def accept_value(self, val, trigger, cache_key=None):	# Already parsed (e.g. by a FrameExtractor), 'cache_key' identifies the raw input
+		if cache_key is not None and cache_key == self.last_cache_key:
+			return self._update_unchanged(trigger)
+		
+		return self._accept_parsed(val, trigger, cache_key)
+	def _accept_parsed(self, val, trigger, cache_key):
+		local_time_now = self.manager.engine.get_local_time_now()
+		
+		valid = self.element.validator().validate(val, state=self)
+		
+		self._update(local_time_now, trigger, val, valid)
+		
+		self.last_cache_key = cache_key
+		self.cache_miss_cnt += 1
+
+class ElementStateGroup():	# Element states reading identical bytes for a trigger share one collect
+	def __init__(self, element_states):
+		self.element_states = element_states
+	def __call__(self, trigger, *args, **kwds):
+		first = self.element_states[0]
+		
+		raw_data = first.element.positions().collect(trigger=trigger, state=first, mode=first.engine.options.mode, *args, **kwds)
+		
+		for element_state in self.element_states:
+			element_state.accept(list(raw_data), trigger, *args, **kwds)	# Parsers may modify the list (e.g. FSSAParser)
+
+class FrameExtractor():	# Collects raw data of all element states in a minor frame with one numpy pass
+	def __init__(self):
+		self.byte_indices = []
+		self.bit_shifts = []
+		self.masks = []
+		self.value_shifts = []
+		self.starts = []
+		self.raw_data = None
+		self.values = None
+	def add_targets(self, trigger, targets):	# Returns targets with those that can be extracted replaced
+		l = []
+		for target in targets:
+			if isinstance(target, ElementStateGroup):
+				element_states = target.element_states
+			elif isinstance(target, ElementState):
+				element_states = [target]
+			else:
+				l += [target]
+				continue
+			
+			plan = element_states[0].get_extract_plan(trigger)
+			if plan is None:
+				l += [target]
+				continue
+			
+			byte_indices, bit_offsets = plan
+			l += [ExtractedElementTarget(self, self._add_segment(byte_indices, bit_offsets), element_states)]
+		return tuple(l)
+	def _add_segment(self, byte_indices, bit_offsets):
+		cnt = len(byte_indices)
+		start = len(self.byte_indices)
+		
+		if bit_offsets is None:
+			shift = 8
+			self.bit_shifts += [0] * cnt
+			self.masks += [0xff] * cnt
+		else:
+			shift = 1
+			self.bit_shifts += [7 - (j % 8) for j in bit_offsets]
+			self.masks += [0x1] * cnt
+		
+		if (shift * cnt) > 63:	# Won't fit, so value will have to be parsed
+			shift = None
+			self.value_shifts += [0] * cnt
+		else:
+			self.value_shifts += [shift * (cnt - 1 - i) for i in range(cnt)]
+		
+		self.byte_indices += byte_indices
+		self.starts += [start]
+		
+		return (len(self.starts) - 1, start, start + cnt, shift)
+	def compile(self):
+		self.byte_indices = numpy.array(self.byte_indices, dtype=numpy.intp)
+		self.bit_shifts = numpy.array(self.bit_shifts, dtype=numpy.uint8)
+		self.masks = numpy.array(self.masks, dtype=numpy.uint8)
+		self.value_shifts = numpy.array(self.value_shifts, dtype=numpy.int64)
+		self.starts = numpy.array(self.starts, dtype=numpy.intp)
+	def is_empty(self):
+		return len(self.starts) == 0
+	def extract(self, frame):
+		data = numpy.asarray(frame, dtype=numpy.uint8)
+		raw = (data[self.byte_indices] >> self.bit_shifts) & self.masks
+		self.raw_data = raw.tolist()
+		self.values = numpy.add.reduceat(raw.astype(numpy.int64) << self.value_shifts, self.starts).tolist()
+
+class ExtractedElementTarget():	# Hands data gathered by a FrameExtractor to element states
+	def __init__(self, extractor, segment, element_states):
+		self.extractor = extractor
+		self.segment_idx, self.start, self.end, shift = segment
+		self.element_states = element_states
+		# Parsing can be skipped when the parser would only be combining the values again
+		self.combined = [(shift is not None and element_state.get_element().parser().get_shift() == shift) for element_state in element_states]
+	def __call__(self, trigger, *args, **kwds):
+		for element_state, combined in zip(self.element_states, self.combined):
+			if combined:
+				value = self.extractor.values[self.segment_idx]
+				element_state.accept_value(long(value), trigger, value)	# Combined value is as good as the raw bytes for caching
+			else:
+				element_state.accept(self.extractor.raw_data[self.start:self.end], trigger, *args, **kwds)
+
+def compile_targets(targets, trigger):	# Returns tuple of targets for a slot, with element states that collect identical data merged into groups
+	compiled = []
+	groups = {}
+	others = []	# Element states go first so other targets (e.g. UI, server) see the values decoded for this slot, whenever they were tracked
+	for target in targets:
+		if isinstance(target, ElementState):
+			key = target.get_collect_key(trigger)
+			if key is not None:
+				if key in groups:
+					groups[key] += [target]
+				else:
+					groups[key] = [target]
+					compiled += [groups[key]]	# Keeps position of first member
+				continue
+			compiled += [target]
+		else:
+			others += [target]
+	compiled += others
+	
+	l = []
+	for target in compiled:
+		if isinstance(target, list):
+			if len(target) == 1:
+				target = target[0]
+			else:
+				target = ElementStateGroup(target)
+		l += [target]
+	return tuple(l)
 
 class EventDispatcher():
 	def __init__(self, events):
@@ -100,8 +366,10 @@ class EventDispatcher():
 			return False
 		self.listeners[event].remove(target)
 		return True
+	def has_listeners(self, event):
+		return event in self.listeners and len(self.listeners[event]) > 0
 	def dispatch(self, event, *args, **kwds):
-		if event not in self.listeners.keys():
+		if event not in self.listeners:
 			return None
 		for target in self.listeners[event]:
 			if target(event=event, source=self, *args, **kwds) == False:
@@ -134,33 +402,44 @@ class Trigger():
 	def __eq__(self, other):
 		return str(self.name) == str(other.name) and self.indices == other.indices
 	def check_map(self, m):
-		if self not in m.keys():
+		if self not in m:
 			return (False, None)
 		v = m[self]
-		if not isinstance(v, list): v = [v]
+		if isinstance(v, (dict, set)): v = list(v)	# Indexed collections (e.g. the server's registration maps)
+		elif not isinstance(v, list): v = [v]
 		return (True, v)
 
+_all_minor_frames_triggers = {}	# Kept out of the instance so pickled triggers are unchanged
+
 class MinorFrameTrigger(Trigger):
 	def __init__(self, *args, **kwds):
 		Trigger.__init__(self, *args, **kwds)
+	def get_all_minor_frames_trigger(self):
+		key = (self.name, self.indices[1])
+		if key not in _all_minor_frames_triggers:
+			_all_minor_frames_triggers[key] = Trigger(self.name, (self.indices[1],))
+		return _all_minor_frames_triggers[key]
 	def check_map(self, m):
 		l = None
-		if self in m.keys():
+		if self in m:
 			v = m[self]
-			if not isinstance(v, list): v = [v]
+			if isinstance(v, (dict, set)): v = list(v)
+			elif not isinstance(v, list): v = [v]
 			l = v
-		all_minor_frames = Trigger(self.name, (self.indices[1],))
-		if all_minor_frames in m.keys():
+		all_minor_frames = self.get_all_minor_frames_trigger()
+		if all_minor_frames in m:
 			if l is None: l = []
+			else: l = list(l)	# Don't extend the list stored in the map
 			v = m[all_minor_frames]
-			if not isinstance(v, list): v = [v]
+			if isinstance(v, (dict, set)): v = list(v)
+			elif not isinstance(v, list): v = [v]
 			l += v
 		if l is None:
 			return (False, None)
 		return (True, l)
 
 class SubcomTracker(Tracker, EventDispatcher):	# FIXME: , CustomOffset
-	def __init__(self, key, length, offsets, major_length):
+	def __init__(self, key, length, offsets, major_length, ring_length=4):	# MAGIC: ring holds the current subcom frame and the last ones completed
 		if offsets != sorted(offsets):
 			raise Exception("Offsets supplied to SubcomTracker for '%s' not in order: %s" % (key, offsets))
 		#Tracker.__init__(self, [SubcomByteOffset, SubcomBitOffset])
@@ -170,23 +449,39 @@ class SubcomTracker(Tracker, EventDispatcher):	# FIXME: , CustomOffset
 		self.offsets = offsets
 		self.major_length = major_length
 		self.update_map = {}
+		self.slots = [None] * length	# (trigger, targets) for each subcom index
+		self.compiled = False
+		
+		self.ring_length = ring_length
+		self.ring = numpy.zeros((ring_length, length), dtype=numpy.uint8)	# Each row is a subcom frame, written in place
+		self.ring_valid = numpy.zeros((ring_length, length), dtype=numpy.bool_)	# Which bytes were actually received
+		self.ring_views = []	# Read-only views of each row
+		for i in range(ring_length):
+			view = self.ring[i].view()
+			view.flags.writeable = False
+			self.ring_views += [view]
 		
 		self.reset()
 		
 		self._build_indices()
 	def reset(self):
-		self.subcom_frame = []
-		self.last_subcom_frame = []
+		self.ring[:] = 0
+		self.ring_valid[:] = False
+		self.ring_idx = 0	# Row of the current subcom frame
+		self.subcom_frame_len = 0	# Number of bytes filled in the current subcom frame (including gaps)
+		self.completed_cnt = 0	# Number of completed subcom frames in the ring (excluding the current one)
 		self.discontinuity_cnt = 0
 	def _build_indices(self):
 		self.trigger_indices = []
 		self.offset_map = {}
+		self.subcom_index_table = [[None] * MINOR_FRAME_LEN for i in range(self.major_length)]	# [minor frame index][column] -> subcom index
 		cnt = 0
 		for i in range(self.major_length):
 			self.offset_map[i] = []
 			for o in self.offsets:
 				self.trigger_indices += [Trigger(MINOR_FRAME_KEY, (i, o))]
 				self.offset_map[i] += [cnt]
+				self.subcom_index_table[i][o] = cnt
 				cnt = (cnt + 1) % self.length
 		if cnt != 0:
 			raise Exception("Subcom '%s' index count ended on %d" % (self.key, cnt))
@@ -194,62 +489,105 @@ class SubcomTracker(Tracker, EventDispatcher):	# FIXME: , CustomOffset
 	def can_handle_subcom(self, key):
 		return (self.get_subcom_key() == key)
 	def get_trigger_indices(self): return self.trigger_indices	# FIXME: , *args, **kwds (for CustomOffset)
+	def get_subcom_frame(self, age=0):	# Read-only view: age 0 is the current (partial) subcom frame, 1 is the last completed one, etc. (None if not available)
+		if age < 0 or age > self.completed_cnt:
+			return None
+		row = (self.ring_idx - age) % self.ring_length
+		if age == 0:
+			return self.ring_views[row][:self.subcom_frame_len]
+		return self.ring_views[row]
+	def get_byte(self, index, age=None):	# Returns None if the byte wasn't received. If no age is given, the most recently received byte at that index is returned.
+		if age is None:
+			ages = range(self.completed_cnt + 1)
+		elif age < 0 or age > self.completed_cnt:
+			return None
+		else:
+			ages = [age]
+		for age in ages:
+			row = (self.ring_idx - age) % self.ring_length
+			if self.ring_valid[row, index]:
+				return int(self.ring[row, index])
+		return None
+	def compile(self):
+		for index in range(self.length):
+			self._compile_slot(index)
+		self.compiled = True
+	def _compile_slot(self, index):
+		if index not in self.update_map or len(self.update_map[index]) == 0:
+			self.slots[index] = None
+			return
+		trigger = Trigger(self.key, (index,))
+		self.slots[index] = (trigger, compile_targets(self.update_map[index], trigger))
 	def update(self, byte, frame, minor_frame_idx, idx, trigger, *args, **kwds):
-		minor_frame_offset_index = self.offsets.index(idx)
-		subcom_offset_list = self.offset_map[minor_frame_idx]
-		subcom_offset = subcom_offset_list[minor_frame_offset_index]
+		if not self.compiled:
+			self.compile()
+		
+		subcom_offset = self.subcom_index_table[minor_frame_idx][idx]
 		
-		diff = subcom_offset - len(self.subcom_frame)
+		diff = subcom_offset - self.subcom_frame_len
 		
 		if diff < 0:
 			self.discontinuity_cnt += 1
-			self.subcom_frame = [0]*subcom_offset
+			self.ring[self.ring_idx] = 0	# Start again (gap up to this byte stays zero and invalid)
+			self.ring_valid[self.ring_idx] = False
 		elif diff > 0:
-			if len(self.subcom_frame) == 0:	# Starting a new stream, so discontinuity is OK
+			if self.subcom_frame_len == 0:	# Starting a new stream, so discontinuity is OK
 				pass
 			else:
 				self.discontinuity_cnt += 1
-			self.subcom_frame += [0]*diff
 		
-		self.subcom_frame += [byte]
+		self.ring[self.ring_idx, subcom_offset] = byte
+		self.ring_valid[self.ring_idx, subcom_offset] = True
+		self.subcom_frame_len = subcom_offset + 1
 		
-		self.dispatch(EVENT_NEW_BYTE, byte=byte, frame=self.subcom_frame)
+		idx = subcom_offset
 		
-		idx = len(self.subcom_frame) - 1
+		slot = self.slots[idx]
+		if slot is not None or self.has_listeners(EVENT_NEW_BYTE):
+			frame = self.ring_views[self.ring_idx][:self.subcom_frame_len]
+			
+			self.dispatch(EVENT_NEW_BYTE, byte=byte, frame=frame, idx=idx)
+			
+			if slot is not None:
+				trigger, targets = slot
+				#if self.key == ? and idx == ?: raise Exception("%s[%d]: %s" % (self.key, idx, map(lambda x: x.element.id(), targets)))	# TEST
+				for target in targets:
+					res = target(byte=byte, frame=frame, idx=idx, trigger=trigger)
+					#if res == False:
+					#	break
 		
-		if idx in self.update_map.keys():
-			targets = self.update_map[idx]
-			trigger = Trigger(self.key, (idx,))
-			#if self.key == ? and idx == ?: raise Exception("%s[%d]: %s" % (self.key, idx, map(lambda x: x.element.id(), targets)))	# TEST
-			for target in targets:
-				res = target(byte=byte, frame=self.subcom_frame, idx=idx, trigger=trigger)
-				#if res == False:
-				#	break
-		
-		if len(self.subcom_frame) == self.length:	# Complete
-			self.dispatch(EVENT_NEW_FRAME, frame=self.subcom_frame)	# Trigger before last frame is overwritten
-			self.last_subcom_frame = self.subcom_frame
-			self.subcom_frame = []
+		if self.subcom_frame_len == self.length:	# Complete
+			if self.has_listeners(EVENT_NEW_FRAME):	# Trigger before the ring moves on
+				self.dispatch(EVENT_NEW_FRAME, frame=self.ring_views[self.ring_idx], minor_frame_idx=minor_frame_idx, valid=bool(self.ring_valid[self.ring_idx].all()))
+			self.ring_idx = (self.ring_idx + 1) % self.ring_length
+			self.ring[self.ring_idx] = 0	# Oldest subcom frame is overwritten
+			self.ring_valid[self.ring_idx] = False
+			self.subcom_frame_len = 0
+			self.completed_cnt = min(self.completed_cnt + 1, self.ring_length - 1)
 	def track(self, indices, target):
 		for index in indices:
 			#assert(index.name in ALL_SUBCOM_LIST)	# FIXME
 			index, = index.indices
 			if index < 0 or index >= self.length:
 				raise Exception("Unable to track index %d outside of SubcomTracker length %d" % (index, self.length))
-			if index not in self.update_map.keys():
+			if index not in self.update_map:
 				self.update_map[index] = []
 			if target not in self.update_map[index]:
 				self.update_map[index] += [target]
+				if self.compiled:
+					self._compile_slot(index)
 		#return indices
 	def untrack(self, indices, target):
 		for index in indices:
 			#assert(index.name in ALL_SUBCOM_LIST)	# FIXME
 			index, = index.indices
-			if index not in self.update_map.keys():
+			if index not in self.update_map:
 				continue
 			if target not in self.update_map[index]:
 				continue
 			self.update_map[index].remove(target)
+			if self.compiled:
+				self._compile_slot(index)
 		#return indices
 
 class FrameTracker(Tracker, EventDispatcher):
@@ -262,13 +600,55 @@ class FrameTracker(Tracker, EventDispatcher):
 		self.ignored_continuous_minor_frame_idx_increment_limit = 3	# MAGIC
 		
 		self.major_frame_update_map = {}
+		self.slot_table = [[None] * MINOR_FRAME_LEN for i in range(length)]	# (trigger, targets) for each [minor frame index][byte index]
+		self.active_slots = [[] for i in range(length)]	# (byte index, trigger, targets) of non-empty slots for each minor frame (used for complete frames)
+		self.extractors = [None] * length	# FrameExtractor for each minor frame (when it has element states that can be extracted)
+		self.compiled = False
+		
+		self.major_frame = numpy.zeros((length, MINOR_FRAME_LEN), dtype=numpy.uint8)	# Each row is a minor frame, written in place
+		self.major_frame_views = []	# Read-only views of each row (handed to consumers instead of copies)
+		for i in range(length):
+			view = self.major_frame[i].view()
+			view.flags.writeable = False
+			self.major_frame_views += [view]
 		
 		self.reset()
+	def compile(self):	# Build the dispatch table from the update map (afterwards track/untrack keep it up-to-date)
+		for minor_idx in range(self.length):
+			for frame_idx in range(MINOR_FRAME_LEN):
+				self._compile_slot(minor_idx, frame_idx, False)
+			self._compile_active_slots(minor_idx)
+		self.compiled = True
+	def _compile_slot(self, minor_idx, frame_idx, update_active=True):
+		targets = []
+		if minor_idx in self.major_frame_update_map and frame_idx in self.major_frame_update_map[minor_idx]:
+			targets = self.major_frame_update_map[minor_idx][frame_idx]
+		if len(targets) == 0:
+			self.slot_table[minor_idx][frame_idx] = None
+		else:
+			trigger = MinorFrameTrigger(MINOR_FRAME_KEY, (minor_idx, frame_idx))
+			self.slot_table[minor_idx][frame_idx] = (trigger, compile_targets(targets, trigger))
+		if update_active:
+			self._compile_active_slots(minor_idx)
+	def _compile_active_slots(self, minor_idx):
+		l = []
+		extractor = FrameExtractor()
+		for frame_idx in range(MINOR_FRAME_LEN):
+			slot = self.slot_table[minor_idx][frame_idx]
+			if slot is not None:
+				trigger, targets = slot
+				l += [(frame_idx, trigger, extractor.add_targets(trigger, targets))]
+		extractor.compile()
+		if extractor.is_empty():
+			extractor = None
+		self.extractors[minor_idx] = extractor
+		self.active_slots[minor_idx] = l	# Replaced (not modified) in case it's being iterated over
 	def reset(self, resync=False):
-		self.last_frame = None
+		self.last_frame_len = 0
 		self.last_byte = None
 		self.minor_frame_idx = None
-		self.major_frame_map = {}
+		self.major_frame_lengths = [0] * self.length	# Number of bytes filled in each row
+		self.major_frame_times = [None] * self.length	# Time each row was received
 		self.continuous_minor_frame_idx_increment_cnt = 0
 		self.ignore_minor_frame_idx = False
 		self.last_ignored_minor_frame_idx = None
@@ -278,10 +658,22 @@ class FrameTracker(Tracker, EventDispatcher):
 			return
 		
 		self.frame_discontinuity_cnt = 0
-	def update(self, byte, frame, sync=False, idx=None, internal=False, *args, **kwds):
+	def get_minor_frame(self, minor_frame_idx):	# Read-only view of the bytes received for a minor frame (None if there are none)
+		length = self.major_frame_lengths[minor_frame_idx]
+		if length == 0:
+			return None
+		return self.major_frame_views[minor_frame_idx][:length]
+	def get_minor_frame_time(self, minor_frame_idx):
+		return self.major_frame_times[minor_frame_idx]
+	def get_memory_usage(self):	# Bytes held for frame storage
+		return self.major_frame.nbytes
+	def update(self, byte, frame, sync=False, idx=None, internal=False, time=None, *args, **kwds):
 		if idx is not None and idx >= len(frame):
 			raise Exception("FrameTracker: manual byte index is %d, but length of frame is %d" % (idx, len(frame)))
 		
+		if not self.compiled:
+			self.compile()
+		
 		if sync:
 			self.reset(True)	# Framer was reset, so reset local tracking state
 		
@@ -294,7 +686,11 @@ class FrameTracker(Tracker, EventDispatcher):
 			self.minor_frame_idx = frame[MINOR_FRAME_IDX_OFFSET]
 			manually_set_minor_frame_idx = True
 		
-		if self.last_frame is not None and len(self.last_frame) == MINOR_FRAME_LEN:	# Last frame is complete
+		if self.last_frame_len == MINOR_FRAME_LEN and idx is None and len(frame) > 1 and not internal:	# Frame was started with complete frames going to 'update_frame' (the engine switched to bytes mid-frame), so catch up on its earlier bytes
+			for i in range(len(frame) - 1):
+				self.update(frame[i], frame[:i+1], internal=True, time=time)
+		
+		if self.last_frame_len == MINOR_FRAME_LEN:	# Last frame is complete
 			if idx is None:
 				if len(frame) != 1:
 					raise Exception("Invalid state in FrameTracker: last frame appears complete but new byte's frame has length %d" % (len(frame)))
@@ -307,63 +703,108 @@ class FrameTracker(Tracker, EventDispatcher):
 		
 		# This will still get run when at MINOR_FRAME_IDX_OFFSET
 		if manually_set_minor_frame_idx == False and idx == MINOR_FRAME_IDX_OFFSET:
-			if self.minor_frame_idx is not None:
-				if frame[idx] != self.minor_frame_idx:
-					self.frame_discontinuity_cnt += 1
-					if not self.ignore_minor_frame_idx:
-						# Force update
-						#self.last_frame = None
-						self.minor_frame_idx = None
-					else:
-						if self.last_ignored_minor_frame_idx is not None and frame[idx] == ((self.last_ignored_minor_frame_idx + 1) % self.length):
-							self.ignored_continuous_minor_frame_idx_increment_cnt += 1
-							if self.ignored_continuous_minor_frame_idx_increment_cnt == self.ignored_continuous_minor_frame_idx_increment_limit:
-								self.minor_frame_idx = None
-								self.ignore_minor_frame_idx = False
-								self.continuous_minor_frame_idx_increment_cnt = 0
-						self.last_ignored_minor_frame_idx = frame[idx]
-				else:
-					self.continuous_minor_frame_idx_increment_cnt += 1
-					if self.continuous_minor_frame_idx_increment_cnt == self.continuous_minor_frame_idx_increment_limit:
-						self.ignore_minor_frame_idx = True
-					self.last_ignored_minor_frame_idx = None
-					self.ignored_continuous_minor_frame_idx_increment_cnt = 0
-			
-			#if self.last_frame is None:
-			if self.minor_frame_idx is None:
-				self.minor_frame_idx = frame[idx]	# Update now
-				
+			if self._lock_minor_frame_idx(frame[idx]):
 				for i in range(idx):
-					self.update(frame[i], frame[:i+1], internal=True)	# FIXME: Check expectation of last_byte/last_frame updating below
-			else:
-				if not self.ignore_minor_frame_idx:
-					self.minor_frame_idx = frame[idx]
+					self.update(frame[i], frame[:i+1], internal=True, time=time)	# FIXME: Check expectation of last_byte/last_frame updating below
 		
 		if self.minor_frame_idx is not None:
-			self.major_frame_map[self.minor_frame_idx] = frame
+			self.major_frame[self.minor_frame_idx, idx] = byte
+			self.major_frame_lengths[self.minor_frame_idx] = idx + 1
+			if idx == 0:
+				self.major_frame_times[self.minor_frame_idx] = time
 			
 			self.dispatch(event=EVENT_NEW_BYTE, byte=byte, frame=frame, minor_frame_idx=self.minor_frame_idx, idx=idx)
 			
-			if self.minor_frame_idx in self.major_frame_update_map.keys():
-				minor_frame_update_map = self.major_frame_update_map[self.minor_frame_idx]
-				
-				if idx in minor_frame_update_map.keys():
-					targets = minor_frame_update_map[idx]
-					trigger = MinorFrameTrigger(MINOR_FRAME_KEY, (self.minor_frame_idx, idx))
-					for target in targets:
-						res = target(byte=byte, frame=frame, minor_frame_idx=self.minor_frame_idx, idx=idx, trigger=trigger)
-						#if res == False:
-						#	break
+			slot = self.slot_table[self.minor_frame_idx][idx]
+			if slot is not None:
+				trigger, targets = slot
+				for target in targets:
+					res = target(byte=byte, frame=frame, minor_frame_idx=self.minor_frame_idx, idx=idx, trigger=trigger)
+					#if res == False:
+					#	break
 			
-			self.dispatch(event=EVENT_NEW_FRAME, frame=frame, minor_frame_idx=self.minor_frame_idx)
+			if idx == (MINOR_FRAME_LEN - 1):	# Complete
+				self.dispatch(event=EVENT_NEW_FRAME, frame=frame, minor_frame_idx=self.minor_frame_idx, sync=sync, drop=False)
 		
 		# These are updated *after* the event handlers are called
 		#if internal == False:
 		if True:	# Will always update (even when doing catch-up)
 			self.last_byte = byte
-			self.last_frame = list(frame[:idx+1])	# Make a copy
+			self.last_frame_len = idx + 1
+	def _lock_minor_frame_idx(self, frame_minor_frame_idx):	# Returns True if the minor frame index had to be (re)acquired
+		if self.minor_frame_idx is not None:
+			if frame_minor_frame_idx != self.minor_frame_idx:
+				self.frame_discontinuity_cnt += 1
+				if not self.ignore_minor_frame_idx:
+					# Force update
+					#self.last_frame = None
+					self.minor_frame_idx = None
+				else:
+					if self.last_ignored_minor_frame_idx is not None and frame_minor_frame_idx == ((self.last_ignored_minor_frame_idx + 1) % self.length):
+						self.ignored_continuous_minor_frame_idx_increment_cnt += 1
+						if self.ignored_continuous_minor_frame_idx_increment_cnt == self.ignored_continuous_minor_frame_idx_increment_limit:
+							self.minor_frame_idx = None
+							self.ignore_minor_frame_idx = False
+							self.continuous_minor_frame_idx_increment_cnt = 0
+					self.last_ignored_minor_frame_idx = frame_minor_frame_idx
+			else:
+				self.continuous_minor_frame_idx_increment_cnt += 1
+				if self.continuous_minor_frame_idx_increment_cnt == self.continuous_minor_frame_idx_increment_limit:
+					self.ignore_minor_frame_idx = True
+				self.last_ignored_minor_frame_idx = None
+				self.ignored_continuous_minor_frame_idx_increment_cnt = 0
+		
+		#if self.last_frame is None:
+		if self.minor_frame_idx is None:
+			self.minor_frame_idx = frame_minor_frame_idx	# Update now
+			return True
+		
+		if not self.ignore_minor_frame_idx:
+			self.minor_frame_idx = frame_minor_frame_idx
+		
+		return False
+	def update_frame(self, frame, sync=False, drop=False, idx_lock=False, time=None, *args, **kwds):	# Complete minor frame in one call (instead of 'update' for each byte)
+		if len(frame) != MINOR_FRAME_LEN:
+			raise Exception("FrameTracker: complete frame has length %d" % (len(frame)))
+		
+		if sync or drop:
+			self.reset(True)	# Framer was reset (or data was lost), so reset local tracking state
+		
+		if not self.compiled:
+			self.compile()
+		
+		frame_minor_frame_idx = frame[MINOR_FRAME_IDX_OFFSET]
+		
+		if idx_lock:	# Index byte might be corrupt (e.g. decoded from symbols), so lock on to a continuous sequence
+			if self.minor_frame_idx is not None and self.last_frame_len == MINOR_FRAME_LEN:	# Not if 'update' was given the start of this frame (the engine switched from bytes mid-frame), as it has already moved on
+				self.minor_frame_idx = (self.minor_frame_idx + 1) % self.length	# Last frame is complete, auto-increment for the new one
+			self._lock_minor_frame_idx(frame_minor_frame_idx)
+		else:	# Index byte is taken as-is
+			if self.minor_frame_idx is not None and frame_minor_frame_idx != ((self.minor_frame_idx + 1) % self.length):
+				self.frame_discontinuity_cnt += 1
+			self.minor_frame_idx = frame_minor_frame_idx
+		
+		self.major_frame[self.minor_frame_idx] = frame
+		self.major_frame_lengths[self.minor_frame_idx] = MINOR_FRAME_LEN
+		self.major_frame_times[self.minor_frame_idx] = time
+		frame_view = self.major_frame_views[self.minor_frame_idx]
+		
+		extractor = self.extractors[self.minor_frame_idx]
+		if extractor is not None:
+			extractor.extract(frame_view)
+		
+		for idx, trigger, targets in self.active_slots[self.minor_frame_idx]:
+			byte = frame[idx]
+			for target in targets:
+				res = target(byte=byte, frame=frame_view, minor_frame_idx=self.minor_frame_idx, idx=idx, trigger=trigger)
+		
+		self.dispatch(event=EVENT_NEW_FRAME, frame=frame_view, minor_frame_idx=self.minor_frame_idx, sync=sync, drop=drop)
+		
+		self.last_byte = frame[-1]
+		self.last_frame_len = MINOR_FRAME_LEN
 	def track(self, indices, target):
 		#l = []
+		changed = set()	# Minor frames whose active slots need recompiling (once each, however many slots changed)
 		for index in indices:
 			assert(index.name == MINOR_FRAME_KEY)
 			index = index.indices
@@ -372,29 +813,37 @@ class FrameTracker(Tracker, EventDispatcher):
 				index = index[0]
 				for i in range(self.length):
 					#l += 
-					self._track([(i, index)], target)
+					self._track([(i, index)], target, changed)
 			else:
 				assert(len(index) == 2)
 				#l += 
-				self._track([index], target)
+				self._track([index], target, changed)
+		for minor_idx in changed:
+			self._compile_active_slots(minor_idx)
 		#return l
-	def _track(self, indices, target):
+	def _track(self, indices, target, changed):
 		#l = []
 		for minor_idx, frame_idx in indices:
 			if minor_idx < 0 or minor_idx >= self.length:
 				raise Exception("Unable to track index %d outside of FrameTracker length %d" % (minor_idx, self.length))
+			if frame_idx < 0 or frame_idx >= MINOR_FRAME_LEN:
+				raise Exception("Unable to track byte index %d outside of minor frame length %d" % (frame_idx, MINOR_FRAME_LEN))
 			#l += [Trigger(MINOR_FRAME_KEY, (minor_idx, frame_idx))]
-			if minor_idx not in self.major_frame_update_map.keys():
+			if minor_idx not in self.major_frame_update_map:
 				self.major_frame_update_map[minor_idx] = {}
 			minor_frame_update_map = self.major_frame_update_map[minor_idx]
-			if frame_idx not in minor_frame_update_map.keys():
+			if frame_idx not in minor_frame_update_map:
 				minor_frame_update_map[frame_idx] = []
 			if target in minor_frame_update_map[frame_idx]:
 				continue
 			minor_frame_update_map[frame_idx] += [target]
+			if self.compiled:
+				self._compile_slot(minor_idx, frame_idx, False)
+				changed.add(minor_idx)
 		#return l
 	def untrack(self, indices, target):
 		#l = []
+		changed = set()
 		for index in indices:
 			assert(index.name == MINOR_FRAME_KEY)
 			index = index.indices
@@ -403,24 +852,29 @@ class FrameTracker(Tracker, EventDispatcher):
 				index = index[0]
 				for i in range(self.length):
 					#l += 
-					self._untrack([(i, index)], target)
+					self._untrack([(i, index)], target, changed)
 			else:
 				assert(len(index) == 2)
 				#l += 
-				self._untrack([index], target)
+				self._untrack([index], target, changed)
+		for minor_idx in changed:
+			self._compile_active_slots(minor_idx)
 		#return l
-	def _untrack(self, indices, target):
+	def _untrack(self, indices, target, changed):
 		#l = []
 		for minor_idx, frame_idx in indices:
 			#l += [Trigger(MINOR_FRAME_KEY, (minor_idx, frame_idx))]
-			if minor_idx not in self.major_frame_update_map.keys():
+			if minor_idx not in self.major_frame_update_map:
 				continue
 			minor_frame_update_map = self.major_frame_update_map[minor_idx]
-			if frame_idx not in minor_frame_update_map.keys():
+			if frame_idx not in minor_frame_update_map:
 				continue
 			if target not in minor_frame_update_map[frame_idx]:
 				continue
 			minor_frame_update_map[frame_idx].remove(target)
+			if self.compiled:
+				self._compile_slot(minor_idx, frame_idx, False)
+				changed.add(minor_idx)
 		#return l
 
 def main():
@@ -22,12 +22,13 @@
 #  
 #  
 
-import sys, socket, traceback, os, sys, datetime, time
+import sys, socket, traceback, os, sys, datetime, time, threading, re, bisect, fnmatch, collections
 import curses	# For detecting UI update errors during callbacks
+import numpy
 
 from optparse import OptionParser
 
-import ui, net, state, res, server, utils, input
+import ui, net, state, res, server, utils, input, archive
 from constants import *
 from primitives import *
 
@@ -55,7 +56,7 @@ class Deframer():
 	def get_sync_reset_count(self): return self.sync_reset_cnt
 	def get_state(self):
 		return state.STATE_NONE
-	def process(self, buffers, accept_fn=None):
+	def process(self, buffers, accept_fn=None, accept_frame_fn=None):	# 'accept_frame_fn' receives each complete minor frame (instead of each byte via 'accept_fn'), both with the receive time of the buffer it came from
 		pass
 
 class ByteDeframer(Deframer):
@@ -67,10 +68,12 @@ class ByteDeframer(Deframer):
 	def get_state(self):
 		if self.synced: return state.STATE_RECEIVING
 		return state.STATE_WAITING_FOR_SYNC
-	def process(self, buffers, accept_fn=None):
+	def process(self, buffers, accept_fn=None, accept_frame_fn=None):
 		for buf in buffers:
+			drop = False
 			if buf.get_flags() & net.Buffer.FLAG_DROP:
 				self.synced = False
+				drop = True
 			
 			resync = False
 			if buf.get_flags() & net.Buffer.FLAG_FIRST:
@@ -94,11 +97,14 @@ class ByteDeframer(Deframer):
 				self.synced = False
 				continue
 			
-			idx = 0
-			for b in data:
-				if accept_fn:
-					accept_fn(b, data, resync, idx)
-				idx += 1
+			if accept_frame_fn:
+				accept_frame_fn(data, resync, drop, time=buf.get_time())
+			else:
+				idx = 0
+				for b in data:
+					if accept_fn:
+						accept_fn(b, data, resync, idx, time=buf.get_time())
+					idx += 1
 			
 			self.complete_frame_cnt += 1
 
@@ -113,16 +119,19 @@ class SymbolDeframer(Deframer):
 		self.bit_idx = 0
 		self.sym_cnt = 2
 		self.frame = []
+		self.frame_resync = False
+		self.frame_drop = False
 		self.pre_sync_byte = 0xbe >> 1	# Last byte of sync without last bit
 		self.newly_synced = False
 	def get_state(self):
 		if self.synced: return state.STATE_RECEIVING
 		return state.STATE_WAITING_FOR_SYNC
-	def process(self, buffers, accept_fn=None):
+	def process(self, buffers, accept_fn=None, accept_frame_fn=None):
 		for buf in buffers:
 			if buf.get_flags() & net.Buffer.FLAG_DROP:
 				self.synced = False
 				self.skip = 0
+				self.frame_drop = True
 			
 			data = map(ord, buf.get_buffer())
 			cnt = 0
@@ -183,21 +192,180 @@ class SymbolDeframer(Deframer):
 					#if len(self.frame) == self.length: raise Exception("Frame complete 1")	# TEST
 					
 					if accept_fn:
-						accept_fn(self.byte, self.frame, self.newly_synced)
+						accept_fn(self.byte, self.frame, self.newly_synced, time=buf.get_time())
+					
+					if len(self.frame) == 1:
+						self.frame_resync = self.newly_synced
 					
 					if len(self.frame) == self.length:
 						#raise Exception("Frame complete 2")	# TEST
 						self.complete_frame_cnt += 1
+						if accept_frame_fn:
+							accept_frame_fn(self.frame, self.frame_resync, self.frame_drop, idx_lock=True, time=buf.get_time())
+						self.frame_drop = False
 						self.frame = []
 					
 					self.bit_idx = 0
 					self.byte = 0
 					self.newly_synced = False
 
+class VectorSymbolDeframer(Deframer):	# Same decisions as SymbolDeframer, but works on whole buffers with numpy
+	def __init__(self, length):
+		Deframer.__init__(self, length)
+		self.synced = False
+		self.skip = 0
+		self.last_sym = 0
+		self.sym_idx = 0
+		self.sym_cnt = 2
+		self.bits = numpy.zeros(0, dtype=numpy.uint8)	# Bits of the byte currently being assembled (always fewer than 8)
+		self.frame = numpy.zeros(length, dtype=numpy.uint8)
+		self.frame_len = 0
+		self.frame_resync = False
+		self.frame_drop = False
+		self.frame_time = None	# Receive time of the buffer being decoded
+		self.pre_sync_byte = 0xbe >> 1	# Last byte of sync without last bit
+		self.newly_synced = False
+	def get_state(self):
+		if self.synced: return state.STATE_RECEIVING
+		return state.STATE_WAITING_FOR_SYNC
+	def process(self, buffers, accept_fn=None, accept_frame_fn=None):
+		for buf in buffers:
+			self.frame_time = buf.get_time()
+			
+			if buf.get_flags() & net.Buffer.FLAG_DROP:
+				self.synced = False
+				self.skip = 0
+				self.frame_drop = True
+			
+			data = buf.get_buffer()
+			if isinstance(data, memoryview):	# e.g. straight from the UDP receive ring (NumPy's frombuffer can't take one in Python 2)
+				data = numpy.asarray(data)
+			else:
+				data = numpy.frombuffer(data, dtype=numpy.uint8)
+			flags = numpy.flatnonzero(data & 0x2)	# Correlated
+			flag_cnt = len(flags)
+			flag_idx = 0
+			pos = 0
+			end = len(data)
+			
+			while pos < end:
+				if self.skip > 0:
+					cnt = min(self.skip, end - pos)
+					self.skip -= cnt
+					pos += cnt
+					continue
+				
+				while flag_idx < flag_cnt and flags[flag_idx] < pos:	# Flags on skipped symbols are never seen
+					flag_idx += 1
+				
+				if flag_idx < flag_cnt:
+					next_flag = flags[flag_idx]
+				else:
+					next_flag = end
+				
+				if self.synced:
+					self._decode(data[pos:next_flag], accept_fn, accept_frame_fn)
+				
+				if next_flag == end:
+					break
+				
+				pos = next_flag
+				flag_idx += 1
+				
+				self.sym_idx = 0
+				
+				if self.synced:
+					if self.frame_len != (self.length - 1) or self._get_byte() != self.pre_sync_byte:	# If not in the final byte, then something has gone wrong
+						self.sync_reset_cnt += 1
+						self.synced = False
+				
+				if self.synced == False:
+					self.synced = True
+					self.skip = 1	# Flag on first bit after access code
+					self.bits = self.bits[:0]
+					self.frame_len = 0
+					self.newly_synced = True
+					pos += 1
+					continue
+				
+				# In the final byte: the pre-sync bits are already in place, so decoding resumes on this symbol
+	def _get_byte(self):
+		if len(self.bits) != 7:	# Pre-sync byte is only complete with 7 bits
+			return None
+		return int(numpy.packbits(self.bits)[0]) >> 1
+	def _decode(self, syms, accept_fn, accept_frame_fn):
+		if len(syms) == 0:
+			return
+		
+		syms = syms & 0x1
+		
+		if self.sym_idx == (self.sym_cnt-1):
+			syms = numpy.concatenate((numpy.array([self.last_sym], dtype=numpy.uint8), syms))
+		
+		pair_cnt = len(syms) / 2
+		if len(syms) % 2:
+			self.last_sym = syms[-1]
+			self.sym_idx = 1
+		else:
+			self.sym_idx = 0
+		
+		if pair_cnt == 0:
+			return
+		
+		qli = syms[0:pair_cnt*2:2] ^ syms[1:pair_cnt*2:2] ^ 0x1	# d1 ^ (not d2)
+		
+		bits = numpy.concatenate((self.bits, qli))
+		byte_cnt = len(bits) / 8
+		self.bits = bits[byte_cnt*8:]
+		
+		if byte_cnt == 0:
+			return
+		
+		data = numpy.packbits(bits[:byte_cnt*8])
+		
+		idx = 0
+		while idx < byte_cnt:
+			if self.frame_len == 0:
+				self.frame_resync = self.newly_synced
+			self.newly_synced = False
+			
+			cnt = min(self.length - self.frame_len, byte_cnt - idx)
+			self.frame[self.frame_len:self.frame_len+cnt] = data[idx:idx+cnt]
+			self.frame_len += cnt
+			idx += cnt
+			
+			if self.frame_len == self.length:
+				self.complete_frame_cnt += 1
+				self.frame_len = 0
+				self._emit(accept_fn, accept_frame_fn)
+	def _emit(self, accept_fn, accept_frame_fn):
+		frame = self.frame.tolist()
+		drop = self.frame_drop
+		self.frame_drop = False
+		if accept_frame_fn:
+			accept_frame_fn(frame, self.frame_resync, drop, idx_lock=True, time=self.frame_time)
+			return
+		if not accept_fn:
+			return
+		idx = 0
+		for b in frame:
+			accept_fn(b, frame, (self.frame_resync and idx == 0), idx, time=self.frame_time)
+			idx += 1
+
+PATTERN_MODULE		= 'module:'
+PATTERN_CATEGORY	= 'category:'
+PATTERN_REGEX		= 're:'
+PATTERN_PREFIXES	= [PATTERN_MODULE, PATTERN_CATEGORY, PATTERN_REGEX]
+PATTERN_GLOB_CHARS	= '*?['
+PATTERN_CACHE_SIZE	= 64	# Patterns come from clients, so only the most recently used are kept
+
 class ElementManager():
 	def __init__(self):
 		self.elements_by_module = {}
+		self.elements_by_category = {}
 		self.elements_map = {}
+		self.sorted_element_ids = []	# For prefix searches
+		self.pattern_cache = collections.OrderedDict()	# Pattern -> element IDs, least recently used first (elements don't change once loaded)
 	def get_element(self, name, safe=True):
 		if name not in self.elements_map.keys():
 			if not safe:
@@ -214,6 +382,53 @@ class ElementManager():
 		if module not in self.elements_by_module.keys():
 			return None
 		return self.elements_by_module[module]
+	def get_element_category_ids(self):
+		return self.elements_by_category.keys()
+	def get_elements_by_category(self, category):
+		if category not in self.elements_by_category:
+			return None
+		return self.elements_by_category[category]
+	def is_pattern(self, spec):
+		if not isinstance(spec, basestring):	# Left to fail as a plain ID
+			return False
+		for prefix in PATTERN_PREFIXES:
+			if spec.startswith(prefix):
+				return True
+		for c in PATTERN_GLOB_CHARS:
+			if c in spec:
+				return True
+		return False
+	def find_elements(self, pattern):	# Element IDs matching 'module:<name>', 'category:<name>', 're:<regex>' (searched for anywhere in the ID) or a glob
+		if pattern in self.pattern_cache:
+			element_ids = self.pattern_cache.pop(pattern)
+			self.pattern_cache[pattern] = element_ids	# Now most recently used
+			return element_ids
+		
+		if pattern.startswith(PATTERN_MODULE):
+			element_ids = self.get_elements_by_module(pattern[len(PATTERN_MODULE):]) or []
+		elif pattern.startswith(PATTERN_CATEGORY):
+			element_ids = self.get_elements_by_category(pattern[len(PATTERN_CATEGORY):]) or []
+		elif pattern.startswith(PATTERN_REGEX):
+			regex = re.compile(pattern[len(PATTERN_REGEX):])
+			element_ids = [x for x in self.sorted_element_ids if regex.search(x)]
+		else:
+			prefix = pattern
+			for c in PATTERN_GLOB_CHARS:
+				if c in prefix:
+					prefix = prefix[:prefix.index(c)]
+			element_ids = []
+			for i in range(bisect.bisect_left(self.sorted_element_ids, prefix), len(self.sorted_element_ids)):	# Only IDs with the glob's literal prefix
+				element_id = self.sorted_element_ids[i]
+				if not element_id.startswith(prefix):
+					break
+				if fnmatch.fnmatchcase(element_id, pattern):
+					element_ids += [element_id]
+		
+		element_ids = list(element_ids)
+		if len(self.pattern_cache) >= PATTERN_CACHE_SIZE:
+			self.pattern_cache.popitem(last=False)
+		self.pattern_cache[pattern] = element_ids
+		return element_ids
 	def load_elements(self, load_path=".", verbose=False):
 		abs_load_path = os.path.abspath(load_path)
 		if verbose: print "Loading elements from:", abs_load_path
@@ -250,6 +465,13 @@ class ElementManager():
 						continue
 					self.elements_map[e.id()] = e
 					module_element_list += [e.id()]
+					if e.category() is not None:
+						if e.category() not in self.elements_by_category:
+							self.elements_by_category[e.category()] = []
+						self.elements_by_category[e.category()] += [e.id()]
+		
+		self.sorted_element_ids = sorted(self.elements_map.keys())
+		self.pattern_cache.clear()
 		
 		if verbose: print "Loaded %d elements" % (len(self.elements_map.keys()))
 
@@ -258,6 +480,8 @@ class ElementStateManager():
 		self.element_manager = element_manager
 		self.engine = engine
 		self.element_state_map = {}
+		self.consumer_counts = {}	# Element ID -> number of consumers (UI layouts, server clients, etc) that have acquired it
+		self.consumer_lock = threading.Lock()	# Server clients release from their own threads
 	def get_element_state(self, element, safe=True):
 		if not isinstance(element, str):
 			element = str(element)
@@ -268,6 +492,43 @@ class ElementStateManager():
 			element_state = state.ElementState(element_instance, self, self.engine)
 			self.element_state_map[element] = element_state
 		return self.element_state_map[element]
+	def acquire(self, element, safe=True):	# Returns the element state (None if not found). In on-demand mode, it is only decoded while it has been acquired.
+		element_state = self.get_element_state(element, safe)
+		if element_state is None:
+			return None
+		element_id = element_state.get_element().id()
+		with self.consumer_lock:
+			if element_id not in self.consumer_counts:
+				self.consumer_counts[element_id] = 0
+				if self.engine.options.on_demand:
+					self.engine.track_element_state(element_state)
+			self.consumer_counts[element_id] += 1
+		return element_state
+	def release(self, element):
+		element_state = self.get_element_state(element, False)
+		if element_state is None:
+			return None
+		element_id = element_state.get_element().id()
+		with self.consumer_lock:
+			if element_id not in self.consumer_counts:
+				raise Exception("Element '%s' released without being acquired" % (element_id))
+			self.consumer_counts[element_id] -= 1
+			if self.consumer_counts[element_id] == 0:
+				del self.consumer_counts[element_id]
+				if self.engine.options.on_demand:
+					self.engine.untrack_element_state(element_state)
+		return element_state
+	def get_history_memory_usage(self):	# Bytes held by all element histories
+		total = 0
+		for element_state in self.element_state_map.values():
+			total += element_state.get_history_memory_usage()
+		return total
+	def get_consumer_count(self, element):
+		if not isinstance(element, str):
+			element = str(element)
+		if element not in self.consumer_counts:
+			return 0
+		return self.consumer_counts[element]
 
 class Engine(state.EventDispatcher, state.Tracker):
 	def __init__(self, options):
@@ -282,15 +543,29 @@ class Engine(state.EventDispatcher, state.Tracker):
 		self.subcom_trackers = {}
 		self.trackers = {MINOR_FRAME_KEY: self.frame_tracker}
 		
+		self.commands = collections.deque()	# (function, args) from other threads (e.g. server tracking changes), run between frames
+		self.command_stats = (0, 0.0, 0.0)	# (count, total time, max time) spent running them
+		
 		if options.input:
 			self.deframer = ByteDeframer(MINOR_FRAME_LEN)
-			self.net = input.FileInput()
+			if archive.is_archive(options.input):
+				self.net = archive.ArchiveInput()
+			elif options.index:
+				self.net = input.IndexedFileInput(follow=options.follow)
+			else:
+				self.net = input.FileInput()
+			self.net.set_pacing(options.replay_speed, options.frame_interval)
 		elif options.network_address:
 			self.deframer = ByteDeframer(MINOR_FRAME_LEN)
 			self.net = net.TCPNetwork()
 		else:
-			self.deframer = SymbolDeframer(MINOR_FRAME_LEN)
-			self.net = net.UDPNetwork()
+			if options.vector_deframer:
+				self.deframer = VectorSymbolDeframer(MINOR_FRAME_LEN)
+			else:
+				self.deframer = SymbolDeframer(MINOR_FRAME_LEN)
+			self.net = net.UDPNetwork(receive_buffer_size=options.receive_buffer)
+		
+		self.archive = None	# ArchiveWriter recording minor frames
 		
 		self.server = server.Server(self, self.element_manager, self.element_state_manager, global_log)
 		if options.headless:
@@ -299,6 +574,24 @@ class Engine(state.EventDispatcher, state.Tracker):
 			self.ui = ui.UserInterface(self)
 	def get_element(self, name, safe=True):
 		return self.element_manager.get_element(name, safe)
+	def post_command(self, fn, *args):	# Thread-safe: 'fn' is called by the engine thread at the next frame boundary
+		self.commands.append((fn, args))
+	def run_commands(self):	# Engine thread only
+		start = time.time()
+		while len(self.commands) > 0:
+			fn, args = self.commands.popleft()
+			try:
+				fn(*args)
+			except Exception, e:
+				global_log("While running command %s: %s" % (fn, e))
+		duration = time.time() - start
+		cnt, total, maximum = self.command_stats
+		self.command_stats = (cnt + 1, total + duration, max(maximum, duration))
+	def get_command_stats(self):	# (times commands were run, average, max) in seconds
+		cnt, total, maximum = self.command_stats
+		if cnt == 0:
+			return (0, 0.0, 0.0)
+		return (cnt, total / cnt, maximum)
 	def get_element_state(self, element):
 		return self.element_state_manager.get_element_state(element)
 	def track(self, indices, target, same_tracker=True):	# Currently indices will always be for same tracker in one call
@@ -327,49 +620,75 @@ class Engine(state.EventDispatcher, state.Tracker):
 			#l += 
 			self.trackers[trigger.name].untrack([trigger], target)
 		#return l
-	def start(self, verbose=False):
+	def track_element_state(self, element_state):	# With every tracker that can handle its positions
+		positions = element_state.get_element().positions()
+		trigger_indices = positions.get_trigger_indices(mode=self.options.mode)
+		for tracker in [self.frame_tracker] + self.subcom_trackers.values():
+			if not positions.is_compatible_tracker(tracker):
+				continue
+			try:
+				tracker.track(trigger_indices, element_state)
+			except:
+				print "Exception during tracking of '%s': %s" % (element_state.get_element().id(), trigger_indices)
+				raise
+	def untrack_element_state(self, element_state):
+		positions = element_state.get_element().positions()
+		trigger_indices = positions.get_trigger_indices(mode=self.options.mode)
+		for tracker in [self.frame_tracker] + self.subcom_trackers.values():
+			if positions.is_compatible_tracker(tracker):
+				tracker.untrack(trigger_indices, element_state)
+	def load(self, verbose=False):	# Load elements and build the tracking state (without starting any I/O)
 		res.load_curves(self.options.load_path, verbose)
 		self.element_manager.load_elements(self.options.load_path, verbose)
 		
-		# FIXME: If an element doesn't get tracked due to a certain mode where it'll never appear, mark is as such and have UI not display it
-		
-		for k in self.element_manager.get_element_ids():
-			element_state = self.get_element_state(k)	# Create element state
-			
-			#self.frame_tracker.track(element_state.get_trigger_indices(), element_state)	# Force registration with tracker: this needs to be the first handler
-			#if self.frame_tracker.is_compatible_target(element_state.get_element().positions()):
-			#	self.frame_tracker.track(element_state.get_element().positions().get_trigger_indices(), element_state)
-			
-			positions = element_state.get_element().positions()
-			if positions.is_compatible_tracker(self.frame_tracker):
-				try:
-					self.frame_tracker.track(positions.get_trigger_indices(mode=self.options.mode), element_state)
-				except:
-					print "Exception during tracking of '%s': %s" % (element_state.get_element().id(), positions.get_trigger_indices(mode=self.options.mode))
-					raise
-		
 		current_mode_col_map = MODE_MAP[self.options.mode]
 		
-		for subcom_key in current_mode_col_map.keys():
+		for subcom_key in current_mode_col_map.keys():	# Subcoms are always reassembled (their raw layout and some parsers read them directly)
 			subcom_length, subcom_cols = current_mode_col_map[subcom_key]
 			subcom_tracker = state.SubcomTracker(subcom_key, subcom_length, subcom_cols, NUM_MINOR_FRAMES)
 			self.frame_tracker.track(subcom_tracker.get_trigger_indices(), subcom_tracker.update)
 			self.subcom_trackers[subcom_key] = subcom_tracker
 			self.trackers[subcom_key] = subcom_tracker
-			
+		
+		# FIXME: If an element doesn't get tracked due to a certain mode where it'll never appear, mark is as such and have UI not display it
+		
+		if not self.options.on_demand:	# Otherwise element states are only tracked while a consumer has acquired them
+			for k in self.element_manager.get_element_ids():
+				element_state = self.get_element_state(k)	# Create element state
+				self.track_element_state(element_state)
+		
+		if self.options.history_length > 0 or self.options.history_duration > 0:	# Recorded whenever an element is decoded
+			history_length = None
+			if self.options.history_length > 0:
+				history_length = self.options.history_length
+			history_duration = None
+			if self.options.history_duration > 0:
+				history_duration = self.options.history_duration
 			for k in self.element_manager.get_element_ids():
-				element_state = self.get_element_state(k)
-				positions = element_state.get_element().positions()
-				if positions.is_compatible_tracker(subcom_tracker):
-					try:
-						subcom_tracker.track(positions.get_trigger_indices(mode=self.options.mode), element_state)
-					except:
-						print "Exception during subcom '%s' tracking of '%s': %s" % (subcom_key, element_state.get_element().id(), positions.get_trigger_indices(mode=self.options.mode))
-						raise
+				self.get_element_state(k).enable_history(history_length, history_duration)
+		
+		for subcom_key in self.subcom_trackers.keys():
+			self.subcom_trackers[subcom_key].compile()
+		
+		self.frame_tracker.compile()	# Build dispatch tables (track/untrack will keep them up-to-date from now on)
+	def start(self, verbose=False):
+		self.load(verbose)
+		
+		if self.options.archive:
+			self.archive = archive.ArchiveWriter(self.options.archive, self, self.options.archive_source)
+			self.frame_tracker.register(EVENT_NEW_FRAME, self.archive)
+			global_log("Recording to archive: %s (%d frames already in it)" % (self.options.archive, self.archive.get_frame_count()))
 		
 		self.net.start(address=self.options.network_address, port=self.options.port, file_path=self.options.input)
 		
-		self.server.start(port=self.options.server_port)
+		if isinstance(self.net, input.IndexedFileInput) or isinstance(self.net, archive.ArchiveInput):
+			global_log("%d frames in: %s" % (self.net.get_frame_count(), self.options.input))
+			if self.options.start_time is not None:
+				self.net.seek_time(self.options.start_time)
+			elif self.options.start_frame > 0:
+				self.net.seek_frame(self.options.start_frame)
+		
+		self.server.start(port=self.options.server_port, queue_length=self.options.client_queue, overflow_policy=self.options.overflow)
 		
 		global _layouts
 		if _layouts is None:
@@ -402,7 +721,10 @@ class Engine(state.EventDispatcher, state.Tracker):
 			# It's mainly here as a workaround for windows that are too small and causes curses to throw an exception as the UI assumes the window is larger enough
 			try:
 			#if True:
-				self.deframer.process(data, self.accept_byte)
+				if self.has_listeners(EVENT_NEW_BYTE) or self.frame_tracker.has_listeners(EVENT_NEW_BYTE):
+					self.deframer.process(data, accept_fn=self.accept_byte)	# Only when something needs each byte as it arrives (e.g. raw frame layout)
+				else:
+					self.deframer.process(data, accept_frame_fn=self.accept_frame)
 				
 				if self.ui:
 					if not self.ui.run():
@@ -417,16 +739,39 @@ class Engine(state.EventDispatcher, state.Tracker):
 			
 			self.server.run()
 			
+			if self.archive:
+				self.archive.check_flush()
+			
+			if len(self.commands) > 0:	# When no frames are arriving
+				self.run_commands()
+			
 			if ((len(data) == 0) or (self.options.always_sleep)) and (self.options.sleep > 0):
 				time.sleep(self.options.sleep)
-	def accept_byte(self, byte, frame, sync=False, idx=None):	# Called by Deframer
-		self.frame_tracker.update(byte, frame, sync, idx)	# Will update Subcoms
+	def accept_byte(self, byte, frame, sync=False, idx=None, time=None):	# Called by Deframer ('time' is when the byte's buffer was received)
+		if len(self.commands) > 0 and (idx == 0 or (idx is None and len(frame) == 1)):	# Frame boundary
+			self.run_commands()
+		
+		if time is None:
+			time = self.local_time_now
+		
+		self.frame_tracker.update(byte, frame, sync, idx, time=time)	# Will update Subcoms
 		
 		self.dispatch(EVENT_NEW_BYTE, byte=byte, frame=frame, sync=sync, idx=idx)
+	def accept_frame(self, frame, sync=False, drop=False, idx_lock=False, time=None):	# Called by Deframer with a complete minor frame ('time' is when its buffer was received)
+		if len(self.commands) > 0:
+			self.run_commands()
+		
+		if time is None:
+			time = self.local_time_now
+		
+		self.frame_tracker.update_frame(frame, sync, drop, idx_lock, time=time)	# Will update Subcoms
 	def get_local_time_now(self): return self.local_time_now
 	def get_state(self):
 		return self.deframer.get_state()
 	def stop(self):
+		if self.archive:	# First, so what has been recorded is kept even if stopping anything else fails
+			self.archive.close()
+		
 		if self.ui: self.ui.stop()
 		#print "UI shutdown"
 		
@@ -455,7 +800,22 @@ def main():
 	parser.add_option("-v", "--verbose", action="store_true", default=False, help="verbose logging outside of UI [default=%default]")
 	parser.add_option("-m", "--mode", type="string", default="engineering", help="select telemetry mode (%s) [default=%%default]" % (",".join(MODE_MAP.keys())))
 	parser.add_option("-H", "--headless", action="store_true", default=False, help="do not run the UI [default=%default]")
-	parser.add_option("-i", "--input", type="string", default=None, help="input file (instead of network) [default=%default]")
+	parser.add_option("-i", "--input", type="string", default=None, help="input file: PK log or archive (instead of network) [default=%default]")
+	parser.add_option("-x", "--index", action="store_true", default=False, help="memory-map the input file and replay it through a frame index (cached next to it) [default=%default]")
+	parser.add_option("-F", "--follow", action="store_true", default=False, help="keep replaying frames appended to an indexed input file, instead of stopping at its end [default=%default]")
+	parser.add_option("-f", "--start-frame", type="int", default=0, help="frame of an indexed input file to start from [default=%default]")
+	parser.add_option("-t", "--start-time", type="string", default=None, help="receive time (YYYY-MM-DD HH:MM:SS) in an indexed input file to start from [default=%default]")
+	parser.add_option("-r", "--replay-speed", type="float", default=0.0, help="replay an input file at this multiple of its recorded pace (1: real time, 0: as fast as possible) [default=%default]")
+	parser.add_option("-I", "--frame-interval", type="float", default=0.0, help="recorded seconds between replayed frames that have no receive time (0: don't pace them) [default=%default]")
+	parser.add_option("-a", "--archive", type="string", default=None, help="record minor frames to a binary archive (appended to if it exists, and can be replayed with -i) [default=%default]")
+	parser.add_option("-A", "--archive-source", type="int", default=0, help="source ID recorded with each archived frame (0-255) [default=%default]")
+	parser.add_option("-R", "--receive-buffer", type="int", default=0, help="UDP socket receive buffer size (SO_RCVBUF) in bytes (0: system default) [default=%default]")
+	parser.add_option("-V", "--vector-deframer", action="store_true", default=False, help="use numpy symbol deframer for UDP input [default=%default]")
+	parser.add_option("-q", "--client-queue", type="int", default=1000, help="messages queued for each server client before overflowing [default=%default]")
+	parser.add_option("-O", "--overflow", type="choice", choices=server.OVERFLOW_POLICIES, default=server.OVERFLOW_DROP_OLDEST, help="server client queue overflow policy (%s) [default=%%default]" % (",".join(server.OVERFLOW_POLICIES)))
+	parser.add_option("-D", "--on-demand", action="store_true", default=False, help="only decode elements that are displayed or registered by a client [default=%default]")
+	parser.add_option("-k", "--history-length", type="int", default=0, help="samples of history kept for each element (0: unlimited if a duration is given, otherwise none) [default=%default]")
+	parser.add_option("-K", "--history-duration", type="float", default=0.0, help="seconds of history kept for each element (0: no limit) [default=%default]")
 	
 	(options, args) = parser.parse_args()
 	
@@ -469,6 +829,19 @@ def main():
 	options.mode = matching_modes[0]
 	print "Mode:", options.mode
 	
+	if (options.start_time is not None or options.start_frame > 0) and not (options.input and (options.index or archive.is_archive(options.input))):
+		print "Starting from a frame or time needs an indexed input file (-i and -x) or an archive"
+		return
+	if options.follow and not (options.input and options.index):
+		print "Following an input file needs it to be indexed (-i and -x)"
+		return
+	if options.start_time is not None:
+		try:
+			options.start_time = datetime.datetime.strptime(options.start_time, "%Y-%m-%d %H:%M:%S")
+		except Exception, e:
+			print "Failed to parse start time:", e
+			return
+	
 	options.network_address = None
 	
 	if len(args) > 0:
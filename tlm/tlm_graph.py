@@ -38,7 +38,7 @@ import matplotlib
 import matplotlib.pyplot as pyplot
 import wx	# For catching when GUI is closed (when using WX MPL backend)
 
-import realtime_graph
+import realtime_graph, protocol
 
 """ From server.py:
 state['id'] = element_state.get_element().id()
@@ -123,10 +123,11 @@ class ElementState():
 		self.y = numpy.append(self.y, [v])
 
 class Network(threading.Thread):
-	def __init__(self, destination, buffer_size=1024, sleep=1, auto_reconnect=True, *args, **kwds):
+	def __init__(self, destination, buffer_size=1024, sleep=1, auto_reconnect=True, wire_protocol=protocol.PROTOCOL_JSON, *args, **kwds):
 		threading.Thread.__init__(self, name="Network", *args, **kwds)
 		self.setDaemon(True)
 		self.destination = destination
+		self.wire_protocol = wire_protocol
 		self.sock = None
 		self.buffer_size = buffer_size
 		self.sleep = sleep
@@ -139,6 +140,8 @@ class Network(threading.Thread):
 		self.buffer = ""
 		self.seq = 0
 		self.msgs = []
+		self.binary = False	# Until negotiated on each connection
+		self.element_ids = {}	# Index -> element ID (binary updates only carry the index from registration)
 	def set_auto_reconnect(self, auto_reconnect):
 		self.auto_reconnect = auto_reconnect
 	def get_msgs(self):
@@ -171,6 +174,17 @@ class Network(threading.Thread):
 					return False
 				break
 		
+		if self.wire_protocol != protocol.PROTOCOL_JSON:
+			return self.negotiate()
+		
+		return True
+	def negotiate(self):	# Requests stay as JSON, but what the server sends changes after the response
+		response = self._transact({'action':'protocol', 'data':self.wire_protocol})
+		if response is None or response['error'] is not None:
+			print "Failed to negotiate protocol:", self.wire_protocol
+			return False
+		self.buffer = ""
+		self.binary = (self.wire_protocol == protocol.PROTOCOL_BINARY)
 		return True
 	def run(self):
 		while self.keep_running:
@@ -279,35 +293,63 @@ class Network(threading.Thread):
 			
 			cnt += 1
 			self.buffer += data
-			lines = self.buffer.splitlines(True)
 			
-			for line in lines:
-				if line[-1] != '\n':
-					self.buffer = line
-					break
-				line = line.strip()
+			for msg in self._decode():
+				if msg.has_key('error') and msg['error'] is not None:
+					print "Error at server: %s\n%s" % (msg['error'], msg)
+				
+				if msg.has_key('action') and msg['action'] == 'register' and msg['result'] is not None:
+					successful_elements, failed_elements = msg['result']
+					for element_info in successful_elements:
+						if 'index' in element_info:
+							self.element_ids[element_info['index']] = element_info['id']
 				
+				# With 'seq' this ignores previous messages AND future decoded messages
+				if seq:
+					if msg.has_key('seq'):
+						if seq == msg['seq']:
+							return [msg]
+					cnt = 0	# Don't abort the loop if there's no more to read
+				elif msg.has_key('action') and msg['action'] == 'batch':
+					msgs += msg['result']	# Same as individual updates
+				else:
+					msgs += [msg]
+		
+		return msgs
+	def _decode(self):	# Returns complete messages in the buffer (binary updates are turned back into the same form as JSON ones)
+		msgs = []
+		
+		if self.binary:
+			records, self.buffer = protocol.unpack_records(self.buffer)
+			for record_type, body in records:
 				try:
-					try:
-						msg = jsonpickle.decode(line)
-					except Exception, e:
-						raise Exception("Could not decode JSON:\n%s" % (line))
-					
-					if msg.has_key('error') and msg['error'] is not None:
-						print "Error at server: %s\n%s" % (msg['error'], msg)
-					
-					# With 'seq' this ignores previous messages AND future decoded lines
-					if seq:
-						if msg.has_key('seq'):
-							if seq == msg['seq']:
-								return [msg]
-						cnt = 0	# Don't abort the loop if there's no more to read
+					if record_type == protocol.RECORD_JSON:
+						msgs += [jsonpickle.decode(body)]
+					elif record_type == protocol.RECORD_UPDATE:
+						element_idx, state = protocol.unpack_update(body)
+						if element_idx not in self.element_ids:
+							raise Exception("Unknown element index: %d" % (element_idx))
+						state['id'] = self.element_ids[element_idx]
+						msgs += [{'result':state, 'error':None}]
 					else:
-						msgs += [msg]
+						raise Exception("Unknown record type: %d" % (record_type))
 				except Exception, e:
-					print "Exception in message decode: %s" % (e)
-			else:
-				self.buffer = ""
+					print "Exception in record decode: %s" % (e)
+			return msgs
+		
+		lines = self.buffer.splitlines(True)
+		for line in lines:
+			if line[-1] != '\n':
+				self.buffer = line
+				break
+			line = line.strip()
+			
+			try:
+				msgs += [jsonpickle.decode(line)]
+			except Exception, e:
+				print "Exception in message decode: Could not decode JSON:\n%s" % (line)
+		else:
+			self.buffer = ""
 		
 		return msgs
 
@@ -322,6 +364,7 @@ def main():
 	parser.add_option("-x", "--x-type", type="string", default="", help="default X-axis type (blank: consecutive samples, time) [default=%default]")
 	#parser.add_option("-v", "--verbose", action="store_true", default=False, help="verbose logging [default=%default]")
 	parser.add_option("-n", "--no-reconnect", action="store_true", default=False, help="do not automatically reconnect [default=%default]")
+	parser.add_option("-b", "--binary", action="store_true", default=False, help="use binary protocol for updates [default=%default]")
 	
 	(options, args) = parser.parse_args()
 	
@@ -345,6 +388,7 @@ def main():
 	
 	element_states = {}
 	elements_ordered = []
+	subscriptions = {}	# Element ID -> server-side options (e.g. 'spin_rate,max_rate=2,deadband=0.5')
 	
 	for element_spec in args[1:]:
 		parts = element_spec.split(',')
@@ -358,10 +402,20 @@ def main():
 		if 'duration' not in kwdargs.keys(): kwdargs['duration'] = options.duration
 		if 'value_type' not in kwdargs.keys(): kwdargs['value_type'] = options.type
 		if 'x_type' not in kwdargs.keys(): kwdargs['x_type'] = options.x_type
+		subscription = {}
+		for key in ['max_rate', 'every', 'on_change', 'deadband']:
+			if key in kwdargs.keys():
+				subscription[key] = kwdargs[key]
+				del kwdargs[key]
+		if 'on_change' in subscription.keys():
+			subscription['on_change'] = (subscription['on_change'].lower() in ['1', 'true', 'yes'])
 		state = ElementState(element_id, **kwdargs)
 		if element_id in element_states.keys():
 			print "Element \'%s\' already supplied" % (element_id)
 			continue
+		if len(subscription) > 0:
+			subscription['id'] = element_id
+			subscriptions[element_id] = subscription
 		element_states[element_id] = state
 		elements_ordered += [(element_id, state)]
 	
@@ -374,11 +428,22 @@ def main():
 	##################################################################
 	
 	try:
-		net = Network(destination, sleep=options.sleep, auto_reconnect=not options.no_reconnect)
+		wire_protocol = protocol.PROTOCOL_JSON
+		if options.binary:
+			wire_protocol = protocol.PROTOCOL_BINARY
+		
+		net = Network(destination, sleep=options.sleep, auto_reconnect=not options.no_reconnect, wire_protocol=wire_protocol)
 		if not net.connect():
 			return
 		
-		registration = {'action':'register', 'data':element_states.keys()}
+		registration_data = []
+		for element_id in element_states.keys():
+			if element_id in subscriptions.keys():
+				registration_data += [subscriptions[element_id]]
+			else:
+				registration_data += [element_id]
+		
+		registration = {'action':'register', 'data':registration_data}
 		
 		response = net.transact(registration)
 		if response is None:
@@ -220,6 +220,7 @@ class ElementsLayout(Layout):
 		for element in self.elements:
 			self.y_offset_map[element.id()] = y+cnt
 			
+			self.ui.engine.element_state_manager.acquire(element)	# Before tracking, so it's decoded before being drawn
 			self.ui.engine.track(element.positions().get_trigger_indices(mode=self.ui.engine.options.mode), self)
 			
 			scr.move(self.y_offset_map[element.id()], 1)
@@ -233,6 +234,7 @@ class ElementsLayout(Layout):
 	def deactivate(self):
 		for element in self.elements:
 			self.ui.engine.untrack(element.positions().get_trigger_indices(mode=self.ui.engine.options.mode), self)
+			self.ui.engine.element_state_manager.release(element)
 		
 		Layout.deactivate(self)
 	def __call__(self, *args, **kwds):
@@ -261,7 +263,7 @@ class ElementsLayout(Layout):
 		scr.addstr(count_str)
 		
 		s = " = "
-		value_str = element.formatter().format(element_state.last_value)
+		value_str = element_state.get_formatted_value()
 		s += value_str
 		if element.unit() is not None and len(element.unit()) > 0:
 			s += " " + element.unit()
@@ -277,7 +279,7 @@ class ElementsLayout(Layout):
 		
 		if element_state.previous_value is not None:
 			scr.move(self.y_offset_map[element.id()], 1 + self.max_id_len + self.padding + self.max_value_len + 10)	# MAGIC
-			s = " (%03d: %s)" % ((self.ui.engine.get_local_time_now() - element_state.previous_value_time).total_seconds(), element.formatter().format(element_state.previous_value))
+			s = " (%03d: %s)" % ((self.ui.engine.get_local_time_now() - element_state.previous_value_time).total_seconds(), element_state.get_formatted_previous_value())
 			scr.addstr(s)
 		
 		time_delta = self.ui.engine.get_local_time_now() - element_state.last_update_time
@@ -310,7 +312,8 @@ class HistoryLayout(Layout):
 			element, history_length = spec
 			self.history_lengths[element] = history_length
 			self.history_map[element] = []
-			trigger_indices = self.ui.engine.get_element_state(element).get_element().positions().get_trigger_indices(mode=self.ui.engine.options.mode)
+			element_state = self.ui.engine.element_state_manager.acquire(element)	# History is always collected
+			trigger_indices = element_state.get_element().positions().get_trigger_indices(mode=self.ui.engine.options.mode)
 			self.ui.engine.track(trigger_indices, self)
 			for trigger_index in trigger_indices:
 				if trigger_index not in self.trigger_map.keys(): self.trigger_map[trigger_index] = []
@@ -335,7 +338,7 @@ class HistoryLayout(Layout):
 			if element_state.last_value is None:
 				return
 			
-			value_str = element_state.get_element().formatter().format(element_state.last_value)
+			value_str = element_state.get_formatted_value()
 			
 			history = self.history_map[element]
 			history += [value_str]
@@ -392,7 +395,7 @@ class UserInterface():
 		self.element_layout_key_shortcuts = {}
 		self.element_layouts = []
 		
-		self.layout_y_offset = 5
+		self.layout_y_offset = 7	# Below the status lines
 	def start(self, element_layouts):
 		self.minor_frame_layout = MinorFrameLayout("raw", self)
 		self.element_layout_key_shortcuts['`'] = self.minor_frame_layout
@@ -490,6 +493,8 @@ class UserInterface():
 			self.scr.addstr("Data lag    : %+f" % (self.engine.net.get_time_diff().total_seconds()))
 			self.scr.move(2, 32)
 			self.scr.addstr("Data source: %s" % (self.engine.net.get_status_string()))
+			if self.engine.archive:
+				self.scr.addstr(", %s" % (self.engine.archive.get_status_string()))
 			
 			self.scr.move(3, 0)
 			self.scr.clrtoeol()
@@ -500,6 +505,19 @@ class UserInterface():
 				self.engine.frame_tracker.ignore_minor_frame_idx,
 				self.engine.frame_tracker.minor_frame_idx,
 			))
+			
+			encode_rate, write_rate = self.engine.server.get_rates()
+			queued, max_queue_depth, dropped = self.engine.server.get_queue_stats()
+			self.scr.move(4, 0)
+			self.scr.clrtoeol()
+			self.scr.addstr("Server clients: %d, updates encoded: %.1f/s, written: %.1f/s, queued: %d (max %d), dropped: %d, filtered: %d" % (self.engine.server.get_client_count(), encode_rate, write_rate, queued, max_queue_depth, dropped, self.engine.server.filter_cnt))
+			
+			request_cnt, request_latency, max_request_latency = self.engine.server.get_request_stats('request')
+			lock_cnt, lock_time, max_lock_time = self.engine.server.get_request_stats('lock wait')
+			command_cnt, command_time, max_command_time = self.engine.get_command_stats()
+			self.scr.move(5, 0)
+			self.scr.clrtoeol()
+			self.scr.addstr("Server requests: %d, latency: %.1f ms (max %.1f), engine waited for update lock: %.2f ms (max %.2f), engine commands: %.2f ms (max %.2f)" % (request_cnt, request_latency * 1e3, max_request_latency * 1e3, lock_time * 1e3, max_lock_time * 1e3, command_time * 1e3, max_command_time * 1e3))
 		
 		if self.update_log_message:
 			self.scr.move(self.max_y-2, 0)
@@ -22,6 +22,8 @@
 #  
 #  
 
+import time
+
 class Callable:
 	def __init__(self, anycallable):
 		self.__call__ = anycallable
@@ -73,6 +75,9 @@ def num_range(start, stop): return range(start, stop + 1)	# [start, end] (inclus
 
 def flatten(l): return [i for subl in l for i in subl]
 
+def to_epoch(t):	# Local datetime -> seconds since the epoch
+	return time.mktime(t.timetuple()) + (t.microsecond / 1e6)
+
 def main():
 	return 0
 